@@ -16,7 +16,21 @@ the average speed. The purpose of this file is to allow to filter tracks e.g. by
 This file contains all time dependent values for each track. Information such as current velocities, viewing ranges
 and information about surrounding vehicles are included.
 
-This function processes all of these files
+This function processes all of these files. Run it from the root of the repository:
+    python -m Utils.A01_process_data [highD data folder] [output folder]
+or call extract(data_path, output_path) from another module.
+
+The recordings of all the locations are processed (see Location). The number of
+lanes of each direction comes from the lane markings of each recordingMeta, and
+the length of the section from section_length or the extent of the tracks, so the
+traffic density is normalised per recording. Car_following_groups.csv gives the
+location of each line.
+
+The extraction is a pipeline of generators: the Stage A lines of each vehicle go
+straight to Stage B (stage_a, stage_b), and the lines of both stages are appended
+to the output files chunk_rows lines at a time (AppendingWriter). So the memory
+does not grow with the number of recordings, and the files can be read while the
+extraction goes on (e.g. to train on the first recordings).
 
 TODO:
 1. Empirical analysis: Identify cases/situations in the data
@@ -41,6 +55,8 @@ import pandas as pd
 import numpy as np
 #import os
 
+from Utils.A04_dataset_catalog import load_catalog, recording_files
+
 minSec =10 # in seconds, we focus on vehicles that stay at least 40s in the data
 
 #prject_path = '~/Documents/Research/highD/'
@@ -48,207 +64,303 @@ prject_path = 'C:/Research/highD/'
 dynamic_col_to_use = [0,6,12,13,14,15,24]
 static_col_to_use = [1,2,6,9,10,11]
 nearby_index = [2,6]
-
-uniqueID = 0 #give an unique ID to the vehicle being processed
-
-Location = 2  #focus only on the location number 2 in the dataset
-L = 0.424  # length of the location under study (in km)
-NumLane = 2
-
-"""
-STAGE A: First, we process data into a line-by-line dataset of all related information
-"""
-
-print("Stage A")
-Car_following_df = []
-for i in range(1,60):
-    print("currently at file: " + str(i))
-    #file names:
-    if i <10:
-        record_name = prject_path + "data/0" + str(i) + "_recordingMeta.csv"
-        tracksMeta_name = prject_path + "./data/0" + str(i) + "_tracksMeta.csv"
-        track_name = prject_path + "./data/0" + str(i) + "_tracks.csv"
+#columns of the ids of the surrounding vehicles, in the order they are written out
+nearby_id_cols = ["leftPrecedingId","leftAlongsideId","leftFollowingId","rightPrecedingId","rightAlongsideId","rightFollowingId"]
+
+Location = None  #None for all the locations in the dataset, or a locationId (or a list of them) to focus on
+#length of the section (in km) of the locations where it is known; for the others it is the extent of the tracks
+section_length = {2: 0.424}
+
+frame_stride = None  # number of frames between two lines of data: None for one line per second (frameRate), 1 for every frame (25 Hz)
+target_horizon = 1  # the output acceleration is taken target_horizon frames after the line
+chunk_rows = 100000  # number of lines written to disk at a time
+
+
+def recording_geometry(recordMeta_df, all_track_df):
+    '''
+    Number of lanes of each direction (from the lane markings of the recordingMeta)
+    and length of the section in km
+    '''
+    upper = str(recordMeta_df["upperLaneMarkings"][0]).split(';')
+    lower = str(recordMeta_df["lowerLaneMarkings"][0]).split(';')
+    location = int(recordMeta_df["locationId"][0])
+    if location in section_length:
+        L = section_length[location]
     else:
-        record_name = prject_path + "./data/" + str(i) + "_recordingMeta.csv"
-        tracksMeta_name = prject_path + "./data/" + str(i) + "_tracksMeta.csv"
-        track_name = prject_path + "./data/" + str(i) + "_tracks.csv"
-
-    #Step A.1: Read the Record Metadata
-    recordMeta_df = pd.read_csv(record_name)
-    #only take the data in the morning (if we take the whole day there will be >1M data lines)
-    #if int(recordMeta_df["startTime"][0][1]) >12:
-    #    continue
+        # from the rear of the first vehicle to the front of the last one
+        x = all_track_df["x"].values
+        L = (np.max(x + all_track_df["width"].values) - np.min(x)) / 1000
+    return {'NumLaneUpper': len(upper)-1, 'NumLaneLower': len(lower)-1, 'L': L}
+
+
+def frame_aggregates(all_track_df, max_frame, NumLaneUpper=2):
+    '''
+    Number of vehicles and sum of xVelocity at every frame, for the upper lanes
+    (drivingDirection 1) and the lower lanes (drivingDirection 2). The laneIds
+    count the lane markings too: the upper lanes are 2..NumLaneUpper+1
+    '''
+    frames = all_track_df["frame"].values
+    upper = all_track_df["laneId"].values < NumLaneUpper+2
+    xVelocity = all_track_df["xVelocity"].values
+    count_upper = np.bincount(frames[upper], minlength=max_frame+1)
+    count_lower = np.bincount(frames[~upper], minlength=max_frame+1)
+    speed_upper = np.bincount(frames[upper], weights=xVelocity[upper], minlength=max_frame+1)
+    speed_lower = np.bincount(frames[~upper], weights=xVelocity[~upper], minlength=max_frame+1)
+    return count_upper, count_lower, speed_upper, speed_lower
+
+
+def find_rows(ids, frames, query_ids, query_frames):
+    '''
+    Row index in the tracks data of each (id, frame) pair, or -1 if not found.
+    The tracks data is sorted by id then frame, with consecutive frames for each id
+    '''
+    start = np.searchsorted(ids, query_ids, side='left')
+    start = np.minimum(start, len(ids)-1)
+    row = start + (query_frames - frames[start])
+    row_in = (row >= 0) & (row < len(ids))
+    row = np.where(row_in, row, 0)
+    found = row_in & (query_ids != 0) & (ids[row] == query_ids) & (frames[row] == query_frames)
+    return np.where(found, row, -1)
+
+
+def extract_recording(recordMeta_df, tracksMeta_df, all_track_df, uniqueID, frame_stride=None, target_horizon=1, chunk_rows=100000):
+    '''
+    Stage A for one recording, vectorised over all the lines of all the vehicles.
+    Returns a generator of blocks of at most chunk_rows lines and the next free uniqueID
+    '''
+    frameRate = recordMeta_df["frameRate"][0]
+    stride = frameRate if frame_stride is None else frame_stride
     timestamp =  pd.to_datetime(recordMeta_df["startTime"][0],format='%H:%M')
     time_hour =np.array(timestamp.hour+timestamp.minute/60)
-    #only take data if it's on our location of interests
-    
-    if recordMeta_df["locationId"][0] != Location:
-        continue
-    
-    #Step A.2: Read the tracksMeta data (summary about each vehicle)
-    tracksMeta_df = pd.read_csv(tracksMeta_name)
-    #Read the track data (individual vehicle data)
-    all_track_df = pd.read_csv(track_name)
-    #loop through the tracksMeta line-by-line, each line is a vehicle
+
+    all_track_df = all_track_df.sort_values(["id","frame"], kind='mergesort').reset_index(drop=True)
+    ids = all_track_df["id"].values
+    frames = all_track_df["frame"].values
+    # Step A.1: geometry of the road of this recording
+    geometry = recording_geometry(recordMeta_df, all_track_df)
+    L = geometry['L']
+    count_upper, count_lower, speed_upper, speed_lower = frame_aggregates(all_track_df, frames.max(), geometry['NumLaneUpper'])
+
+    # Step A.2: select the vehicles and the lines (one every stride frames) to use
+    rows = []
+    vehicles = []
     for l in range(0,len(tracksMeta_df.index)):
-        trackID = tracksMeta_df["id"][l]
-        drivingDirection = tracksMeta_df["drivingDirection"][l]  #1 for upper lanes (drive to the left), and 2 for lower lanes (drive to the right)
-        numFrames = tracksMeta_df["numFrames"][l]
-        
-        if numFrames < recordMeta_df["frameRate"][0]*minSec:  #only focus to vehicles that we can observed for more than minSec seconds
+        if tracksMeta_df["numFrames"][l] < frameRate*minSec:  #only focus to vehicles that we can observed for more than minSec seconds
             continue
-        #sanity check
-        if trackID != tracksMeta_df.iloc[l,0]:
-            print("The trackID is not the same at line: " + str(l))
-        
-        ############################################################        
-        # find all the static data of the vehicle (e.g. vehicle length, class, etc)
-        static_df_track = np.array(tracksMeta_df.iloc[l,static_col_to_use])
-        # convert categorical to binary variable (e.g Car vs Truck)
-        if static_df_track[2]=='Car':
-            static_df_track[2]=0
-        else: static_df_track[2]=1 #otherwise it should be a truck           
-        #convert to float for speed
-        static_df_track=static_df_track.astype(float)
-        #META DATA OF static_df_float: width, height, class, minXSpeed,
-        #maxXSpeed,meanXSpeed
-        
-        #Step A.3: Find the dynamic features of each vehicle
-        track_df = all_track_df[all_track_df["id"]==trackID].reset_index(drop=True)
-        # on the upper half of the video, the speed and acceleration is negative 
-        # because it uses universal positioning
-        # we need to convert it to the otherway around
-        if drivingDirection==1:
-            track_df["xVelocity"]=-track_df["xVelocity"]
-            track_df["xAcceleration"]=-track_df["xAcceleration"]
-            track_df["precedingXVelocity"]=-track_df["precedingXVelocity"]
-        
-        # loop through each line in the track data
-        for t in range(0,len(track_df.index)-1,recordMeta_df["frameRate"][0]):  #loop by each second
-            #print('currently looking at line:' + str(t))
-
-            #################################################################            
-            # collect all the dynamic vehicle data (e.g. position, speed, etc)
-            dynamic_df_track = np.array(track_df.iloc[t,dynamic_col_to_use])
-            # META DATA OF dynamic_df_track: XSpeed, Distance Headway,
-            #Time Headway, Time to Collision, Preceeding XSpeed
-            frameID = dynamic_df_track[0]
-            laneID = dynamic_df_track[-1]
-            
-            #Step A.4: Find traffic-related variables: Density and traffic mean speed
-            if drivingDirection==1:
-                traffic_density = len(all_track_df[(all_track_df["frame"]==frameID) & (all_track_df["laneId"] < NumLane+2)]) / (L*NumLane)
-            else: traffic_density = len(all_track_df[(all_track_df["frame"]==frameID) & (all_track_df["laneId"] > NumLane+1)]) / (L*NumLane)
-            
-            if drivingDirection==1:
-                traffic_speed = -np.mean(all_track_df.loc[(all_track_df["frame"]==frameID) & (all_track_df["laneId"] < NumLane+2),"xVelocity"])
-            else: traffic_speed = np.mean(all_track_df.loc[(all_track_df["frame"]==frameID) & (all_track_df["laneId"] > NumLane+1),"xVelocity"])
-            
-            
-            #Step A.5: Now look at the all_track_df data to find the location 
-            #and speed of surrounding vehicles
-            #for each vehicle we keep [x_location,speed]
-            
-            if track_df["leftPrecedingId"][t]!=0:
-                leftPreceding_df = np.array(all_track_df.loc[(all_track_df["id"] == track_df["leftPrecedingId"][t]) & (all_track_df["frame"] == track_df["frame"][t])].values[0][nearby_index])
-                leftPreceding_df[0] = np.abs(leftPreceding_df[0]-track_df["x"][t])
-                leftPreceding_df[1]= np.abs(leftPreceding_df[1])
-            else: leftPreceding_df = np.array([0,0])
-
-            if track_df["leftFollowingId"][t]!=0:
-                leftFollowing_df = np.array(all_track_df.loc[(all_track_df["id"] == track_df["leftFollowingId"][t]) & (all_track_df["frame"] == track_df["frame"][t])].values[0][nearby_index])
-                leftFollowing_df[0] = np.abs(leftFollowing_df[0]-track_df["x"][t])
-                leftFollowing_df[1] = np.abs(leftFollowing_df[1])
-            else: leftFollowing_df = np.array([0,0])
-
-            if track_df["leftAlongsideId"][t]!=0:
-                leftAlongside_df = np.array(all_track_df.loc[(all_track_df["id"] == track_df["leftAlongsideId"][t]) & (all_track_df["frame"] == track_df["frame"][t])].values[0][nearby_index])
-                leftAlongside_df[0] = np.abs(leftAlongside_df[0]-track_df["x"][t])
-                leftAlongside_df[1] = np.abs(leftAlongside_df[1])
-            else: leftAlongside_df = np.array([0,0])
-            
-
-            if track_df["rightPrecedingId"][t]!=0:
-                rightPreceding_df = np.array(all_track_df.loc[(all_track_df["id"] == track_df["rightPrecedingId"][t]) & (all_track_df["frame"] == track_df["frame"][t])].values[0][nearby_index])
-                rightPreceding_df[0] = np.abs(rightPreceding_df[0]-track_df["x"][t])
-                rightPreceding_df[1] = np.abs(rightPreceding_df[1])
-            else: rightPreceding_df = np.array([0,0])
-
-            if track_df["rightAlongsideId"][t]!=0:
-                rightAlongside_df = np.array(all_track_df.loc[(all_track_df["id"] == track_df["rightAlongsideId"][t]) & (all_track_df["frame"] == track_df["frame"][t])].values[0][nearby_index])
-                rightAlongside_df[0] = np.abs(rightAlongside_df[0]-track_df["x"][t]) 
-                rightAlongside_df[1] = np.abs(rightAlongside_df[1])
-            else: rightAlongside_df = np.array([0,0])
-
-            if track_df["rightFollowingId"][t]!=0:
-                rightFollowing_df = np.array(all_track_df.loc[(all_track_df["id"] == track_df["rightFollowingId"][t]) & (all_track_df["frame"] == track_df["frame"][t])].values[0][nearby_index])
-                rightFollowing_df[0] = np.abs(rightFollowing_df[0]-track_df["x"][t])
-                rightFollowing_df[1] = np.abs(rightFollowing_df[1])
-            else: rightFollowing_df = np.array([0,0])
-
-            #Step A.6: Now combine all the data together
-        
-            #The output of the car-following model is the acceleration
-            Acceleration = np.array(track_df.loc[t+1,"xAcceleration"])
-            # Combine the whole line of data
-            line_df = np.hstack([uniqueID,frameID,drivingDirection,time_hour,static_df_track,dynamic_df_track[1:-1],leftPreceding_df,leftAlongside_df,leftFollowing_df,rightPreceding_df,rightAlongside_df,rightFollowing_df,traffic_density,traffic_speed,laneID,Acceleration])
+        first = np.searchsorted(ids, tracksMeta_df["id"][l], side='left')
+        last = np.searchsorted(ids, tracksMeta_df["id"][l], side='right')
+        t = np.arange(first, last-target_horizon, stride)
+        rows.append(t)
+        vehicles.append(np.full(len(t), l))
+    if len(rows) == 0:
+        return iter(()), uniqueID
+    rows = np.concatenate(rows)
+    vehicles = np.concatenate(vehicles)
+    # unique ID of each selected vehicle, in the order of tracksMeta
+    selected = np.unique(vehicles)
+    vehicle_uid = np.zeros(len(tracksMeta_df.index))
+    vehicle_uid[selected] = uniqueID + np.arange(len(selected))
+
+    # static data of the vehicles (e.g. vehicle length, class, etc)
+    static_df = np.array(tracksMeta_df.iloc[:,static_col_to_use])
+    # convert categorical to binary variable (e.g Car vs Truck)
+    static_df[:,2] = np.where(static_df[:,2]=='Car',0,1)
+    static_df = static_df.astype(float)
+    drivingDirection = tracksMeta_df["drivingDirection"].values
+
+    track_values = all_track_df.values.astype(float)
+    x = all_track_df["x"].values
+    xAcceleration = all_track_df["xAcceleration"].values
+    nearby_ids = all_track_df[nearby_id_cols].values
+
+    def blocks():
+        for start in range(0,len(rows),chunk_rows):
+            r = rows[start:start+chunk_rows]
+            v = vehicles[start:start+chunk_rows]
+            direction = drivingDirection[v]
+            upper = direction == 1
+            # on the upper half of the video, the speed and acceleration is negative
+            # because it uses universal positioning, so we convert it to the otherway around
+            sign = np.where(upper,-1.0,1.0)
+            frameID = frames[r]
+
+            # Step A.3: dynamic features: XSpeed, Distance Headway, Time Headway, Time to Collision, Preceeding XSpeed
+            dynamic = track_values[r][:,dynamic_col_to_use[1:-1]]
+            dynamic[:,0] *= sign
+            dynamic[:,-1] *= sign
+            laneID = track_values[r,dynamic_col_to_use[-1]]
+
+            # Step A.4: traffic-related variables: Density and traffic mean speed in the driving direction
+            count = np.where(upper,count_upper[frameID],count_lower[frameID])
+            traffic_density = count / (L*np.where(upper,geometry['NumLaneUpper'],geometry['NumLaneLower']))
+            traffic_speed = np.where(upper,-speed_upper[frameID],speed_lower[frameID]) / count
+
+            # Step A.5: relative position and speed of the surrounding vehicles (0,0 if there is none)
+            nearby = np.zeros((len(r),2*len(nearby_id_cols)))
+            for k in range(len(nearby_id_cols)):
+                found = find_rows(ids, frames, nearby_ids[r,k], frameID)
+                has = found >= 0
+                nearby_df = track_values[found[has]][:,nearby_index]
+                nearby[has,2*k] = np.abs(nearby_df[:,0]-x[r[has]])
+                nearby[has,2*k+1] = np.abs(nearby_df[:,1])
+
+            # Step A.6: the output of the car-following model is the acceleration target_horizon frames later
+            Acceleration = xAcceleration[r+target_horizon] * sign
             # METADATA OF THE WHOLE DATAFRAME:
             # uniqueID,frameID,drivingDirection,time_hour,width, height, class, minXSpeed,
             #maxXSpeed,meanXSpeed,XSpeed,Distance Headway, Time Headway, Time to Collision, Preceeding XSpeed,
-            #LaneID,leftPreceding_df,leftAlongside_df,leftFollowing_df,
-            #rightPreceding_df,rightAlongside_df (each as Xpos and Xspeed), Output (Acceleration)
-            
-            
-            Car_following_df.append(line_df)
-        
-        uniqueID += 1
-        print(len(Car_following_df))
-        
-    
-#import pickle
-#with open('Car_following_df.pickle', 'wb') as f:
-#    pickle.dump(Car_following_df_2d, f)
-#save csv file as well
-Car_following_df_2d = np.vstack(Car_following_df)        
-#np.savetxt("Car_following_df_AM.csv", Car_following_df_2d,fmt='%6.2f', delimiter=",")    
+            #leftPreceding_df,leftAlongside_df,leftFollowing_df,
+            #rightPreceding_df,rightAlongside_df,rightFollowing_df (each as Xpos and Xspeed),
+            #traffic_density,traffic_speed,LaneID, Output (Acceleration)
+            yield np.column_stack([vehicle_uid[v],frameID,direction,np.full(len(r),time_hour),static_df[v],dynamic,
+                                   nearby,traffic_density,traffic_speed,laneID,Acceleration])
 
-np.savetxt("Car_following_df_raw.csv", Car_following_df_2d,fmt='%5.2f', delimiter=",")   
+    return blocks(), uniqueID + len(selected)
 
-"""
-STAGE B: next, we process the data such that data from previous time steps are also included in the features
-"""
-print("Stage B")
 
-static_index = [2,3,4,5,6,7,8,9]
+def stage_b_lines(Veh_df, lag=1):
+    '''
+    Stage B for one vehicle: static data, the dynamic data of 3 lines lag apart,
+    then whether the lane has changed and the acceleration of the line 3*lag later
+    '''
+    l = np.arange(0,len(Veh_df)-3*lag)
+    dynamic = slice(static_index[-1]+1,-2)
+    return np.hstack([Veh_df[l][:,static_index],Veh_df[l,dynamic],Veh_df[l+lag,dynamic],Veh_df[l+2*lag,dynamic],
+                      np.abs(Veh_df[l+3*lag,-2]-Veh_df[l,-2])[:,None],Veh_df[l+3*lag,-1][:,None]])
 
-list_veh = np.unique(Car_following_df_2d[:,0])
-DL_df = []
-#loop through each vehicle in the processed data
-for v in list_veh:
-    Veh_df = Car_following_df_2d[Car_following_df_2d[:,0]==v,:]  #take out the vehicle data to analyse
-    
-   
-    for l in range(0,len(Veh_df)-3):
-        #take static data only
-        static_df = Veh_df[l,static_index]
-        #now look at 03 time steps ahead and take all the dynamic information
-        dynamic1 = Veh_df[l,static_index[-1]+1:-2]
-        dynamic2 = Veh_df[l+1,static_index[-1]+1:-2]
-        dynamic3 = Veh_df[l+2,static_index[-1]+1:-2]
-        #combine all the static and dynamic data
-        line_df = np.hstack([static_df,dynamic1,dynamic2,dynamic3,np.abs(Veh_df[l+3,-2]-Veh_df[l,-2]),Veh_df[l+3,-1]])
-        #write to a large list
-        DL_df.append(line_df)
-        
-    print(v)
-#convert the list into a 2D dataframe
-DL_df_2D = np.vstack(DL_df)
-#write to data file
-np.savetxt("Car_following_df.csv", DL_df_2D,fmt='%5.2f', delimiter=",")   
-                     
-                     
-                
-        
 
+static_index = [2,3,4,5,6,7,8,9]
 
 
+def vehicle_lines(blocks):
+    '''
+    Regroups blocks of Stage A lines into the lines of one vehicle at a time (the lines of
+    a vehicle are next to each other, but may be split between two blocks)
+    '''
+    tail = None
+    for block in blocks:
+        if len(block) == 0:
+            continue
+        if tail is not None:
+            block = np.vstack([tail, block])
+        starts = np.flatnonzero(np.r_[True, block[1:,0] != block[:-1,0]])
+        for s, e in zip(starts[:-1], starts[1:]):
+            yield block[s:e]
+        # the last vehicle may go on in the next block
+        tail = block[starts[-1]:]
+    if tail is not None:
+        yield tail
+
+
+def stage_a(data_path, location=None, frame_stride=None, target_horizon=1, chunk_rows=100000):
+    '''
+    Stage A over the recordings of the given location(s), one vehicle at a time:
+    yields (recording, locationId, frameRate, Stage A lines of the vehicle)
+    '''
+    uniqueID = 0 #give an unique ID to the vehicle being processed
+    #the catalog gives the Record Metadata of the recordings on our location(s) of interests
+    #(all of them by default), so the other recordings are not opened at all
+    catalog = load_catalog(data_path)
+    for _, recordMeta in catalog.recordings(location=location).iterrows():
+        i = recordMeta["recording"]
+        record_name, tracksMeta_name, track_name = recording_files(data_path, i)
+        recordMeta_df = recordMeta.to_frame().T.reset_index(drop=True)
+        frameRate = recordMeta_df["frameRate"][0]
+
+        #Read the tracksMeta data (summary about each vehicle) and the track data (individual vehicle data)
+        #all the tracks are needed here, for the traffic density/speed and the surrounding vehicles
+        tracksMeta_df = pd.read_csv(tracksMeta_name)
+        all_track_df = pd.read_csv(track_name)
+        blocks, uniqueID = extract_recording(recordMeta_df, tracksMeta_df, all_track_df, uniqueID, frame_stride, target_horizon, chunk_rows)
+        for lines in vehicle_lines(blocks):
+            yield i, recordMeta["locationId"], frameRate, lines
+
+
+def stage_b(vehicles, frame_stride=None):
+    '''
+    Stage B of each vehicle of stage_a: yields (recording, locationId, Stage A lines, Stage B lines)
+    '''
+    for recording, locationId, frameRate, lines in vehicles:
+        # the 3 time steps are kept 1 second apart whatever the sampling of Stage A
+        lag = 1 if frame_stride is None else max(int(round(frameRate/frame_stride)),1)
+        yield recording, locationId, lines, stage_b_lines(lines, lag)
+
+
+class AppendingWriter:
+    '''
+    Appends arrays to a csv file, chunk_rows lines at a time. The file is flushed at every
+    write, so the lines written so far can be read while the run goes on
+    '''
+    def __init__(self, path, fmt='%5.2f', chunk_rows=100000):
+        self.file = open(path, 'w')
+        self.fmt = fmt
+        self.chunk_rows = chunk_rows
+        self.buffer = []
+        self.n_buffered = 0
+        self.n_written = 0
+
+    def append(self, lines):
+        self.buffer.append(lines)
+        self.n_buffered += len(lines)
+        if self.n_buffered >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if self.n_buffered > 0:
+            np.savetxt(self.file, np.vstack(self.buffer), fmt=self.fmt, delimiter=",")
+            self.file.flush()
+            self.n_written += self.n_buffered
+        self.buffer = []
+        self.n_buffered = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def extract(data_path, output_path='', location=None, frame_stride=None, target_horizon=1, chunk_rows=100000):
+    '''
+    Stage A and Stage B over the recordings of data_path (highD data folder) on the given
+    location(s), all of them by default. Writes Car_following_df_raw.csv, Car_following_df.csv
+    and Car_following_groups.csv to output_path, and returns the number of lines of each stage
+
+    The lines of one vehicle go through Stage A, Stage B and the writers before the next
+    vehicle is processed: only the tracks of the current recording, one block of Stage A
+    lines and the buffers of the writers (at most chunk_rows lines each) are kept in memory
+    '''
+    counts = {'vehicles': 0, 'stage_a': 0, 'stage_b': 0}
+    #Car_following_groups.csv gives the uniqueID, recording and location of each line of Car_following_df.csv,
+    #so that models can be evaluated by vehicle, recording or location
+    writers = [AppendingWriter(output_path + "Car_following_df_raw.csv", '%5.2f', chunk_rows),
+               AppendingWriter(output_path + "Car_following_df.csv", '%5.2f', chunk_rows),
+               AppendingWriter(output_path + "Car_following_groups.csv", '%d', chunk_rows)]
+    raw_writer, DL_writer, groups_writer = writers
+    current = None
+    try:
+        # STAGE A: First, we process data into a line-by-line dataset of all related information
+        # STAGE B: next, we process the data such that data from previous time steps are also included in the features
+        vehicles = stage_a(data_path, location, frame_stride, target_horizon, chunk_rows)
+        for recording, locationId, lines, DL_lines in stage_b(vehicles, frame_stride):
+            if recording != current:
+                if current is not None:
+                    print("%(vehicles)d vehicles, Stage A: %(stage_a)d lines, Stage B: %(stage_b)d lines" % counts)
+                print("currently at file: " + str(recording))
+                current = recording
+            raw_writer.append(lines)
+            DL_writer.append(DL_lines)
+            groups_writer.append(np.tile([int(lines[0,0]), recording, locationId], (len(DL_lines),1)))
+            counts['vehicles'] += 1
+            counts['stage_a'] += len(lines)
+            counts['stage_b'] += len(DL_lines)
+    finally:
+        for writer in writers:
+            writer.close()
+    print("%(vehicles)d vehicles, Stage A: %(stage_a)d lines, Stage B: %(stage_b)d lines" % counts)
+    return counts
+
+
+if __name__ == '__main__':
+    import sys
+    # usage: python -m Utils.A01_process_data [highD data folder] [output folder]
+    extract(sys.argv[1] if len(sys.argv) > 1 else prject_path + "data/", sys.argv[2] if len(sys.argv) > 2 else '',
+            location=Location, frame_stride=frame_stride, target_horizon=target_horizon, chunk_rows=chunk_rows)
@@ -28,97 +28,114 @@ the average speed. The purpose of this file is to allow to filter tracks e.g. by
 - Tracks (XX_tracks.csv)
 This file contains all time dependent values for each track. Information such as current velocities, viewing ranges
 and information about surrounding vehicles are included.
+
+Run it from the root of the repository:
+    python -m Utils.A02_data_distributions [highD data folder] [Veh_features.csv]
+or call vehicle_features(data_path) from another module.
     
 """
 
 #import pickle
 import pandas as pd
 import numpy as np
-#import os
+import os
 
+from Utils.A04_dataset_catalog import find_recordings, recording_files
 
 
 prject_path = '~/Documents/Research/highD/'
 #prject_path = 'C:/Research/highD/'
 following_ratio_threshold = 0.3
-unique_count=1
 #Location = 2  #focus only on the location number 2 in the dataset
-Veh_features = []
-for i in range(1,60):
-    print("currently at file: " + str(i))
-    #file names:
-    if i <10:
-        record_name = prject_path + "data/0" + str(i) + "_recordingMeta.csv"
-        tracksMeta_name = prject_path + "./data/0" + str(i) + "_tracksMeta.csv"
-        track_name = prject_path + "./data/0" + str(i) + "_tracks.csv"
-    else:
-        record_name = prject_path + "./data/" + str(i) + "_recordingMeta.csv"
-        tracksMeta_name = prject_path + "./data/" + str(i) + "_tracksMeta.csv"
-        track_name = prject_path + "./data/" + str(i) + "_tracks.csv"
-
-    #Step 1: Read the Record Metadata
-    recordMeta_df = pd.read_csv(record_name)
-
-    #only take data if it's on our location of interests
-    #if recordMeta_df["locationId"][0] != Location:
-    #    continue
-
-    timestamp =  pd.to_datetime(recordMeta_df["startTime"][0],format='%H:%M')
-    time_hour =np.array(timestamp.hour+timestamp.minute/60)
-    
-    #Step 2: Read the tracksMeta data (summary about each vehicle)
-    tracksMeta_df = pd.read_csv(tracksMeta_name)
-    #Read the track data (individual vehicle data)
-    all_track_df = pd.read_csv(track_name)
-    #loop through the tracksMeta line-by-line, each line is a vehicle
-    for l in range(0,len(tracksMeta_df.index)):
-        trackID = tracksMeta_df["id"][l]
-
-        #Step 3: Find the dynamic features of each vehicle
-        track_df = all_track_df[all_track_df["id"]==trackID].reset_index(drop=True)
-
-        #following ratio: the amount of time  the vehicle is following some other vehicle
-        if len(track_df[track_df["precedingId"]!=0])/len(track_df) > following_ratio_threshold:
-            continue
-        
-        
-        
-        startlane = track_df["laneId"][0]
-
-        drivingDirection = tracksMeta_df["drivingDirection"][l]
-
-        if drivingDirection==1:
-            track_df["xVelocity"]=-track_df["xVelocity"]
-            track_df["xAcceleration"]=-track_df["xAcceleration"]
-            track_df["precedingXVelocity"]=-track_df["precedingXVelocity"]
-        
-        startSpeed = track_df["xVelocity"][0]
-        time_start = time_hour + tracksMeta_df["initialFrame"][l]/(recordMeta_df["frameRate"][0]*3600)
-
-        length = tracksMeta_df["width"][l]      
-        width = tracksMeta_df["height"][l] 
-        
-        if tracksMeta_df["class"][l]=='Car':
-            veh_class=0
-        else: veh_class=1
-        
-        #Take the time where the vehicle is actually the leading vehicle
-        lead_df = track_df[track_df["precedingId"]==0]
-        
-        maxSpeed = np.max(lead_df["xVelocity"])
-        maxAcceleration = np.max(lead_df["xAcceleration"])
-        
-        # Combine the whole line of data
-        line_df = np.hstack([unique_count,recordMeta_df["locationId"][0],drivingDirection,time_start,startlane,startSpeed,length,width,veh_class,maxSpeed,maxAcceleration])
-            
-        unique_count+=1    
-        Veh_features.append(line_df)
-            
-        print(len(Veh_features))
-    
-#save pickle file
-#with open('Car_following_df.pickle', 'wb') as f:
-#    pickle.dump(Car_following_df, f)
-#save csv file as well
-Veh_features = np.vstack(Veh_features)        
-np.savetxt("Veh_features.csv", Veh_features,fmt='%10.5f', delimiter=",")    
+#columns of each line of Veh_features.csv (written as its header, as in data/Veh_features.csv)
+COLUMNS = ['ID','Location','Direction','TimeStart','LaneStart','IniSpeed','Length','Width','Is_truck','MaxSpeed','MaxAcceleration']
+
+
+def vehicle_features(data_path, recordings=None, following_ratio_threshold=0.3):
+    '''
+    One line per vehicle of the given recordings (all the recordings of data_path by default)
+    '''
+    unique_count=1
+    Veh_features = []
+    data_path = os.path.expanduser(data_path)
+    if recordings is None:
+        recordings = find_recordings(data_path)
+    for i in recordings:
+        print("currently at file: " + str(i))
+        #file names:
+        record_name, tracksMeta_name, track_name = recording_files(data_path, i)
+
+        #Step 1: Read the Record Metadata
+        recordMeta_df = pd.read_csv(record_name)
+
+        #only take data if it's on our location of interests
+        #if recordMeta_df["locationId"][0] != Location:
+        #    continue
+
+        timestamp =  pd.to_datetime(recordMeta_df["startTime"][0],format='%H:%M')
+        time_hour =np.array(timestamp.hour+timestamp.minute/60)
+
+        #Step 2: Read the tracksMeta data (summary about each vehicle)
+        tracksMeta_df = pd.read_csv(tracksMeta_name)
+        #Read the track data (individual vehicle data)
+        all_track_df = pd.read_csv(track_name)
+        #loop through the tracksMeta line-by-line, each line is a vehicle
+        for l in range(0,len(tracksMeta_df.index)):
+            trackID = tracksMeta_df["id"][l]
+
+            #Step 3: Find the dynamic features of each vehicle
+            track_df = all_track_df[all_track_df["id"]==trackID].reset_index(drop=True)
+
+            #following ratio: the amount of time  the vehicle is following some other vehicle
+            if len(track_df[track_df["precedingId"]!=0])/len(track_df) > following_ratio_threshold:
+                continue
+
+
+
+            startlane = track_df["laneId"][0]
+
+            drivingDirection = tracksMeta_df["drivingDirection"][l]
+
+            if drivingDirection==1:
+                track_df["xVelocity"]=-track_df["xVelocity"]
+                track_df["xAcceleration"]=-track_df["xAcceleration"]
+                track_df["precedingXVelocity"]=-track_df["precedingXVelocity"]
+
+            startSpeed = track_df["xVelocity"][0]
+            time_start = time_hour + tracksMeta_df["initialFrame"][l]/(recordMeta_df["frameRate"][0]*3600)
+
+            length = tracksMeta_df["width"][l]      
+            width = tracksMeta_df["height"][l] 
+
+            if tracksMeta_df["class"][l]=='Car':
+                veh_class=0
+            else: veh_class=1
+
+            #Take the time where the vehicle is actually the leading vehicle
+            lead_df = track_df[track_df["precedingId"]==0]
+
+            maxSpeed = np.max(lead_df["xVelocity"])
+            maxAcceleration = np.max(lead_df["xAcceleration"])
+
+            # Combine the whole line of data
+            line_df = np.hstack([unique_count,recordMeta_df["locationId"][0],drivingDirection,time_start,startlane,startSpeed,length,width,veh_class,maxSpeed,maxAcceleration])
+
+            unique_count+=1    
+            Veh_features.append(line_df)
+
+            print(len(Veh_features))
+
+    return np.vstack(Veh_features)
+
+
+if __name__ == '__main__':
+    import sys
+    # usage: python -m Utils.A02_data_distributions [highD data folder] [Veh_features.csv]
+    Veh_features = vehicle_features(sys.argv[1] if len(sys.argv) > 1 else prject_path + "data/",
+                                    following_ratio_threshold=following_ratio_threshold)
+    #save pickle file
+    #with open('Car_following_df.pickle', 'wb') as f:
+    #    pickle.dump(Car_following_df, f)
+    #save csv file as well
+    np.savetxt(sys.argv[2] if len(sys.argv) > 2 else "Veh_features.csv", Veh_features,fmt='%10.5f', delimiter=",",
+               header=",".join(COLUMNS), comments='')
@@ -0,0 +1,181 @@
+"""
+Catalog of the highD recordings and tracks
+
+The catalog is built once from all the XX_recordingMeta.csv and XX_tracksMeta.csv
+files, plus one pass over the id column of each XX_tracks.csv to find where the
+lines of each track start and end in the file. It is saved next to the data as:
+
+    catalog_recordings.csv: one line per recording (location, start time, frameRate,
+        lane markings, numbers of vehicles, ...)
+    catalog_tracks.csv: one line per track (class, drivingDirection, frames, speeds,
+        ..., first and last line in the tracks file and the matching byte range)
+
+Queries are answered from the catalog only, e.g.
+
+    catalog = load_catalog(prject_path + 'data/')
+    selection = catalog.query(location=2, time_of_day='morning', classes=['Car'], min_seconds=10)
+    tracks_df = catalog.read_tracks(selection)
+
+and read_tracks only reads the bytes of the selected tracks (neighbouring tracks
+are read in one go).
+"""
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+RECORDINGS_FILE = 'catalog_recordings.csv'
+TRACKS_FILE = 'catalog_tracks.csv'
+
+#start hour of the periods accepted by query(time_of_day=...)
+TIME_OF_DAY = {'morning': (0, 12), 'afternoon': (12, 17), 'evening': (17, 24)}
+
+
+def recording_files(data_path, recording):
+    '''
+    File names of a recording, e.g. 01_recordingMeta.csv, 01_tracksMeta.csv, 01_tracks.csv
+    '''
+    prefix = os.path.join(data_path, '%02d_' % recording)
+    return prefix + 'recordingMeta.csv', prefix + 'tracksMeta.csv', prefix + 'tracks.csv'
+
+
+def find_recordings(data_path):
+    return sorted(int(f[:2]) for f in os.listdir(data_path) if f.endswith('_recordingMeta.csv') and f[:2].isdigit())
+
+
+def track_byte_ranges(track_name):
+    '''
+    First/last line and first/end byte of each track in a tracks file (sorted by id)
+    '''
+    with open(track_name, 'rb') as f:
+        buffer = np.frombuffer(f.read(), dtype=np.uint8)
+    line_end = np.flatnonzero(buffer == ord('\n'))
+    if len(line_end) == 0 or line_end[-1] != len(buffer) - 1:
+        line_end = np.append(line_end, len(buffer))  # no newline after the last line
+    ids = pd.read_csv(track_name, usecols=['id'])['id'].values
+    if np.any(np.diff(ids) < 0):
+        raise ValueError(track_name + ' is not sorted by id')
+    track_ids, first_line = np.unique(ids, return_index=True)
+    last_line = np.r_[first_line[1:], len(ids)] - 1
+    # line k of the data is after the header line, so it starts after line_end[k]
+    return pd.DataFrame({'id': track_ids, 'firstLine': first_line, 'lastLine': last_line,
+                         'firstByte': line_end[first_line] + 1, 'endByte': line_end[last_line + 1] + 1,
+                         'headerBytes': line_end[0] + 1})
+
+
+def build_catalog(data_path, save=True, verbose=True):
+    '''
+    Reads all the metadata files (and the id column of the tracks files) once
+    '''
+    recordings = []
+    tracks = []
+    for recording in find_recordings(data_path):
+        if verbose:
+            print('cataloguing recording ' + str(recording))
+        record_name, tracksMeta_name, track_name = recording_files(data_path, recording)
+        recordMeta_df = pd.read_csv(record_name)
+        timestamp = pd.to_datetime(recordMeta_df['startTime'][0], format='%H:%M')
+        recordMeta_df['recording'] = recording
+        recordMeta_df['time_hour'] = timestamp.hour + timestamp.minute / 60
+        recordMeta_df['tracksBytes'] = os.path.getsize(track_name)
+        recordings.append(recordMeta_df)
+
+        tracksMeta_df = pd.read_csv(tracksMeta_name)
+        tracksMeta_df = tracksMeta_df.merge(track_byte_ranges(track_name), on='id', how='left')
+        tracksMeta_df.insert(0, 'recording', recording)
+        tracksMeta_df['locationId'] = recordMeta_df['locationId'][0]
+        tracksMeta_df['time_hour'] = recordMeta_df['time_hour'][0]
+        tracksMeta_df['seconds'] = tracksMeta_df['numFrames'] / recordMeta_df['frameRate'][0]
+        tracks.append(tracksMeta_df)
+    catalog = Catalog(data_path, pd.concat(recordings, ignore_index=True), pd.concat(tracks, ignore_index=True))
+    if save:
+        catalog.save()
+    return catalog
+
+
+def load_catalog(data_path, rebuild=False):
+    '''
+    Loads the saved catalog, building it first if it is missing or older than the data files
+    '''
+    recordings_name = os.path.join(data_path, RECORDINGS_FILE)
+    tracks_name = os.path.join(data_path, TRACKS_FILE)
+    if not rebuild and os.path.exists(recordings_name) and os.path.exists(tracks_name):
+        built = min(os.path.getmtime(recordings_name), os.path.getmtime(tracks_name))
+        newest = max(os.path.getmtime(name) for recording in find_recordings(data_path)
+                     for name in recording_files(data_path, recording))
+        if built >= newest:
+            return Catalog(data_path, pd.read_csv(recordings_name), pd.read_csv(tracks_name))
+    return build_catalog(data_path)
+
+
+class Catalog:
+    def __init__(self, data_path, recordings, tracks):
+        self.data_path = data_path
+        self.recordings_df = recordings
+        self.tracks_df = tracks
+
+    def save(self):
+        self.recordings_df.to_csv(os.path.join(self.data_path, RECORDINGS_FILE), index=False)
+        self.tracks_df.to_csv(os.path.join(self.data_path, TRACKS_FILE), index=False)
+
+    def recordings(self, location=None, time_of_day=None, hours=None):
+        '''
+        Metadata of the recordings on a location and/or starting within a time period
+        '''
+        keep = np.ones(len(self.recordings_df), dtype=bool)
+        if location is not None:
+            keep &= np.isin(self.recordings_df['locationId'], np.atleast_1d(location))
+        if time_of_day is not None:
+            hours = TIME_OF_DAY[time_of_day]
+        if hours is not None:
+            keep &= (self.recordings_df['time_hour'] >= hours[0]) & (self.recordings_df['time_hour'] < hours[1])
+        return self.recordings_df[keep]
+
+    def query(self, location=None, time_of_day=None, hours=None, classes=None, min_seconds=None,
+              drivingDirection=None, recordings=None):
+        '''
+        Tracks matching all the given conditions, e.g. location 2, morning, cars only, >=10 s:
+            catalog.query(location=2, time_of_day='morning', classes=['Car'], min_seconds=10)
+        '''
+        selected = self.recordings(location, time_of_day, hours)['recording']
+        if recordings is not None:
+            selected = selected[np.isin(selected, np.atleast_1d(recordings))]
+        keep = np.isin(self.tracks_df['recording'], selected)
+        if classes is not None:
+            keep &= np.isin(self.tracks_df['class'], np.atleast_1d(classes))
+        if min_seconds is not None:
+            keep &= self.tracks_df['seconds'] >= min_seconds
+        if drivingDirection is not None:
+            keep &= self.tracks_df['drivingDirection'] == drivingDirection
+        return self.tracks_df[keep]
+
+    def read_tracks(self, selection, usecols=None):
+        '''
+        Reads the lines of the selected tracks only (one seek and read per run of
+        neighbouring tracks), with a 'recording' column added
+        '''
+        frames = []
+        for recording, tracks in selection.groupby('recording', sort=True):
+            _, _, track_name = recording_files(self.data_path, recording)
+            tracks = tracks.sort_values('firstByte')
+            # neighbouring tracks in the file are read together
+            new_run = np.r_[True, tracks['firstByte'].values[1:] != tracks['endByte'].values[:-1]]
+            run = np.cumsum(new_run)
+            with open(track_name, 'rb') as f:
+                header = f.read(int(tracks['headerBytes'].iloc[0]))
+                for _, run_tracks in tracks.groupby(run):
+                    start = int(run_tracks['firstByte'].iloc[0])
+                    f.seek(start)
+                    data = f.read(int(run_tracks['endByte'].iloc[-1]) - start)
+                    frames.append(pd.read_csv(io.BytesIO(header + data), usecols=usecols))
+                    frames[-1].insert(0, 'recording', recording)
+        if len(frames) == 0:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def bytes_to_read(self, selection):
+        '''
+        Number of bytes read_tracks would read, to compare with the size of the whole tracks files
+        '''
+        return int((selection['endByte'] - selection['firstByte']).sum())
@@ -0,0 +1,288 @@
+"""
+Index of traffic events in the highD recordings
+
+Each XX_tracks.csv is read once and all its lines are checked at once
+(vectorized over the whole recording) for:
+
+    lane_change:   the laneId of a track changes; severity: lateral speed (m/s)
+    cut_in:        a new preceding vehicle appears in the same lane with a time
+                   headway below cut_in_thw; severity: 1 / time headway (1/s)
+    hard_braking:  deceleration of at least hard_braking m/s2 during at least
+                   min_seconds; severity: peak deceleration (m/s2)
+    low_ttc:       0 < time to collision < low_ttc during at least min_seconds;
+                   severity: 1 / smallest time to collision (1/s)
+    stop_and_go:   a vehicle that drove faster than go_speed slows down below
+                   stop_speed (it enters a stop-and-go wave); severity: speed drop (m/s)
+
+One line per event (recording, track, type, first and last frame, severity, and
+the location, class and driving direction of the track) is stored in an SQLite
+file next to the data, indexed on (type, severity) and (recording, track):
+
+    events = build_event_index(prject_path + 'data/')
+    rare = events.query(types=['cut_in', 'low_ttc'], location=2, min_severity=0.5)
+    training = events.sample(500, types=['lane_change', 'cut_in', 'hard_braking'])
+    lines = events.read_frames(load_catalog(prject_path + 'data/'), training, margin_seconds=2)
+
+Recordings already in the index (same file, same thresholds) are not scanned again.
+"""
+import json
+import os
+import sqlite3
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+from Utils.A04_dataset_catalog import load_catalog, recording_files
+
+INDEX_FILE = 'event_index.sqlite'
+EVENT_TYPES = ('lane_change', 'cut_in', 'hard_braking', 'low_ttc', 'stop_and_go')
+COLUMNS = ['frame', 'id', 'xVelocity', 'yVelocity', 'xAcceleration', 'thw', 'ttc', 'precedingId', 'laneId']
+
+#default thresholds of the detectors
+THRESHOLDS = {'cut_in_thw': 1.0, 'hard_braking': 3.0, 'low_ttc': 3.0, 'min_seconds': 0.2,
+              'stop_speed': 5.0, 'go_speed': 15.0}
+
+
+def _runs(flag, new_track, min_length=1):
+    '''
+    First and last line of the runs of True in flag that stay in one track
+    '''
+    previous = np.r_[False, flag[:-1]] & ~new_track
+    following = np.r_[flag[1:], False] & ~np.r_[new_track[1:], True]
+    starts = np.flatnonzero(flag & ~previous)
+    ends = np.flatnonzero(flag & ~following)
+    keep = ends - starts + 1 >= min_length
+    return starts[keep], ends[keep]
+
+
+def _run_reduce(ufunc, values, starts, ends):
+    # ufunc over values[start:end+1] of every run
+    padded = np.r_[values, values[-1:]]
+    return ufunc.reduceat(padded, np.column_stack([starts, ends + 1]).ravel())[::2]
+
+
+def detect_events(tracks_df, direction, frame_rate, thresholds=None):
+    '''
+    Events of one recording (tracks_df: lines of XX_tracks.csv sorted by id and frame,
+    direction: drivingDirection of each line). Returns one line per event
+    '''
+    t = dict(THRESHOLDS, **(thresholds or {}))
+    min_length = max(int(round(t['min_seconds'] * frame_rate)), 1)
+    track = tracks_df['id'].values
+    frame = tracks_df['frame'].values
+    new_track = np.r_[True, track[1:] != track[:-1]]
+    #x is positive to the right: the lower lanes (drivingDirection 2) drive forward
+    sign = np.where(direction == 1, -1.0, 1.0)
+    speed = tracks_df['xVelocity'].values * sign
+    acceleration = tracks_df['xAcceleration'].values * sign
+    lane = tracks_df['laneId'].values
+    preceding = tracks_df['precedingId'].values
+    thw = tracks_df['thw'].values
+    ttc = tracks_df['ttc'].values
+
+    events = []
+
+    def add(kind, starts, ends, severity):
+        events.append(pd.DataFrame({'track': track[starts], 'type': kind, 'start_frame': frame[starts],
+                                    'end_frame': frame[ends], 'severity': severity}))
+
+    #Step 1: lane changes, from the last line in the old lane to the first line in the new one
+    change = np.flatnonzero(~new_track & (lane != np.r_[lane[:1], lane[:-1]]))
+    add('lane_change', change - 1, change, np.abs(tracks_df['yVelocity'].values[change]))
+
+    #Step 2: cut-ins, a new leader in the same lane, close to the vehicle
+    cut_in = np.flatnonzero(~new_track & (preceding != np.r_[preceding[:1], preceding[:-1]]) & (preceding != 0)
+                            & (lane == np.r_[lane[:1], lane[:-1]]) & (thw > 0) & (thw < t['cut_in_thw']))
+    add('cut_in', cut_in, cut_in, 1 / thw[cut_in])
+
+    #Step 3: hard braking
+    starts, ends = _runs(acceleration <= -t['hard_braking'], new_track, min_length)
+    add('hard_braking', starts, ends, -_run_reduce(np.minimum, acceleration, starts, ends))
+
+    #Step 4: low time to collision
+    starts, ends = _runs((ttc > 0) & (ttc < t['low_ttc']), new_track, min_length)
+    add('low_ttc', starts, ends, 1 / _run_reduce(np.minimum, ttc, starts, ends))
+
+    #Step 5: stop-and-go, slow runs of vehicles that were faster than go_speed before
+    fastest_before = pd.Series(speed).groupby(track).cummax().values
+    starts, ends = _runs(speed < t['stop_speed'], new_track, min_length)
+    entered = fastest_before[starts] > t['go_speed']
+    starts, ends = starts[entered], ends[entered]
+    add('stop_and_go', starts, ends, fastest_before[starts] - _run_reduce(np.minimum, speed, starts, ends))
+
+    return pd.concat(events, ignore_index=True)
+
+
+def _scan_recording(task):
+    data_path, recording, frame_rate, tracks_meta, thresholds = task
+    _, _, track_name = recording_files(data_path, recording)
+    tracks_df = pd.read_csv(track_name, usecols=COLUMNS).sort_values(['id', 'frame'], kind='mergesort')
+    direction = tracks_meta.set_index('id')['drivingDirection'].reindex(tracks_df['id']).values
+    events = detect_events(tracks_df, direction, frame_rate, thresholds)
+    events = events.merge(tracks_meta[['id', 'class', 'drivingDirection']], left_on='track', right_on='id',
+                          how='left').drop(columns='id')
+    events.insert(0, 'recording', recording)
+    return recording, os.path.getmtime(track_name), events
+
+
+class EventIndex:
+    '''
+    SQLite index of the events (one line per event)
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS events (recording INTEGER, track INTEGER, type TEXT, start_frame INTEGER,
+                end_frame INTEGER, severity REAL, locationId INTEGER, class TEXT, drivingDirection INTEGER);
+            CREATE INDEX IF NOT EXISTS events_type ON events (type, severity);
+            CREATE INDEX IF NOT EXISTS events_track ON events (recording, track);
+            CREATE TABLE IF NOT EXISTS scanned (recording INTEGER PRIMARY KEY, mtime REAL, thresholds TEXT,
+                events INTEGER);
+        ''')
+        self.conn.commit()
+
+    def is_scanned(self, recording, mtime, thresholds):
+        row = self.conn.execute('SELECT mtime, thresholds FROM scanned WHERE recording = ?', (recording,)).fetchone()
+        return row is not None and row[0] == mtime and row[1] == json.dumps(thresholds, sort_keys=True)
+
+    def write(self, recording, mtime, thresholds, events):
+        '''
+        Replaces the events of a recording
+        '''
+        columns = ['recording', 'track', 'type', 'start_frame', 'end_frame', 'severity', 'locationId', 'class',
+                   'drivingDirection']
+        with self.conn:
+            self.conn.execute('DELETE FROM events WHERE recording = ?', (recording,))
+            self.conn.executemany('INSERT INTO events VALUES (?,?,?,?,?,?,?,?,?)',
+                                  events[columns].astype(object).itertuples(index=False, name=None))
+            self.conn.execute('INSERT OR REPLACE INTO scanned VALUES (?,?,?,?)',
+                              (recording, mtime, json.dumps(thresholds, sort_keys=True), len(events)))
+
+    def _where(self, types=None, recordings=None, location=None, classes=None, min_severity=None,
+               drivingDirection=None):
+        conditions, args = [], []
+        for column, values in (('type', types), ('recording', recordings), ('locationId', location),
+                               ('class', classes)):
+            if values is not None:
+                values = [v.item() if isinstance(v, np.generic) else v for v in np.atleast_1d(values)]
+                conditions.append('%s IN (%s)' % (column, ','.join('?' * len(values))))
+                args += values
+        if min_severity is not None:
+            conditions.append('severity >= ?')
+            args.append(float(min_severity))
+        if drivingDirection is not None:
+            conditions.append('drivingDirection = ?')
+            args.append(int(drivingDirection))
+        return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), args
+
+    def query(self, types=None, recordings=None, location=None, classes=None, min_severity=None,
+              drivingDirection=None, limit=None):
+        '''
+        Events matching all the given conditions, the most severe first, e.g.
+            events.query(types='cut_in', location=2, classes='Car', min_severity=1)
+        '''
+        where, args = self._where(types, recordings, location, classes, min_severity, drivingDirection)
+        sql = 'SELECT rowid AS event, * FROM events' + where + ' ORDER BY severity DESC'
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        return pd.read_sql_query(sql, self.conn, params=args)
+
+    def counts(self):
+        return pd.read_sql_query('SELECT type, COUNT(*) AS events, AVG(severity) AS mean_severity FROM events '
+                                 'GROUP BY type', self.conn)
+
+    def sample(self, n_per_type, types=None, random_state=0, **conditions):
+        '''
+        Stratified sample: n_per_type events of each type (all of them for rarer types),
+        drawn at random among the events matching the conditions of query
+        '''
+        rng = np.random.default_rng(random_state)
+        samples = []
+        for kind in (EVENT_TYPES if types is None else np.atleast_1d(types)):
+            where, args = self._where(types=kind, **conditions)
+            rowids = np.array([r for r, in self.conn.execute('SELECT rowid FROM events' + where, args)])
+            if len(rowids) > n_per_type:
+                rowids = np.sort(rng.choice(rowids, n_per_type, replace=False))
+            if len(rowids) > 0:
+                samples.append(pd.read_sql_query(
+                    'SELECT rowid AS event, * FROM events WHERE rowid IN (%s)' % ','.join(map(str, rowids)),
+                    self.conn))
+        if len(samples) == 0:
+            return self.query(limit=0)
+        return pd.concat(samples, ignore_index=True)
+
+    def read_frames(self, catalog, events, margin_seconds=0.0, usecols=None):
+        '''
+        Lines of XX_tracks.csv of the events (from margin_seconds before to margin_seconds
+        after), read with the catalog (A04), with the event number added
+        '''
+        selection = catalog.tracks_df.merge(events[['recording', 'track']].drop_duplicates(),
+                                            left_on=['recording', 'id'], right_on=['recording', 'track'])
+        lines = catalog.read_tracks(selection.drop(columns='track'), usecols=usecols)
+        if len(lines) == 0:
+            return lines
+        frame_rate = catalog.recordings_df.set_index('recording')['frameRate']
+        window = events[['event', 'recording', 'track', 'start_frame', 'end_frame']].copy()
+        margin = np.round(margin_seconds * frame_rate.reindex(window['recording']).values)
+        window['start_frame'] -= margin.astype(int)
+        window['end_frame'] += margin.astype(int)
+        lines = lines.merge(window, left_on=['recording', 'id'], right_on=['recording', 'track'])
+        keep = (lines['frame'] >= lines['start_frame']) & (lines['frame'] <= lines['end_frame'])
+        return lines[keep].drop(columns=['track', 'start_frame', 'end_frame']).reset_index(drop=True)
+
+    def close(self):
+        self.conn.close()
+
+
+def build_event_index(data_path, path=None, recordings=None, processes=1, rebuild=False, verbose=True,
+                      **thresholds):
+    '''
+    Scans the recordings that are not in the index yet (or have changed since, or
+    were scanned with other thresholds), processes recordings at a time
+    '''
+    thresholds = dict(THRESHOLDS, **thresholds)
+    catalog = load_catalog(data_path)
+    index = EventIndex(os.path.join(data_path, INDEX_FILE) if path is None else path)
+    if rebuild:
+        with index.conn:
+            index.conn.execute('DELETE FROM events')
+            index.conn.execute('DELETE FROM scanned')
+    tasks = []
+    for _, meta in catalog.recordings_df.iterrows():
+        recording = int(meta['recording'])
+        if recordings is not None and recording not in np.atleast_1d(recordings):
+            continue
+        _, _, track_name = recording_files(data_path, recording)
+        if index.is_scanned(recording, os.path.getmtime(track_name), thresholds):
+            continue
+        tracks_meta = catalog.tracks_df.loc[catalog.tracks_df['recording'] == recording,
+                                            ['id', 'class', 'drivingDirection']]
+        tasks.append((data_path, recording, meta['frameRate'], tracks_meta, thresholds))
+
+    def written(results):
+        for recording, mtime, events in results:
+            events['locationId'] = int(catalog.recordings_df.loc[catalog.recordings_df['recording'] == recording,
+                                                                 'locationId'].iloc[0])
+            index.write(recording, mtime, thresholds, events)
+            if verbose:
+                print('indexed recording %d: %d events' % (recording, len(events)))
+
+    if processes == 1 or len(tasks) <= 1:
+        written(map(_scan_recording, tasks))
+    else:
+        with mp.Pool(processes) as pool:
+            written(pool.imap_unordered(_scan_recording, tasks))
+    return index
+
+
+def load_event_index(data_path, path=None):
+    return EventIndex(os.path.join(data_path, INDEX_FILE) if path is None else path)
+
+
+if __name__ == '__main__':
+    import sys
+    # usage: python -m Utils.A05_event_index data_path [processes]
+    events = build_event_index(sys.argv[1], processes=int(sys.argv[2]) if len(sys.argv) > 2 else 1)
+    print(events.counts())
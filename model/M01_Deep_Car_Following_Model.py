@@ -8,6 +8,11 @@ deep car following model to predicts the acceleration rate at the next time inte
 Note that this model try to predict the acceleration only, so it's a separated
 car-following model (no lane changing)
 
+Different models for each class of drivers (one network per vehicle class and
+speed band, trained at the same time in separate processes, with a gate routing
+each vehicle to its network) are trained by M18_Mixture_of_Experts:
+    python -m model.M18_Mixture_of_Experts data/Car_following_df.csv model/experts
+
 The lower the loss, the better a model (unless the model has over-fitted to the training data). 
 The loss is calculated on training and validation and its interperation is how well the model 
 is doing for these two sets. Unlike accuracy, loss is not a percentage. 
@@ -36,26 +41,24 @@ For example, if the number of test samples is 1000 and model classifies
 More about loss vs accuracy: 
 https://stackoverflow.com/questions/34518656/how-to-interpret-loss-and-accuracy-for-a-machine-learning-model
 
+Run it from the root of the repository:
+    python -m model.M01_Deep_Car_Following_Model train [Car_following_df.csv] [model_dir] [figures_dir]
+    python -m model.M01_Deep_Car_Following_Model evaluate [Car_following_df.csv] [model_dir] [figures_dir]
+
+or call train() and evaluate() from another module; tensorflow, sklearn and
+matplotlib are only imported when they are called.
+
 """
 
 #load all the required packages
+import os
+
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-#from pandas import read_csv
-import tensorflow.keras
-#from tensorflow.keras import backend
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Dropout
-
-from sklearn.preprocessing import MinMaxScaler
-#from sklearn.metrics import mean_squared_error
-from sklearn.model_selection import train_test_split
-
-#Step 1: load data abd process the data for modelling
-prject_path = '/Users/MinhKieu/Documents/Github/data-driven-car-following/'
-filename = prject_path + "data/Car_following_df.csv"
-dataset = np.genfromtxt(filename, delimiter=',',dtype=None)
+
+from model.M17_Lean_Dataset import load_dataset, fit_min_max, scale_in_place, split_indices
+
+# the default files are read and written in the repository
+prject_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
 
 names=('drivingDirection','time_hour','width','height', 'class', 'minXSpeed',
         'maxXSpeed','meanXSpeed',
@@ -75,35 +78,45 @@ names=('drivingDirection','time_hour','width','height', 'class', 'minXSpeed',
         'Right_Pre_X1', 'Right_Pre_Speed1', 'Right_Al_X1', 'Right_Al_Speed1', 'Right_Fol_X1',
         'Right_Fol_Speed1', 'traffic_density1', 'traffic_speed1')
 
-## process the data to consider static vs dynamic variables, and also consider several time steps
 
-# normalize the dataset
-scaler = MinMaxScaler(feature_range=(0, 1))
-dataset = scaler.fit_transform(dataset)
+##########
+# Step 1: load data abd process the data for modelling
+
+def load_data(filename, scaler=None, test_size=0.25, random_state=42):
+    '''
+    Car_following_df.csv as one float32 array, scaled in place, with the training and testing rows.
+    Without a scaler, the min/max of the training rows are used
+    '''
+    # one float32 array, read in chunks: it is the only full copy of the data kept in memory
+    dataset = load_dataset(filename)
 
-# Labels are the values we want to predict
-acceleration = np.array(dataset[:,dataset.shape[1]-1])  #last column: acceleration
-lanechange = np.array(dataset[:,dataset.shape[1]-2])   #second last column: lane change (binary)
+    ## process the data to consider static vs dynamic variables, and also consider several time steps
 
-target = acceleration
+    # Split the rows into training and testing sets first, so that the scaler only sees the training rows
+    # (index arrays: the rows stay in the one dataset array)
+    train_index, test_index = split_indices(len(dataset), test_size = test_size, random_state = random_state)
 
-# Remove the labels from the features
-dataset= dataset[:,7:-2]
-# Using Skicit-learn to split data into training and testing sets
-# Split the data into training and testing sets
-train_features, test_features, train_labels, test_labels = train_test_split(dataset, target, test_size = 0.25, random_state = 42)
+    # normalize the dataset in place, with the min/max of the training rows
+    if scaler is None:
+        scaler = fit_min_max(dataset, train_index)
+    scale_in_place(dataset, scaler)
+    # Labels are the last column (acceleration, the second last is the lane change),
+    # the features are dataset[:,7:-2]
+    return dataset, scaler, train_index, test_index
 
 
 ##########
 # Step 2: Develop and train the Deep Learning model
 
-def build_model():
+def build_model(n_features):
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import Dense, Dropout
     
     model = Sequential()
     # Dense(64) is a fully-connected layer with 64 hidden units.
     # in the first layer, you must specify the expected input data shape:
     # here, 20-dimensional vectors.
-    model.add(Dense(64, activation='relu', input_dim=train_features.shape[1]))
+    model.add(Dense(64, activation='relu', input_dim=n_features))
     #model.add(Dropout(0.5))
     model.add(Dense(64, activation='relu'))
     #model.add(Dropout(0.5))
@@ -118,39 +131,47 @@ def build_model():
                   metrics=['mae', 'mse'])
     return model
 
-model = build_model()
 
-# The patience parameter is the amount of epochs to check for improvement
-early_stop = tensorflow.keras.callbacks.EarlyStopping(monitor='val_loss', patience=10)
+def train(filename, model_dir, figures_path=None, epochs=100, patience=10, test_size=0.25, random_state=42):
+    '''
+    Trains the network on the training rows and saves it with the scaler statistics as
+    a new version in model_dir, so that new recordings can be added later with
+    M07_Incremental_Training. Returns the model and its training history
+    '''
+    import tensorflow.keras
+    from model.M07_Incremental_Training import save_version
+    from model.M09_Sequence_Dataset import RowSequence
 
-# Display training progress by printing a single dot for each completed epoch
-class PrintDot(tensorflow.keras.callbacks.Callback):
-  def on_epoch_end(self, epoch, logs):
-    if epoch % 100 == 0: print('')
-    print('.', end='')
+    dataset, scaler, train_index, test_index = load_data(filename, test_size=test_size, random_state=random_state)
+    # The rows are gathered batch by batch from the dataset; as validation_split=0.2 did,
+    # the last 20% of the training rows are kept for validation
+    n_validation = len(train_index) - int(len(train_index) * (1 - 0.2))
+    train_batches = RowSequence(dataset, train_index[:len(train_index) - n_validation])
+    validation_batches = RowSequence(dataset, train_index[len(train_index) - n_validation:], shuffle=False)
 
-EPOCHS = 100
+    model = build_model(dataset.shape[1] - 9)
 
-history = model.fit(
-  train_features, train_labels,
-  epochs=EPOCHS, validation_split = 0.2, verbose=0,
-  callbacks=[early_stop])
+    # The patience parameter is the amount of epochs to check for improvement
+    early_stop = tensorflow.keras.callbacks.EarlyStopping(monitor='val_loss', patience=patience)
 
+    history = model.fit(
+      train_batches,
+      epochs=epochs, validation_data = validation_batches, verbose=0,
+      callbacks=[early_stop])
 
-##########
-# Step 3: Analyse the modelling progress
-
-#score: first is the mean squared error, second is the accuracy in percentage
-# for instance accuracy = 0.94 means 94% of accuracy
-#score = model.evaluate(test_features, test_labels, batch_size=128)
+    if figures_path is not None:
+        plot_history(history, figures_path)
 
-#hist = pd.DataFrame(history.history)
-#hist['epoch'] = history.epoch
+    save_version(model, scaler, model_dir, dataset, index=train_index)
+    return model, history
 
-#model.summary()
 
+##########
+# Step 3: Analyse the modelling progress
 
-def plot_history(history):
+def plot_history(history, figures_path):
+  import matplotlib.pyplot as plt
+  import pandas as pd
   hist = pd.DataFrame(history.history)
   hist['epoch'] = history.epoch
 
@@ -163,7 +184,7 @@ def plot_history(history):
            label = 'Validation Error')
   #plt.ylim([0,5])
   plt.legend()
-  plt.savefig(prject_path + "figures/NN_mae.pdf", bbox_inches='tight')
+  plt.savefig(figures_path + "NN_mae.pdf", bbox_inches='tight')
 
   plt.figure()
   plt.xlabel('Epoch')
@@ -174,39 +195,57 @@ def plot_history(history):
            label = 'Validation Error')
   #plt.ylim([0,100])
   plt.legend() 
-  plt.savefig(prject_path + "figures/NN_mse.pdf", bbox_inches='tight')
-
-  plt.show()
-
-plot_history(history)
+  plt.savefig(figures_path + "NN_mse.pdf", bbox_inches='tight')
+  plt.close('all')
 
 
 ##########
 # Step 4: Test the models
 
-#loss, mae, mse = model.evaluate(test_features, test_labels, verbose=2)
-
-#print("Testing set Mean Abs Error: {:5.2f}".format(mae))
-
-test_predictions = model.predict(test_features)
-
-plt.figure()
-plt.scatter(test_labels, test_predictions)
-plt.xlabel('True Values')
-plt.ylabel('Predictions')
-plt.axis('equal')
-plt.axis('square')
-plt.xlim([0,plt.xlim()[1]])
-plt.ylim([0,plt.ylim()[1]])
-plt.savefig(prject_path + "figures/scatter_pred.pdf", bbox_inches='tight')
-plt.show()
-#_ = plt.plot([-100, 100], [-100, 100])
-
-#plt.figure()
-#error = test_predictions - test_labels
-#plt.hist(error, bins = 25)
-#plt.xlabel("Prediction Error")
-#_ = plt.ylabel("Count")
-#plt.savefig(prject_path + "figures/error_bins.pdf", bbox_inches='tight')
-#plt.show()
-
+def evaluate(filename, model_dir, version=None, figures_path=None, test_size=0.25, random_state=42):
+    '''
+    Errors (m/s2) of a saved version (the latest by default) on the testing rows,
+    scaled with the statistics saved with the version
+    '''
+    from model.M07_Incremental_Training import load_version
+    from model.M09_Sequence_Dataset import RowSequence
+
+    model, scaler, entry = load_version(model_dir, version)
+    dataset, _, _, test_index = load_data(filename, scaler, test_size, random_state)
+    test_batches = RowSequence(dataset, test_index, batch_size=4096, shuffle=False)
+    test_labels = dataset[test_index, -1]
+    test_predictions = model.predict(test_batches, verbose=0).ravel()
+
+    if figures_path is not None:
+        import matplotlib.pyplot as plt
+        plt.figure()
+        plt.scatter(test_labels, test_predictions)
+        plt.xlabel('True Values')
+        plt.ylabel('Predictions')
+        plt.axis('equal')
+        plt.axis('square')
+        plt.xlim([0,plt.xlim()[1]])
+        plt.ylim([0,plt.ylim()[1]])
+        plt.savefig(figures_path + "scatter_pred.pdf", bbox_inches='tight')
+        plt.close()
+
+    # errors in m/s2
+    error = (test_predictions - test_labels) / scaler.scale_[-1]
+    return {'version': entry['version'], 'test_lines': len(test_index),
+            'mae': float(np.mean(np.abs(error))), 'mse': float(np.mean(error ** 2))}
+
+
+if __name__ == '__main__':
+    import sys
+    # usage: python -m model.M01_Deep_Car_Following_Model train|evaluate [Car_following_df.csv] [model_dir] [figures_dir]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'train'
+    if command not in ('train', 'evaluate'):
+        sys.exit('usage: python -m model.M01_Deep_Car_Following_Model train|evaluate [Car_following_df.csv] [model_dir] [figures_dir]')
+    filename = sys.argv[2] if len(sys.argv) > 2 else prject_path + "data/Car_following_df.csv"
+    model_dir = sys.argv[3] if len(sys.argv) > 3 else prject_path + "model/car_following"
+    figures_path = sys.argv[4] if len(sys.argv) > 4 else prject_path + "figures/"
+    if command == 'train':
+        model, history = train(filename, model_dir, figures_path)
+        print('trained for %d epochs' % len(history.epoch))
+    result = evaluate(filename, model_dir, figures_path=figures_path)
+    print('version %d: testing set Mean Abs Error %.4f m/s2, Mean Square Error %.4f' % (result['version'], result['mae'], result['mse']))
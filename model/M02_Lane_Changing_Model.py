@@ -5,23 +5,25 @@
 This function develops a lane-changing model from the data
 It uses Random Forest to perform the classication of lane change or not
 
+Run it from the root of the repository:
+    python -m model.M02_Lane_Changing_Model train [Car_following_df.csv] [lane_change_forest.pkl] [figures_dir]
+    python -m model.M02_Lane_Changing_Model evaluate [Car_following_df.csv] [lane_change_forest.pkl] [figures_dir]
 
+train fits the classifier again, evaluate loads the saved one; both print the
+accuracy on the testing rows and plot the important features. sklearn, rfpimp,
+matplotlib and seaborn are only imported by the functions that use them.
 
 """
 
 # load all the required packages
+import os
+
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
 
-from sklearn.preprocessing import MinMaxScaler
-# from sklearn.metrics import mean_squared_error
-from sklearn.model_selection import train_test_split
+from model.M17_Lean_Dataset import load_dataset, fit_min_max, scale_in_place, split_indices
 
-# Step 1: load data abd process the data for modelling
-prject_path = '/Users/MinhKieu/Documents/Github/data-driven-car-following/'
-filename = prject_path + "data/Car_following_df.csv"
-dataset = np.genfromtxt(filename, delimiter=',', dtype=None)
+# the default files are read and written in the repository
+prject_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
 
 names=('drivingDirection','time_hour','width','height', 'class', 'minXSpeed',
         'maxXSpeed','meanXSpeed',
@@ -42,70 +44,110 @@ names=('drivingDirection','time_hour','width','height', 'class', 'minXSpeed',
         'Right_Fol_Speed1', 'traffic_density1', 'traffic_speed1')
 
 
-## process the data to consider static vs dynamic variables, and also consider several time steps
+# Step 1: load data abd process the data for modelling
+def load_data(filename, test_size=0.25, random_state=42):
+    '''
+    Features and lane-change labels of the training and testing rows of Car_following_df.csv,
+    and the scaler (min/max of the training rows) they have been scaled with
+    '''
+    # one float32 array, read in chunks
+    dataset = load_dataset(filename)
 
-# normalize the dataset
-scaler = MinMaxScaler(feature_range=(0, 1))
-dataset = scaler.fit_transform(dataset)
+    ## process the data to consider static vs dynamic variables, and also consider several time steps
 
-# Labels are the values we want to predict
-acceleration = np.array(dataset[:, dataset.shape[1] - 1])  # last column: acceleration
-lanechange = np.array(dataset[:, dataset.shape[1] - 2])  # second last column: lane change (binary)
+    # Split the rows into training and testing sets first, so that the scaler only sees the training rows
+    # (the same rows as train_test_split(dataset, target, ...))
+    train_index, test_index = split_indices(len(dataset), test_size=test_size, random_state=random_state)
 
-target = lanechange
+    # normalize the dataset in place, with the min/max of the training rows (as M01)
+    scaler = fit_min_max(dataset, train_index)
+    scale_in_place(dataset, scaler)
 
-# Remove the labels from the features
-dataset = dataset[:, 7:-2]
-# Using Skicit-learn to split data into training and testing sets
-# Split the data into training and testing sets
-train_features, test_features, train_labels, test_labels = train_test_split(dataset, target, test_size=0.25,
-                                                                            random_state=42)
+    # Labels are the values we want to predict (views on the dataset, not copies)
+    target = dataset[:, dataset.shape[1] - 2]  # second last column: lane change (binary)
 
-##########
-# Step 2: Develop and train the Random Forest model
-#Import Random Forest Model
-from sklearn.ensemble import RandomForestClassifier
+    # Remove the labels from the features
+    features = dataset[:, 7:-2]
+    # only the selected rows are copied, as the contiguous float32 arrays the forest works on
+    return features[train_index], features[test_index], target[train_index], target[test_index], scaler
 
-#Create a Gaussian Classifier
-clf=RandomForestClassifier(n_estimators=300)
 
-#Train the model using the training sets y_pred=clf.predict(X_test)
-clf.fit(train_features,train_labels)
+##########
+# Step 2: Develop and train the Random Forest model
+def train(train_features, train_labels, model_path, method='forest', refit=False, scaler=None, **kwargs):
+    '''
+    Random Forest Classifier with 300 trees, trained on all the cores, and saved: the next
+    runs load it instead of training it again (refit=True to retrain).
+    method='grow_forest' adds trees until the out-of-bag error stops improving,
+    method='boosting' uses a histogram-based gradient boosting for very large data.
+    The scaler of load_data is saved next to the classifier, so M08_Inference_Server
+    scales the features of the forest as in training
+    '''
+    from model.M10_Lane_Change_Training import load_or_fit
+    return load_or_fit(model_path, train_features, train_labels, method=method, refit=refit, scaler=scaler, **kwargs)
 
-test_predictions=clf.predict(test_features)
-# Probabilities for each class
-rf_probs = clf.predict_proba(test_features)[:, 1]
 
-pd.crosstab(test_labels, test_predictions, rownames=['Actual Result'], colnames=['Predicted Result'])
+##########
+# Step 3: Test the model
+def evaluate(clf, test_features, test_labels):
+    '''
+    Accuracy (how often is the classifier correct?) and confusion table on the testing rows
+    '''
+    import pandas as pd
+    #Import scikit-learn metrics module for accuracy calculation
+    from sklearn import metrics
+    test_predictions = clf.predict(test_features)
+    crosstab = pd.crosstab(test_labels, test_predictions, rownames=['Actual Result'], colnames=['Predicted Result'])
+    return {'accuracy': metrics.accuracy_score(test_labels, test_predictions), 'crosstab': crosstab}
 
-#Import scikit-learn metrics module for accuracy calculation
-from sklearn import metrics
-# Model Accuracy, how often is the classifier correct?
-print("Accuracy:",metrics.accuracy_score(test_labels, test_predictions))
 
 ##########
 # Step 4: Find important features
-from sklearn.metrics import r2_score
-from rfpimp import permutation_importances
-
-def r2(clf, train_features, train_labels):
-    return r2_score(train_labels, clf.predict(train_features))
-
-perm_imp_rfpimp = permutation_importances(clf, pd.DataFrame(train_features,columns=names[7:]), pd.DataFrame(train_labels), r2)
-
-perm_imp_rfpimp=perm_imp_rfpimp.iloc[:,0]
-
-df_plt = perm_imp_rfpimp[perm_imp_rfpimp>0]
-
-import matplotlib.pyplot as plt
-import seaborn as sns
-# Creating a bar plot
-sns.barplot(x=df_plt, y=df_plt.index)
-# Add labels to your graph
-plt.xlabel('Feature Importance Score')
-plt.ylabel('Features')
-plt.title("Important Features")
-#plt.legend()
-plt.savefig(prject_path + "figures/Important_features.pdf", bbox_inches='tight')
-plt.show()
-
+def feature_importance(clf, train_features, train_labels, figures_path=None):
+    '''
+    Permutation importance (rfpimp) of each feature, plotted if figures_path is given
+    '''
+    import pandas as pd
+    from sklearn.metrics import r2_score
+    from rfpimp import permutation_importances
+
+    def r2(clf, train_features, train_labels):
+        return r2_score(train_labels, clf.predict(train_features))
+
+    perm_imp_rfpimp = permutation_importances(clf, pd.DataFrame(train_features,columns=names[7:]), pd.DataFrame(train_labels), r2)
+
+    perm_imp_rfpimp=perm_imp_rfpimp.iloc[:,0]
+
+    if figures_path is not None:
+        df_plt = perm_imp_rfpimp[perm_imp_rfpimp>0]
+
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+        plt.figure()
+        # Creating a bar plot
+        sns.barplot(x=df_plt, y=df_plt.index)
+        # Add labels to your graph
+        plt.xlabel('Feature Importance Score')
+        plt.ylabel('Features')
+        plt.title("Important Features")
+        #plt.legend()
+        plt.savefig(figures_path + "Important_features.pdf", bbox_inches='tight')
+        plt.close()
+    return perm_imp_rfpimp
+
+
+if __name__ == '__main__':
+    import sys
+    # usage: python -m model.M02_Lane_Changing_Model train|evaluate [Car_following_df.csv] [lane_change_forest.pkl] [figures_dir]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'train'
+    if command not in ('train', 'evaluate'):
+        sys.exit('usage: python -m model.M02_Lane_Changing_Model train|evaluate [Car_following_df.csv] [lane_change_forest.pkl] [figures_dir]')
+    filename = sys.argv[2] if len(sys.argv) > 2 else prject_path + "data/Car_following_df.csv"
+    model_path = sys.argv[3] if len(sys.argv) > 3 else prject_path + "model/lane_change_forest.pkl"
+    figures_path = sys.argv[4] if len(sys.argv) > 4 else prject_path + "figures/"
+    train_features, test_features, train_labels, test_labels, scaler = load_data(filename)
+    clf = train(train_features, train_labels, model_path, refit=command == 'train', scaler=scaler)
+    result = evaluate(clf, test_features, test_labels)
+    print(result['crosstab'])
+    print("Accuracy:", result['accuracy'])
+    feature_importance(clf, train_features, train_labels, figures_path)
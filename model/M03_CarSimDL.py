@@ -6,21 +6,49 @@ Requirements:
     1. Run M01_Deep_Car_Following_Model first and save the model to a pickle
     2. Run A02_data_distributions and save all the required pickles
 
+Run it from the root of the repository:
+    python -m model.M03_CarSimDL [two_plots] [ani] [spacetime] [reps] [spacetime_reps]
+                                 [realtime] [historical] [fork] [profile]
+(two_plots by default). matplotlib and pandas are only imported to plot and
+export the results, so the Model can be imported and run quickly in worker processes
+
+A model can be saved with model.save_checkpoint(path) and restored with
+Model.load_checkpoint(path), e.g. to fork many scenarios from one warmed-up
+state (see M13_Checkpoint)
+
+model.enable_profiling() measures the time of each phase of the step, the number
+of buses of each status and the allocations at every step (see M19_Sim_Profiler)
+
+model.traffic keeps the number and speed of the vehicles on the road per lane and
+direction, updated as they enter, leave or change speed; model.traffic_features()
+gives the traffic_density and traffic_speed of A01 in O(1) (see M20_Traffic_Aggregates)
+
+model.add_detectors(Detectors(...)) measures flow, density, speed and occupancy
+with virtual loops and space-time cells while the model runs, so the trajectories
+do not have to be kept (model.record_trajectories = False, see M22_Virtual_Detectors)
+
 
 Author: Minh Kieu, University of Leeds, Nov 2019
 """
 # Import
 import numpy as np
-import matplotlib.pyplot as plt
 import pickle
-import pandas as pd
+import time
+from contextlib import nullcontext
+
+from model.M04_Sim_Animation import SimAnimator
+from model.M06_Scenario_Sweep import run_sweep
+from model.M13_Checkpoint import save_checkpoint, load_checkpoint, fork
+from model.M19_Sim_Profiler import StepProfiler, MemorySink, JsonLinesSink
+from model.M20_Traffic_Aggregates import LaneAggregates, NO_LANE
+from model.M22_Virtual_Detectors import Detectors
 
 '''
 DEFINE AGENTS
 '''
 
 class Car:
-    def __init__(self, bus_params):
+    def __init__(self, car_params):
         # Parameters to be defined
         
         #dynamic variables
@@ -57,10 +85,26 @@ class Car:
         #current lane: self.LaneID
         #find out the utility of changing lane to the left    
         
-        #find out the utility of changing lane to the right        
-        
-        
-        
+        #find out the utility of changing lane to the right
+
+        return
+
+
+class Bus:
+    def __init__(self, bus_params):
+        # Parameters to be defined
+        [setattr(self, key, value) for key, value in bus_params.items()]
+        # Fixed parameters
+        self.visited = 0  # visited bus stop
+        self.states = []  # noisy states: [status,position,velocity]
+        self.groundtruth = []  # ground-truth location of the buses (no noise)
+        self.trajectory = []  # store the location of each buses
+        return
+
+    def move(self):
+        self.position += self.velocity * self.dt
+        return
+
 
 class BusStop:
     def __init__(self, position, busstopID, arrival_rate, departure_rate,activation):
@@ -75,10 +119,22 @@ class BusStop:
         self.activation = activation
 
 class Model:
-    def __init__(self, model_params, TrafficSpeed0,ArrivalRate,DepartureRate,IncreaseRate,maxDemand):        
+    def __init__(self, model_params, TrafficSpeed0,ArrivalRate,DepartureRate,IncreaseRate,maxDemand=None,seed=None):        
         [setattr(self, key, value) for key, value in model_params.items()]        
+        # None: numpy's global random generator (np.random.seed), otherwise see random()
+        self.seed = seed
+        # None: no instrumentation, see enable_profiling()
+        self.profiler = None
+        # None: no virtual detectors, see add_detectors()
+        self.detectors = None
+        # False: the buses do not keep their trajectory and groundtruth
+        self.record_trajectories = True
         # Initial Condition
-        self.maxDemand=maxDemand
+        if maxDemand is not None:
+            self.maxDemand=maxDemand
+        #lanes per direction, numbered as in highD; the buses drive on the first lower lane
+        if not hasattr(self, 'NumLane'):
+            self.NumLane = 1
         self.IncreaseRate=IncreaseRate
         self.TrafficSpeed0 = TrafficSpeed0
         self.TrafficSpeed = TrafficSpeed0
@@ -98,8 +154,66 @@ class Model:
         self.FleetSize = int(self.EndTime / self.Headway)
         self.initialise_busstops()
         self.initialise_buses()        
+        # running counts and speed sums of the vehicles on the road (none before the first dispatch)
+        self.traffic = LaneAggregates(self.NumberOfStop * self.LengthBetweenStop / 1000, self.NumLane)
         return
     
+    def save_checkpoint(self, path):
+        '''
+        Saves the complete state of the model (agents, recorded data, random generator) to a binary file
+        '''
+        save_checkpoint(self, path)
+        return
+
+    @staticmethod
+    def load_checkpoint(path, restore_random=True):
+        '''
+        Restores a model saved with save_checkpoint
+        '''
+        return load_checkpoint(path, restore_random)
+
+    def enable_profiling(self, sinks=None, memory=False, label=None):
+        '''
+        Attaches a StepProfiler to the model (sinks: default one MemorySink) and returns it
+        '''
+        self.profiler = StepProfiler([MemorySink()] if sinks is None else sinks, memory, label)
+        return self.profiler
+
+    def disable_profiling(self):
+        '''
+        Detaches the profiler, closes its sinks and returns its summary
+        '''
+        summary = None
+        if self.profiler is not None:
+            summary = self.profiler.close()
+            self.profiler = None
+        return summary
+
+    def add_detectors(self, detectors):
+        '''
+        Virtual detectors updated after every step, from the current time
+        '''
+        self.detectors = detectors
+        detectors.start(self.current_time, [bus.position for bus in self.buses])
+        return detectors
+
+    def remove_detectors(self):
+        '''
+        Writes the last interval of the detectors and detaches them
+        '''
+        detectors = self.detectors
+        if detectors is not None:
+            detectors.close(self.current_time)
+            self.detectors = None
+        return detectors
+
+    def timed(self, name):
+        '''
+        with model.timed('animation'): ... adds the time of the block to the phase name
+        of the profiler, if there is one
+        '''
+        return nullcontext() if self.profiler is None else self.profiler.phase(name)
+
     #we need this agent2state for future application of data assimilation
     def agents2state(self, do_measurement=False):
         '''
@@ -142,84 +256,211 @@ class Model:
         '''
         This function moves the whole state one time step ahead
         '''
+        if self.profiler is not None:
+            return self.profiled_step()
         
         #Apply dynamic changes at every time step
-        # Decrease the traffic Speed every 100 time steps, until the traffic speed is 20% off at the EndTime
-        self.TrafficSpeed = self.TrafficSpeed0 * (1-self.current_time/((100/self.IncreaseRate)*self.EndTime))
-        # increase the arrival rate every 100 time step, until the demand is 50% more        
-        self.ArrivalRate = np.random.uniform(self.minDemand* (1+self.current_time/((100/self.IncreaseRate)*self.EndTime)) / 60, self.maxDemand * (1+self.current_time/((100/self.IncreaseRate)*self.EndTime)) / 60, self.NumberOfStop)
-        for busstop in self.busstops:
-            busstop.arrival_rate = self.ArrivalRate[busstop.busstopID]
+        self.update_demand()
         
         # This is the main step function to move the model forward
         self.current_time += self.dt
         # Loop through each bus and let it moves or dwells
         for bus in self.buses:
             #print('now looking at bus ',bus.busID)
-            # CASE 1: INACTIVE BUS (not yet dispatched)
-            if bus.status == 0:  # inactive bus (not yet dispatched)
-                # check if it's time to dispatch yet?
-                # if the bus is dispatched at the next time step
-                if self.current_time >= (bus.dispatch_time - self.dt):
-                    bus.status = 1  # change the status to moving bus
-                    bus.velocity = min(self.TrafficSpeed, bus.velocity + bus.acceleration * self.dt)
-            # CASE 2: Moving buses ( on the road)        
-            if bus.status == 1:  # moving bus
+            on_road, velocity = bus.status in (1, 2), bus.velocity
+            if self.move_bus(bus):
+                self.visit_stop(bus)
+            self.dwell_bus(bus)
+            self.record_bus(bus)
+            self.update_traffic(bus, on_road, velocity)
+        if self.detectors is not None:
+            self.detectors.update(self)
+        return
+
+    def profiled_step(self):
+        '''
+        The same step, with the time of each phase added to self.profiler
+        (any change of step() must be made here too)
+        '''
+        profiler = self.profiler
+        clock = time.perf_counter
+        profiler.begin_step()
+        start = clock()
+        self.update_demand()
+        self.current_time += self.dt
+        profiler.add('update_demand', clock() - start)
+        for bus in self.buses:
+            on_road, velocity = bus.status in (1, 2), bus.velocity
+            start = clock()
+            moved = self.move_bus(bus)
+            profiler.add('move_bus', clock() - start)
+            if moved:
+                start = clock()
+                stopID = self.reached_stop(bus)
+                profiler.add('stop_lookup', clock() - start)
+                if stopID is not None:
+                    start = clock()
+                    self.board_alight(bus, stopID)
+                    profiler.add('board_alight', clock() - start)
+            start = clock()
+            self.dwell_bus(bus)
+            profiler.add('dwell_bus', clock() - start)
+            start = clock()
+            self.record_bus(bus)
+            profiler.add('record_bus', clock() - start)
+            start = clock()
+            self.update_traffic(bus, on_road, velocity)
+            profiler.add('update_traffic', clock() - start)
+        if self.detectors is not None:
+            start = clock()
+            self.detectors.update(self)
+            profiler.add('detectors', clock() - start)
+        profiler.end_step(self)
+        return
+
+    def random(self, *key):
+        '''
+        Random numbers: numpy's global generator, or, if the model has a seed, a generator
+        that only depends on (seed, key), so the draws do not depend on the order
+        in which the buses and stops are processed (see M14_Domain_Decomposition)
+        '''
+        if self.seed is None:
+            return np.random
+        return np.random.default_rng([self.seed] + list(key))
+
+    def update_demand(self):
+        # Decrease the traffic Speed every 100 time steps, until the traffic speed is 20% off at the EndTime
+        self.TrafficSpeed = self.TrafficSpeed0 * (1-self.current_time/((100/self.IncreaseRate)*self.EndTime))
+        # increase the arrival rate every 100 time step, until the demand is 50% more        
+        self.ArrivalRate = self.random(0, int(round(self.current_time / self.dt))).uniform(self.minDemand* (1+self.current_time/((100/self.IncreaseRate)*self.EndTime)) / 60, self.maxDemand * (1+self.current_time/((100/self.IncreaseRate)*self.EndTime)) / 60, self.NumberOfStop)
+        for busstop in self.busstops:
+            busstop.arrival_rate = self.ArrivalRate[busstop.busstopID]
+        return
+
+    def move_bus(self, bus):
+        '''
+        Dispatches the bus if it is time, and moves it if it is on the road.
+        Returns True if the bus has moved (it may then have reached a bus stop)
+        '''
+        # CASE 1: INACTIVE BUS (not yet dispatched)
+        if bus.status == 0:  # inactive bus (not yet dispatched)
+            # check if it's time to dispatch yet?
+            # if the bus is dispatched at the next time step
+            if self.current_time >= (bus.dispatch_time - self.dt):
+                bus.status = 1  # change the status to moving bus
                 bus.velocity = min(self.TrafficSpeed, bus.velocity + bus.acceleration * self.dt)
-                bus.move()
-                if bus.position > self.NumberOfStop * self.LengthBetweenStop:
-                    bus.status = 3  # this is to stop bus after they reach the last stop
-                    bus.velocity = 0
-                # if after moving, the bus enters a bus stop with passengers on it, then we move the status to dwelling
-                def dns(x, y): return abs(x - y)
-                if min(dns(self.StopList, bus.position)) <= self.GeoFence:  # reached a bus stop
-                    # Investigate the info from the current stop
-                    Current_StopID = int(min(range(len(self.StopList)), key=lambda x: abs(self.StopList[x] - bus.position)))  # find the nearest bus stop
-                    #print('Current_StopID:',Current_StopID)   
-                    if Current_StopID != bus.visited:
-                        #Store the visited stop                         
-                        bus.visited = Current_StopID
-                        # passenger arrival rate
-                        arrival_rate = self.busstops[Current_StopID].arrival_rate
-                        if arrival_rate<0: arrival_rate=0
-                        # passenger departure rate
-                        departure_rate = self.busstops[Current_StopID].departure_rate
-                        # Now calculate the number of boarding and alighting
-                        boarding_count = 0
-                        # if the bus is the first bus to arrive at the bus stop
-                        if self.busstops[Current_StopID].arrival_time[-1] == 0:
-                            if self.busstops[Current_StopID].activation <= self.current_time:
-                                boarding_count = np.random.poisson(arrival_rate * self.Headway)
-                            alighting_count = int(bus.occupancy * departure_rate)
-                        else:
-                            timegap = self.current_time - self.busstops[Current_StopID].arrival_time[-1]
-                            boarding_count = min(np.random.poisson(arrival_rate*timegap), bus.size - bus.occupancy)                        
-                            alighting_count = int(bus.occupancy * departure_rate)
-                        # If there is at least 1 boarding or alighting passenger
-                        if boarding_count > 0 or alighting_count > 0:  # there is at least 1 boarding or alighting passenger
-                            # change the bus status to dwelling
-                            bus.status = 2  # change the status of the bus to dwelling
-                            bus.velocity = 0                            
-                            bus.leave_stop_time = self.current_time + boarding_count * self.BoardTime + alighting_count * self.AlightTime + self.StoppingTime  # total time for dwelling
-                            bus.occupancy = min(bus.occupancy - alighting_count + boarding_count, bus.size)
-                        # store the headway and arrival times
-                        self.busstops[Current_StopID].arrival_time.extend([self.current_time])  # store the arrival time of the bus
-                        if self.busstops[Current_StopID].arrival_time[-1] != 0:
-                            self.busstops[Current_StopID].actual_headway.extend([self.current_time - self.busstops[Current_StopID].arrival_time[-1]])# store the headway to the previous bus                            
-                        
-
-            # CASE 3: DWELLING BUS (waiting for people to finish boarding and alighting)
-            if bus.status == 2:
-                # check if people has finished boarding/alighting or not?
-                # if the bus hasn't left and can leave at the next time step
-                if self.current_time >= (bus.leave_stop_time - self.dt):
-                    bus.status = 1  # change the status to moving bus
-                    bus.velocity = min(self.TrafficSpeed, bus.velocity + bus.acceleration * self.dt)
+        # CASE 2: Moving buses ( on the road)        
+        if bus.status == 1:  # moving bus
+            bus.velocity = min(self.TrafficSpeed, bus.velocity + bus.acceleration * self.dt)
+            bus.move()
+            if bus.position > self.NumberOfStop * self.LengthBetweenStop:
+                bus.status = 3  # this is to stop bus after they reach the last stop
+                bus.velocity = 0
+            return True
+        return False
 
+    def nearest_stop(self, position):
+        return int(min(range(len(self.StopList)), key=lambda x: abs(self.StopList[x] - position)))
+
+    def visit_stop(self, bus):
+        '''
+        If after moving, the bus enters a bus stop with passengers on it, then we move the status to dwelling
+        '''
+        Current_StopID = self.reached_stop(bus)
+        if Current_StopID is not None:
+            self.board_alight(bus, Current_StopID)
+        return
+
+    def reached_stop(self, bus):
+        '''
+        The bus stop the bus has just reached and not visited yet, or None
+        '''
+        def dns(x, y): return abs(x - y)
+        if min(dns(self.StopList, bus.position)) <= self.GeoFence:  # reached a bus stop
+            # Investigate the info from the current stop
+            Current_StopID = self.nearest_stop(bus.position)  # find the nearest bus stop
+            #print('Current_StopID:',Current_StopID)   
+            if Current_StopID != bus.visited:
+                return Current_StopID
+        return None
+
+    def board_alight(self, bus, Current_StopID):
+        '''
+        Boarding and alighting at the stop; the bus dwells if there is at least one passenger
+        '''
+        #Store the visited stop                         
+        bus.visited = Current_StopID
+        # passenger arrival rate
+        arrival_rate = self.busstops[Current_StopID].arrival_rate
+        if arrival_rate<0: arrival_rate=0
+        # passenger departure rate
+        departure_rate = self.busstops[Current_StopID].departure_rate
+        # Now calculate the number of boarding and alighting
+        boarding_count = 0
+        # the draws of a stop only depend on the number of buses that have arrived there
+        random = self.random(1, Current_StopID, len(self.busstops[Current_StopID].arrival_time))
+        # if the bus is the first bus to arrive at the bus stop
+        if self.busstops[Current_StopID].arrival_time[-1] == 0:
+            if self.busstops[Current_StopID].activation <= self.current_time:
+                boarding_count = random.poisson(arrival_rate * self.Headway)
+            alighting_count = int(bus.occupancy * departure_rate)
+        else:
+            timegap = self.current_time - self.busstops[Current_StopID].arrival_time[-1]
+            boarding_count = min(random.poisson(arrival_rate*timegap), bus.size - bus.occupancy)                        
+            alighting_count = int(bus.occupancy * departure_rate)
+        # If there is at least 1 boarding or alighting passenger
+        if boarding_count > 0 or alighting_count > 0:  # there is at least 1 boarding or alighting passenger
+            # change the bus status to dwelling
+            bus.status = 2  # change the status of the bus to dwelling
+            bus.velocity = 0                            
+            bus.leave_stop_time = self.current_time + boarding_count * self.BoardTime + alighting_count * self.AlightTime + self.StoppingTime  # total time for dwelling
+            bus.occupancy = min(bus.occupancy - alighting_count + boarding_count, bus.size)
+        # store the headway and arrival times
+        self.busstops[Current_StopID].arrival_time.extend([self.current_time])  # store the arrival time of the bus
+        if self.busstops[Current_StopID].arrival_time[-1] != 0:
+            self.busstops[Current_StopID].actual_headway.extend([self.current_time - self.busstops[Current_StopID].arrival_time[-1]])# store the headway to the previous bus                            
+        return
+
+    def dwell_bus(self, bus):
+        # CASE 3: DWELLING BUS (waiting for people to finish boarding and alighting)
+        if bus.status == 2:
+            # check if people has finished boarding/alighting or not?
+            # if the bus hasn't left and can leave at the next time step
+            if self.current_time >= (bus.leave_stop_time - self.dt):
+                bus.status = 1  # change the status to moving bus
+                bus.velocity = min(self.TrafficSpeed, bus.velocity + bus.acceleration * self.dt)
+        return
+
+    def record_bus(self, bus):
+        if self.record_trajectories:
             bus.groundtruth.append([bus.status, bus.position, bus.velocity, bus.occupancy])
             bus.trajectory.extend([bus.position])
         return
 
+    def update_traffic(self, bus, was_on_road, old_velocity):
+        '''
+        Updates the traffic aggregates if the bus has entered or left the road, or changed speed
+        '''
+        on_road = bus.status in (1, 2)
+        if on_road != was_on_road or bus.velocity != old_velocity:
+            self.traffic.move(bus.lane if was_on_road else NO_LANE, old_velocity,
+                              bus.lane if on_road else NO_LANE, bus.velocity)
+        return
+
+    def rebuild_traffic(self):
+        '''
+        Sums the traffic aggregates again over all the buses
+        '''
+        self.traffic.rebuild([bus.lane if bus.status in (1, 2) else NO_LANE for bus in self.buses],
+                             [bus.velocity for bus in self.buses])
+        return
+
+    def traffic_features(self, drivingDirection=2):
+        '''
+        traffic_density (vehicles/km/lane) and traffic_speed of a direction, as computed by A01
+        '''
+        return self.traffic.features(drivingDirection)
+
     def initialise_busstops(self):
         self.busstops = []
         for busstopID in range(len(self.StopList)):
@@ -242,6 +483,7 @@ class Model:
                 "busID": busID,
                 # all buses starts at the first stop,
                 "position": -self.TrafficSpeed * self.dt,
+                "lane": self.NumLane + 3,  # first lower lane (drivingDirection 2, x increasing)
                 "occupancy": 0,
                 "size": 100,
                 "acceleration": self.BusAcceleration / self.dt,
@@ -255,46 +497,35 @@ class Model:
             self.buses.append(bus)
         return
 
-def run_model(model_params,TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate,do_ani,do_spacetime_plot,do_reps,uncalibrated):  #this function is to quickly run the model
+def run_model(model_params,TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate,do_ani,do_spacetime_plot,do_reps,uncalibrated,ani_output='BusSim_ani.mp4',ani_every=1):  #this function is to quickly run the model
     '''
     Model runing and plotting
+    
+    The animation (do_ani) is rendered headlessly in a separate process, see M04_Sim_Animation
+    ani_output: video file (or folder of frames) to write the animation to
+    ani_every: draw one frame every ani_every time steps
     '''
     model = Model(model_params, TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate)
 
     if do_ani or do_spacetime_plot or uncalibrated:
+        if do_ani:
+            animator = SimAnimator(model, ani_output, frame_every=ani_every)
+            animator.start()
         for time_step in range(int(model.EndTime / model.dt)):
             model.step()
             if do_ani:
-                text0 = ['Traffic Speed:  %.2f m/s' % (model.TrafficSpeed)]
-                plt.text(0, 0.025, "".join(text0))
-                text2 = ['Alighted passengers:  %d' % (len(model.alighted_passengers))]
-                plt.text(0, 0.02, "".join(text2))
-                plt.text(0, 0.015, 'Number of waiting passengers')
-                plt.plot(model.StopList, np.zeros_like(model.StopList), "|", markersize=20, alpha=0.3)
-                plt.plot(model.StopList, np.zeros_like(model.StopList), alpha=0.3)
-                for busstop in model.busstops:
-                    # this is the value where you want the data to appear on the y-axis.
-                    val = 0.
-                    plt.plot(busstop.position, np.zeros_like(busstop.position) + val, 'ok', alpha=0.2)
-                    plt.text(busstop.position, np.zeros_like(busstop.position) + val + 0.01, len(busstop.passengers))
-                for bus in model.buses:
-                    plt.plot(bus.position, np.zeros_like(bus.position) + val, '>', markersize=10)
-                    text1 = ['BusID= %d, occupancy= %d, speed= %.2f m/s' % (bus.busID + 1, len(bus.passengers), bus.velocity)]
-                    if bus.status != 0:
-                        plt.text(0, -bus.busID * 0.003 - 0.01, "".join(text1))
-                plt.axis('off')
-                plt.pause(1 / 30)
-                plt.clf()
-            plt.show()
+                with model.timed('animation'):
+                    animator.push(model)
+        if do_ani:
+            animator.close()
+        if do_spacetime_plot or uncalibrated:
+            import matplotlib.pyplot as plt
+            from model.M05_SpaceTime_Plot import spacetime_lines
         if do_spacetime_plot :
             plt.figure(3, figsize=(16 / 2, 9 / 2))
             x = np.array([bus.trajectory for bus in model.buses]).T        
             t = np.arange(0, model.EndTime, model.dt)
-            x[x <= 0 ] = np.nan
-            x[x >= (model.NumberOfStop * model.LengthBetweenStop)] = np.nan            
-            plt.ylabel('Distance (m)')
-            plt.xlabel('Time (s)')
-            plt.plot(t, x, linewidth=.5,linestyle = '-')
+            spacetime_lines(t, x, road_length=model.NumberOfStop * model.LengthBetweenStop, linewidth=.5, linestyle='-')
             plt.pause(1 / 300) 
         
         if  uncalibrated:
@@ -302,11 +533,7 @@ def run_model(model_params,TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate,d
             #plt.clf()            
             x = np.array([bus.trajectory for bus in model.buses]).T        
             t = np.arange(0, model.EndTime, model.dt)
-            x[x <= 0 ] = np.nan
-            x[x >= (model.NumberOfStop * model.LengthBetweenStop)] = np.nan            
-            plt.ylabel('Distance (m)')
-            plt.xlabel('Time (s)')
-            plt.plot(t, x, linewidth=.5,linestyle = '--')
+            spacetime_lines(t, x, road_length=model.NumberOfStop * model.LengthBetweenStop, linewidth=.5, linestyle='--')
             plt.pause(1 / 300)    
         
         '''
@@ -351,6 +578,7 @@ def run_model(model_params,TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate,d
         return RepGPS        
  
 def plot(model_params, StateData, GroundTruth):
+    import matplotlib.pyplot as plt
     # plotting the space-time diagram
     GroundTruth[GroundTruth == 0] = np.nan
     GroundTruth[GroundTruth > (model_params['NumberOfStop'] * model_params['LengthBetweenStop'])] = np.nan
@@ -360,7 +588,13 @@ def plot(model_params, StateData, GroundTruth):
     return
 
 if __name__ == '__main__':
-    
+    import sys
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    from model.M05_SpaceTime_Plot import spacetime_lines, spacetime_overlay, mask_trajectories
+    # usage: python -m model.M03_CarSimDL [two_plots] [ani] [spacetime] [reps] [spacetime_reps] [realtime] [historical] [fork] [profile]
+    runs = sys.argv[1:] if len(sys.argv) > 1 else ['two_plots']
+
     NumberOfStop=20
     minDemand=0.5
     maxDemand=1
@@ -370,6 +604,7 @@ if __name__ == '__main__':
     #DepartureRate = np.linspace(0.05, 0.5,NumberOfStop)
     DepartureRate[0]=0
     TrafficSpeed=14
+    IncreaseRate=10  #as left by the two plots below
     #Initialise the model parameters
     model_params = {        
         "dt": 10,
@@ -388,14 +623,16 @@ if __name__ == '__main__':
 
     #runing parameters    
     
-    do_reps = False #whether we should export the distribution of headways
-    do_spacetime_plot = False
-    do_ani = False
-    do_spacetime_rep_plot = False
+    do_reps = 'reps' in runs #whether we should export the distribution of headways
+    do_spacetime_plot = 'spacetime' in runs
+    do_ani = 'ani' in runs
+    do_spacetime_rep_plot = 'spacetime_reps' in runs
     uncalibrated=False
-    do_data_export_realtime = False
-    do_data_export_historical= False
-    do_two_plots = True
+    do_data_export_realtime = 'realtime' in runs
+    do_data_export_historical= 'historical' in runs
+    do_fork_scenarios = 'fork' in runs
+    do_profile = 'profile' in runs
+    do_two_plots = 'two_plots' in runs
     
     if do_two_plots:                 
         plt.figure(3, figsize=(16 / 2, 9 / 2))
@@ -407,9 +644,7 @@ if __name__ == '__main__':
             model.step()
         x = np.array([bus.trajectory for bus in model.buses]).T        
         t = np.arange(0, model.EndTime, model.dt)
-        x[x <= 0 ] = np.nan
-        x[x >= (model.NumberOfStop * model.LengthBetweenStop)] = np.nan            
-        plt.plot(t, x,'r', linewidth=1,linestyle = '--')
+        spacetime_lines(t, x, road_length=model.NumberOfStop * model.LengthBetweenStop, color='r', linewidth=1, linestyle='--')
         
         IncreaseRate=10
         model = Model(model_params, TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate)
@@ -417,11 +652,7 @@ if __name__ == '__main__':
             model.step()
         x = np.array([bus.trajectory for bus in model.buses]).T        
         t = np.arange(0, model.EndTime, model.dt)
-        x[x <= 0 ] = np.nan
-        x[x >= (model.NumberOfStop * model.LengthBetweenStop)] = np.nan            
-        plt.ylabel('Distance (m)')
-        plt.xlabel('Time (s)')
-        plt.plot(t, x,'k', linewidth=1.5,linestyle = '-')
+        spacetime_lines(t, x, road_length=model.NumberOfStop * model.LengthBetweenStop, color='k', linewidth=1.5, linestyle='-')
                 
         plt.plot([],[], 'r',linestyle = '--',linewidth=1, label='Dynamic change = 1%')
         plt.plot([],[], 'k',linestyle = '-',linewidth=1.5, label='Dynamic change = 10%')
@@ -453,26 +684,17 @@ if __name__ == '__main__':
             
     if do_spacetime_rep_plot:  #plot a few replications using the same data to see the spread        
         NumReps = 20
-        do_spacetime_plot = True
-        uncalibrated = False
-        for r in range(NumReps):
-            run_model(model_params,TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate,do_ani,do_spacetime_plot,do_reps,uncalibrated)    
+        #historical replications: positions only (do_reps mode of run_model)
+        historical = [run_model(model_params,TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate,False,False,True,False) for r in range(NumReps)]
 
         model2 = Model(model_params, TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate)
         for time_step in range(int(model2.EndTime / model2.dt)):
             model2.step()
 
-        x = np.array([bus.trajectory for bus in model2.buses]).T        
+        x = mask_trajectories(np.array([bus.trajectory for bus in model2.buses]).T, model2.NumberOfStop * model2.LengthBetweenStop)
         t = np.arange(0, model2.EndTime, model2.dt)
-        x[x <= 0 ] = np.nan
-        x[x >= (model2.NumberOfStop * model2.LengthBetweenStop)] = np.nan            
-        plt.ylabel('Distance (m)')
-        plt.xlabel('Time (s)')
-        plt.plot(t, x, linewidth=2, color='black')
-        plt.pause(1 / 300) 
-        plt.plot([],[], 'r',linestyle = '-',linewidth=.5, label='Historical')
-        plt.plot([],[], 'black',linestyle = '-',linewidth=2, label='Real-time')
-        plt.legend()
+        plt.figure(3, figsize=(16 / 2, 9 / 2))
+        spacetime_overlay(t, historical, x, road_length=model2.NumberOfStop * model2.LengthBetweenStop)
         plt.show()
         plt.savefig('Fig_spacetime_dynamic.pdf', dpi=200,bbox_inches='tight')
 
@@ -486,54 +708,52 @@ if __name__ == '__main__':
             pickle.dump([model_params,t,x,GroundTruth],f2)
             
 
-    if do_data_export_realtime: #this is the section where we export multiple pickles, each is for a synthetic 'real-time' GPS data of IncreaseRate
-        do_spacetime_plot = True        
-        for IncreaseRate in range(1,21,1):        
-            model2 = Model(model_params, TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate)
-            for time_step in range(int(model2.EndTime / model2.dt)):
-                model2.step()
-            
-            #del model2.buses[0] #remove the first bus 
-            
+    #the scenario that the sweeps below start from
+    scenario = {'model_params': model_params, 'TrafficSpeed': TrafficSpeed, 'ArrivalRate': ArrivalRate,
+                'DepartureRate': DepartureRate, 'IncreaseRate': IncreaseRate}
+
+    if do_data_export_realtime: #this is the section where we export a synthetic 'real-time' GPS data for each IncreaseRate
+        #one replication per IncreaseRate, run in parallel; rerunning resumes from the completed settings
+        store = run_sweep('Realtime_data.sqlite', scenario, {'IncreaseRate': range(1,21,1)}, NumReps=1, outputs=('trajectory','groundtruth'))
+        t = np.arange(0, model_params['EndTime'], model_params['dt'])
+        for setting_id, setting in store.settings().items():
             plt.figure(3, figsize=(16 / 2, 9 / 2))
             plt.clf() 
-            x = np.array([bus.trajectory for bus in model2.buses]).T        
-            t = np.arange(0, model2.EndTime, model2.dt)
-            x[x <= 0 ] = np.nan
-            x[x >= (model2.NumberOfStop * model2.LengthBetweenStop)] = np.nan            
-            plt.ylabel('Distance (m)')
-            plt.xlabel('Time (s)')
-            plt.plot(t, x, linewidth=1)
-            #plt.pause(1 / 300) 
-            #plt.plot([],[], 'r',linestyle = '-',linewidth=.5, label='Historical')
-            #plt.plot([],[], 'black',linestyle = '-',linewidth=2, label='Real-time')
-            #plt.legend()
-            name0 = ['C:/Users/geomlk/Dropbox/Minh_UoL/DA/ABM/BusSim/Figures/Fig_spacetime_IncreaseRate_',str(IncreaseRate),'.pdf']
-            str1 = ''.join(name0)
-            plt.savefig(str1, dpi=200,bbox_inches='tight')    
-            
-            GroundTruth = pd.DataFrame(model2.buses[0].groundtruth)
-            for b in range(1, model2.FleetSize):
-                GroundTruth = np.hstack((GroundTruth, model2.buses[b].groundtruth))
-            GroundTruth[GroundTruth < 0] = 0    
-            
-            name0 = ['C:/Users/geomlk/Dropbox/Minh_UoL/DA/ABM/BusSim/Data/Realtime_data_IncreaseRate_',str(IncreaseRate),'.pkl']
-            str1 = ''.join(name0)    
-            with open(str1,'wb') as f2:
-                pickle.dump([model_params,t,x,GroundTruth],f2)
+            x = mask_trajectories(store.load(setting_id, 'trajectory', rep=0), model_params['NumberOfStop'] * model_params['LengthBetweenStop'])
+            spacetime_lines(t, x, linewidth=1)
+            plt.savefig('Fig_spacetime_IncreaseRate_%d.pdf' % setting['IncreaseRate'], dpi=200,bbox_inches='tight')    
+        store.close()
 
     if do_data_export_historical:  #plot a few replications using the same data to see the spread        
-        do_reps=True
         NumReps = 20
-        for IncreaseRate in range(11,21,1):
-            print('Increase Rate = ',IncreaseRate)
-            for r in range(NumReps):
-                RepGPS = run_model(model_params,TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate,do_ani,do_spacetime_plot,do_reps,uncalibrated)             
-                GPSData.append(RepGPS)            
-            meanGPS = np.mean(GPSData,axis=0)
-            stdGPS = np.std(GPSData,axis=0)
-            name0 = ['C:/Users/geomlk/Dropbox/Minh_UoL/DA/ABM/BusSim/Data/Historical_data_IncreaseRate_',str(IncreaseRate),'.pkl']
-            str1 = ''.join(name0)    
-            with open(str1,'wb') as f2:
+        store = run_sweep('Historical_data.sqlite', scenario, {'IncreaseRate': range(11,21,1)}, NumReps=NumReps)
+        for setting_id, setting in store.settings().items():
+            #read one setting at a time from the store
+            meanGPS, stdGPS = store.mean_std(setting_id)
+            print('Increase Rate = ', setting['IncreaseRate'], ', replications: ', len(store.reps(setting_id)))
+            with open('Historical_data_IncreaseRate_%d.pkl' % setting['IncreaseRate'],'wb') as f2:
                 pickle.dump([model_params,meanGPS,stdGPS],f2)
-     
+        store.close()
+
+    if do_fork_scenarios:  #simulate the burn-in period once, then run every IncreaseRate from there
+        model = Model(model_params, TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate)
+        for time_step in range(int(model.BurnIn / model.dt)):
+            model.step()
+        model.save_checkpoint('BusSim_burnin.npz')
+        results = fork('BusSim_burnin.npz', [{'IncreaseRate': r} for r in range(1,21,1)])
+        t = np.arange(0, model_params['EndTime'], model_params['dt'])
+        plt.figure(3, figsize=(16 / 2, 9 / 2))
+        plt.clf()
+        for r, arrays in zip(range(1,21,1), results):
+            spacetime_lines(t, mask_trajectories(arrays['trajectory'], model_params['NumberOfStop'] * model_params['LengthBetweenStop']), linewidth=.5)
+        plt.savefig('Fig_spacetime_forked.pdf', dpi=200,bbox_inches='tight')
+
+    if do_profile:  #time of each phase of the step, appended to BusSim_profile.jsonl to compare releases
+        model = Model(model_params, TrafficSpeed,ArrivalRate,DepartureRate,IncreaseRate)
+        profiler = model.enable_profiling([MemorySink(), JsonLinesSink('BusSim_profile.jsonl', every=10)])
+        for time_step in range(int(model.EndTime / model.dt)):
+            model.step()
+        summary = model.disable_profiling()
+        print('%.0f steps/s' % summary['steps_per_second'])
+        for name, phase in summary['phases'].items():
+            print('%-14s %8.4f s %6.1f%% %8.1f us/call' % (name, phase['seconds'], 100 * phase['share'], phase['us_per_call']))
@@ -0,0 +1,217 @@
+"""
+Headless animation of the simulation in M03_CarSimDL
+
+The simulation only takes a light snapshot of the agents (a few numpy arrays)
+every few time steps and puts it on a queue. A separate rendering process reads
+the snapshots, updates a fixed set of matplotlib artists (no figure rebuilding)
+and writes either a video file or one image per frame, using the Agg backend so
+no window is needed.
+
+Usage (see run_model in M03_CarSimDL):
+
+    animator = SimAnimator(model, 'BusSim_ani.mp4', frame_every=5)
+    animator.start()
+    for time_step in range(int(model.EndTime / model.dt)):
+        model.step()
+        animator.push(model)
+    animator.close()
+
+If the output name has no video extension, or ffmpeg is not available, the
+frames are written as PNG files into a folder with that name instead.
+
+By default the simulation waits for the renderer when the queue is full, so no
+frame is lost; with drop_frames=True it never waits, and close() warns about the
+frames dropped. If the rendering process dies, push() and close() raise a
+RuntimeError instead of waiting for it forever.
+"""
+import os
+import queue
+import warnings
+import multiprocessing as mp
+
+import numpy as np
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.gif')
+
+
+def snapshot(model):
+    '''
+    This function takes a copy of the state needed to draw one frame.
+    Only small numpy arrays are returned so it is cheap to send between processes
+    '''
+    snap = {
+        'time': model.current_time,
+        'traffic_speed': model.TrafficSpeed,
+        'position': np.array([bus.position for bus in model.buses], dtype=float),
+        'velocity': np.array([bus.velocity for bus in model.buses], dtype=float),
+        'status': np.array([bus.status for bus in model.buses], dtype=np.int8),
+        'occupancy': np.array([bus.occupancy for bus in model.buses], dtype=np.int32),
+        'stop_rate': np.array([busstop.arrival_rate for busstop in model.busstops], dtype=float),
+    }
+    return snap
+
+
+def _render_worker(frame_queue, layout, output, fps, dpi):
+    '''
+    Entry point of the rendering process: builds the figure once, then updates
+    the artists for every snapshot it receives until it gets None
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib import animation
+
+    StopList = layout['StopList']
+    FleetSize = layout['FleetSize']
+    RoadLength = layout['RoadLength']
+
+    fig = plt.figure(figsize=(16 / 2, 9 / 2))
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_xlim(-0.05 * RoadLength, 1.05 * RoadLength)
+    ax.set_ylim(-FleetSize * 0.003 - 0.02, 0.03)
+    ax.axis('off')
+
+    # static artists: the road and the stops
+    ax.plot(StopList, np.zeros_like(StopList), "|", markersize=20, alpha=0.3)
+    ax.plot(StopList, np.zeros_like(StopList), alpha=0.3)
+    ax.plot(StopList, np.zeros_like(StopList), 'ok', alpha=0.2)
+
+    # dynamic artists: created once and updated at every frame
+    text_speed = ax.text(0, 0.025, '')
+    text_time = ax.text(0, 0.02, '')
+    ax.text(0, 0.015, 'Passenger arrival rate (per min)')
+    stop_texts = [ax.text(x, 0.01, '') for x in StopList]
+    bus_markers, = ax.plot([], [], '>', markersize=10)
+    bus_texts = [ax.text(0, -busID * 0.003 - 0.01, '') for busID in range(FleetSize)]
+
+    def update(snap):
+        text_speed.set_text('Traffic Speed:  %.2f m/s' % snap['traffic_speed'])
+        text_time.set_text('Time:  %d s' % snap['time'])
+        for text, rate in zip(stop_texts, snap['stop_rate']):
+            text.set_text('%.2f' % (rate * 60))
+        active = snap['status'] != 0
+        bus_markers.set_data(snap['position'][active], np.zeros(np.sum(active)))
+        for busID, text in enumerate(bus_texts):
+            if active[busID]:
+                text.set_text('BusID= %d, occupancy= %d, speed= %.2f m/s' % (busID + 1, snap['occupancy'][busID], snap['velocity'][busID]))
+            text.set_visible(bool(active[busID]))
+
+    use_video = output.lower().endswith(VIDEO_EXTENSIONS)
+    if use_video:
+        writer_name = 'pillow' if output.lower().endswith('.gif') else 'ffmpeg'
+        if not animation.writers.is_available(writer_name):
+            print('Animation writer %s is not available, writing frames instead' % writer_name)
+            use_video = False
+            output = os.path.splitext(output)[0]
+
+    if use_video:
+        writer = animation.writers[writer_name](fps=fps)
+        with writer.saving(fig, output, dpi):
+            while True:
+                snap = frame_queue.get()
+                if snap is None:
+                    break
+                update(snap)
+                writer.grab_frame()
+    else:
+        os.makedirs(output, exist_ok=True)
+        frame = 0
+        while True:
+            snap = frame_queue.get()
+            if snap is None:
+                break
+            update(snap)
+            fig.savefig(os.path.join(output, 'frame_%05d.png' % frame), dpi=dpi)
+            frame += 1
+    plt.close(fig)
+
+
+class SimAnimator:
+    '''
+    Streams snapshots of a running model to a separate rendering process
+
+    frame_every: only every n-th call to push() produces a frame (decimation)
+    max_queue: number of frames that can wait for the renderer
+    drop_frames: if True the simulation never waits for the renderer; frames
+        arriving while the queue is full are dropped, counted and reported with a warning
+    poll: seconds between two checks that the renderer is alive while waiting for it
+    '''
+    def __init__(self, model, output, frame_every=1, fps=30, dpi=100, max_queue=64, drop_frames=False, poll=1.0):
+        self.output = output
+        self.frame_every = max(int(frame_every), 1)
+        self.fps = fps
+        self.dpi = dpi
+        self.drop_frames = drop_frames
+        self.poll = poll
+        self.layout = {
+            'StopList': np.array(model.StopList, dtype=float),
+            'FleetSize': len(model.buses),
+            'RoadLength': model.NumberOfStop * model.LengthBetweenStop,
+        }
+        ctx = mp.get_context('spawn')
+        self.frame_queue = ctx.Queue(maxsize=max_queue)
+        self.process = ctx.Process(target=_render_worker, args=(self.frame_queue, self.layout, output, fps, dpi))
+        self.process.daemon = True
+        self.pushed = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def start(self):
+        self.process.start()
+        return self
+
+    def _check_renderer(self):
+        if not self.process.is_alive():
+            raise RuntimeError('The animation renderer has stopped (exit code %s), %s is incomplete'
+                               % (self.process.exitcode, self.output))
+
+    def _put(self, item):
+        # waits for a free place in the queue, as long as the renderer is alive
+        while True:
+            try:
+                self.frame_queue.put(item, timeout=self.poll)
+                return
+            except queue.Full:
+                self._check_renderer()
+
+    def push(self, model):
+        '''
+        Call this after every model.step()
+        '''
+        self.pushed += 1
+        if (self.pushed - 1) % self.frame_every != 0:
+            return
+        snap = snapshot(model)
+        if self.drop_frames:
+            try:
+                self.frame_queue.put_nowait(snap)
+            except queue.Full:
+                self.dropped += 1
+                return
+        else:
+            self._put(snap)
+        self.sent += 1
+
+    def close(self, timeout=None):
+        '''
+        Tell the renderer that there are no more frames and wait until the output is written.
+        Raises a RuntimeError if the renderer failed, or is still running after timeout seconds
+        '''
+        self._check_renderer()
+        self._put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            raise RuntimeError('The animation renderer has not finished %s after %s s' % (self.output, timeout))
+        if self.process.exitcode != 0:
+            raise RuntimeError('The animation renderer failed (exit code %s), %s is incomplete'
+                               % (self.process.exitcode, self.output))
+        if self.dropped > 0:
+            warnings.warn('Animation: %d frames written, %d dropped because the renderer was busy'
+                          % (self.sent, self.dropped))
+        return self.sent, self.dropped
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
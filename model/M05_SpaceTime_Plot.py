@@ -0,0 +1,171 @@
+"""
+Space-time diagrams for large fleets
+
+The trajectories are the (time x vehicle) arrays built in M03_CarSimDL with
+    x = np.array([bus.trajectory for bus in model.buses]).T
+Calling plt.plot(t, x) creates one Line2D per vehicle, which becomes very slow
+past a few thousand vehicles. Here the same arrays are drawn either as:
+
+1. spacetime_lines: a single LineCollection (one path per vehicle, only over the
+   time the vehicle is on the road)
+2. spacetime_heatmap: a rasterized density or speed map, where the binning of
+   all points is done with numpy (bincount) before anything is drawn
+3. spacetime_overlay: historical replications drawn as thin lines with the
+   real-time run on top, as in the do_spacetime_rep_plot figure
+"""
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+
+def mask_trajectories(x, road_length=None):
+    '''
+    Set positions before entering (<=0) and after leaving (>=road_length) the
+    road to NaN, as done before every space-time plot in M03
+    '''
+    x = np.array(x, dtype=float)
+    x[x <= 0] = np.nan
+    if road_length is not None:
+        x[x >= road_length] = np.nan
+    return x
+
+
+def valid_positions(x, road_length=None):
+    '''
+    Boolean mask of the same shape as x, True where the vehicle is on the road.
+    Unlike mask_trajectories this does not copy x
+    '''
+    with np.errstate(invalid='ignore'):
+        valid = x > 0
+        if road_length is not None:
+            valid &= x < road_length
+    return valid
+
+
+def _vehicle_paths(t, x, valid, every=1):
+    '''
+    Returns one (n,2) array of (time, position) per vehicle, covering only the
+    rows between the first and the last valid position of that vehicle
+    '''
+    has_data = valid.any(axis=0)
+    first = np.argmax(valid, axis=0)
+    last = x.shape[0] - 1 - np.argmax(valid[::-1], axis=0)
+    paths = []
+    for v in np.flatnonzero(has_data):
+        rows = slice(first[v], last[v] + 1, every)
+        path = np.column_stack((t[rows], x[rows, v]))
+        path[~valid[rows, v], 1] = np.nan
+        paths.append(path)
+    return paths
+
+
+def spacetime_lines(t, x, ax=None, road_length=None, every=1, color=None, linewidth=.5, linestyle='-', label=None, **kwargs):
+    '''
+    Draws all trajectories as one LineCollection
+
+    t: time of each row of x
+    x: positions, one column per vehicle (NaN or <=0 where the vehicle is not on the road)
+    every: only keep every n-th time step (for very long runs)
+    color: one colour for all vehicles; if None the default colour cycle is used
+        so it looks like plt.plot(t, x)
+    '''
+    if ax is None:
+        ax = plt.gca()
+    t = np.asarray(t, dtype=float)
+    x = np.asarray(x)
+    valid = valid_positions(x, road_length)
+    if color is None:
+        color = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    lines = LineCollection(_vehicle_paths(t, x, valid, every), colors=color, linewidths=linewidth, linestyles=linestyle, label=label, **kwargs)
+    ax.add_collection(lines)
+    ax.autoscale_view()
+    ax.set_ylabel('Distance (m)')
+    ax.set_xlabel('Time (s)')
+    return lines
+
+
+def spacetime_bins(t, x, dt_bin, dx_bin, road_length=None, quantity='density'):
+    '''
+    Bins all (time, position) points into a regular space-time grid with numpy
+
+    quantity = 'density': vehicles per km (time spent in the cell / cell area)
+    quantity = 'speed': mean speed in m/s (from the change of position between rows)
+    Returns the grid (positions x times) and the edges of the time and space bins
+    '''
+    t = np.asarray(t, dtype=float)
+    x = np.asarray(x)
+    valid = valid_positions(x, road_length)
+    if quantity == 'speed':
+        # a speed needs the vehicle to be on the road at two consecutive rows
+        valid = valid[:-1] & valid[1:]
+    rows, cols = np.nonzero(valid)
+    position = x[rows, cols]
+
+    if road_length is not None:
+        x_max = road_length
+    else:
+        # without any vehicle on the road the grid is a single band of empty cells
+        x_max = position.max() if position.size > 0 else dx_bin
+    t_edges = np.arange(t[0], t[-1] + dt_bin, dt_bin)
+    x_edges = np.arange(0, x_max + dx_bin, dx_bin)
+    nt = len(t_edges) - 1
+    nx = len(x_edges) - 1
+
+    t_index = np.minimum(((t[rows] - t[0]) // dt_bin).astype(np.int64), nt - 1)
+    x_index = np.minimum((position // dx_bin).astype(np.int64), nx - 1)
+    cell = x_index * nt + t_index
+    counts = np.bincount(cell, minlength=nx * nt).reshape(nx, nt).astype(float)
+
+    if quantity == 'density':
+        # each point stands for one simulation time step spent in the cell
+        step = np.median(np.diff(t)) if len(t) > 1 else 1.0
+        grid = counts * step / (dt_bin * dx_bin / 1000)
+    elif quantity == 'speed':
+        speed = (x[rows + 1, cols] - position) / (t[rows + 1] - t[rows])
+        sums = np.bincount(cell, weights=speed, minlength=nx * nt).reshape(nx, nt)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            grid = sums / counts
+    else:
+        raise ValueError("quantity must be 'density' or 'speed'")
+    return grid, t_edges, x_edges
+
+
+def spacetime_heatmap(t, x, ax=None, road_length=None, dt_bin=60, dx_bin=100, quantity='density', cmap=None, colorbar=True, **kwargs):
+    '''
+    Draws a rasterized density or speed map of the trajectories
+    '''
+    if ax is None:
+        ax = plt.gca()
+    grid, t_edges, x_edges = spacetime_bins(t, x, dt_bin, dx_bin, road_length, quantity)
+    if cmap is None:
+        cmap = 'viridis' if quantity == 'density' else 'RdYlGn'
+    image = ax.imshow(grid, origin='lower', aspect='auto', interpolation='nearest', cmap=cmap,
+                      extent=(t_edges[0], t_edges[-1], x_edges[0], x_edges[-1]), **kwargs)
+    image.set_rasterized(True)
+    if colorbar:
+        cbar = plt.colorbar(image, ax=ax)
+        cbar.set_label('Density (veh/km)' if quantity == 'density' else 'Speed (m/s)')
+    ax.set_ylabel('Distance (m)')
+    ax.set_xlabel('Time (s)')
+    return image
+
+
+def spacetime_overlay(t, historical, realtime, ax=None, road_length=None, every=1,
+                      historical_color='r', realtime_color='black', labels=('Historical', 'Real-time')):
+    '''
+    Overlays several historical replications (thin lines) with a real-time run (thick line)
+
+    historical: list of position arrays (one per replication), or a single array
+    realtime: position array of the real-time run
+    '''
+    if ax is None:
+        ax = plt.gca()
+    if isinstance(historical, np.ndarray) and historical.ndim == 2:
+        historical = [historical]
+    for x in historical:
+        spacetime_lines(t, x, ax, road_length, every, color=historical_color, linewidth=.5)
+    spacetime_lines(t, realtime, ax, road_length, every, color=realtime_color, linewidth=2)
+    ax.plot([], [], color=historical_color, linestyle='-', linewidth=.5, label=labels[0])
+    ax.plot([], [], color=realtime_color, linestyle='-', linewidth=2, label=labels[1])
+    ax.legend()
+    return ax
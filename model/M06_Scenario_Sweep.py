@@ -0,0 +1,223 @@
+"""
+Parallel, resumable scenario sweeps for the simulation in M03_CarSimDL
+
+A sweep runs the model for every combination of a parameter grid, several
+replications each. Every (setting, replication) pair is one task; tasks are run
+on a process pool and the results are written by the main process into one
+SQLite file, compressed with zlib. A task is only marked as completed in the
+same transaction that stores its results, so after a crash the same call simply
+carries on with the tasks that are missing.
+
+The grid can vary any key of model_params, and also the other arguments of
+Model (TrafficSpeed, IncreaseRate). Example:
+
+    scenario = {'model_params': model_params, 'TrafficSpeed': 14,
+                'ArrivalRate': ArrivalRate, 'DepartureRate': DepartureRate,
+                'IncreaseRate': 1}
+    store = run_sweep('Historical_data.sqlite', scenario,
+                      {'IncreaseRate': range(11, 21)}, NumReps=20)
+    for setting_id, setting in store.settings().items():
+        meanGPS, stdGPS = store.mean_std(setting_id)
+
+Only the requested setting is read from disk when loading.
+"""
+import itertools
+import json
+import sqlite3
+import zlib
+import multiprocessing as mp
+
+import numpy as np
+
+MODEL_ARGS = ('TrafficSpeed', 'IncreaseRate')
+
+
+def expand_grid(grid):
+    '''
+    Turns {'key': [values], ...} into a list of settings, one dict per combination
+    '''
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[list(grid[k]) for k in keys])]
+
+
+def _to_json(setting):
+    # numpy scalars are not JSON serializable
+    return json.dumps({k: (v.item() if isinstance(v, np.generic) else v) for k, v in setting.items()}, sort_keys=True)
+
+
+class SweepStore:
+    '''
+    One SQLite file holding the settings of a sweep and the arrays produced by each task
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS settings (setting_id INTEGER PRIMARY KEY, params TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS results (setting_id INTEGER, rep INTEGER, name TEXT,
+                dtype TEXT, shape TEXT, data BLOB, PRIMARY KEY (setting_id, rep, name));
+            CREATE TABLE IF NOT EXISTS completed (setting_id INTEGER, rep INTEGER, seconds REAL,
+                PRIMARY KEY (setting_id, rep));
+        ''')
+        self.conn.commit()
+
+    def add_settings(self, settings):
+        '''
+        Registers the settings (if not already there) and returns their ids
+        '''
+        ids = []
+        for setting in settings:
+            params = _to_json(setting)
+            self.conn.execute('INSERT OR IGNORE INTO settings (params) VALUES (?)', (params,))
+            ids.append(self.conn.execute('SELECT setting_id FROM settings WHERE params = ?', (params,)).fetchone()[0])
+        self.conn.commit()
+        return ids
+
+    def settings(self):
+        return {setting_id: json.loads(params) for setting_id, params in
+                self.conn.execute('SELECT setting_id, params FROM settings ORDER BY setting_id')}
+
+    def completed(self):
+        return set(self.conn.execute('SELECT setting_id, rep FROM completed'))
+
+    def write(self, setting_id, rep, arrays, seconds=0.0):
+        '''
+        Stores the arrays of one task and marks it as completed, in one transaction
+        '''
+        with self.conn:
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                self.conn.execute('INSERT OR REPLACE INTO results VALUES (?,?,?,?,?,?)',
+                                  (setting_id, rep, name, array.dtype.str, json.dumps(array.shape),
+                                   zlib.compress(array.tobytes(), 6)))
+            self.conn.execute('INSERT OR REPLACE INTO completed VALUES (?,?,?)', (setting_id, rep, seconds))
+
+    def reps(self, setting_id):
+        return [r for r, in self.conn.execute('SELECT rep FROM completed WHERE setting_id = ? ORDER BY rep', (setting_id,))]
+
+    def iter_reps(self, setting_id, name='trajectory'):
+        '''
+        Yields (rep, array) one replication at a time
+        '''
+        cursor = self.conn.execute('SELECT rep, dtype, shape, data FROM results WHERE setting_id = ? AND name = ? ORDER BY rep',
+                                   (setting_id, name))
+        for rep, dtype, shape, data in cursor:
+            yield rep, np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(json.loads(shape))
+
+    def load(self, setting_id, name='trajectory', rep=None):
+        '''
+        Returns one replication if rep is given, otherwise all replications stacked on the first axis
+        '''
+        if rep is not None:
+            row = self.conn.execute('SELECT dtype, shape, data FROM results WHERE setting_id = ? AND rep = ? AND name = ?',
+                                    (setting_id, rep, name)).fetchone()
+            if row is None:
+                raise KeyError('No %s stored for setting %d, replication %d' % (name, setting_id, rep))
+            dtype, shape, data = row
+            return np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(json.loads(shape))
+        return np.stack([array for _, array in self.iter_reps(setting_id, name)])
+
+    def mean_std(self, setting_id, name='trajectory'):
+        '''
+        Mean and standard deviation over the replications, computed one replication at a time
+        '''
+        n = 0
+        for _, array in self.iter_reps(setting_id, name):
+            if n == 0:
+                total = np.zeros(array.shape)
+                total_sq = np.zeros(array.shape)
+            total += array
+            total_sq += np.square(array, dtype=float)
+            n += 1
+        if n == 0:
+            raise KeyError('No %s stored for setting %d' % (name, setting_id))
+        mean = total / n
+        return mean, np.sqrt(np.maximum(total_sq / n - mean ** 2, 0))
+
+    def close(self):
+        self.conn.close()
+
+
+def simulate(scenario, setting, seed, outputs=('trajectory',)):
+    '''
+    Runs one replication of the model for a setting and returns the requested arrays:
+        trajectory: positions (time x bus), as returned by run_model with do_reps
+        groundtruth: [status, position, velocity, occupancy] of every bus (time x 4*bus)
+    '''
+    from model.M03_CarSimDL import Model
+
+    model_params = dict(scenario['model_params'])
+    args = {k: scenario[k] for k in MODEL_ARGS}
+    for key, value in setting.items():
+        if key in MODEL_ARGS:
+            args[key] = value
+        else:
+            model_params[key] = value
+    np.random.seed(seed)
+    model = Model(model_params, args['TrafficSpeed'], np.array(scenario['ArrivalRate'], dtype=float),
+                  np.array(scenario['DepartureRate'], dtype=float), args['IncreaseRate'])
+    for time_step in range(int(model.EndTime / model.dt)):
+        model.step()
+    return model_outputs(model, outputs)
+
+
+def model_outputs(model, outputs=('trajectory',)):
+    '''
+    Arrays recorded by a model run (see simulate)
+    '''
+    arrays = {}
+    if 'trajectory' in outputs:
+        GPS = np.array([bus.trajectory for bus in model.buses], dtype=float).T
+        GPS[GPS < 0] = 0
+        arrays['trajectory'] = GPS
+    if 'groundtruth' in outputs:
+        GroundTruth = np.hstack([np.array(bus.groundtruth, dtype=float) for bus in model.buses])
+        GroundTruth[GroundTruth < 0] = 0
+        arrays['groundtruth'] = GroundTruth
+    return arrays
+
+
+def _run_task(task):
+    import time
+    setting_id, rep, scenario, setting, seed, outputs = task
+    start = time.time()
+    arrays = simulate(scenario, setting, seed, outputs)
+    return setting_id, rep, arrays, time.time() - start
+
+
+def run_sweep(store_path, scenario, grid, NumReps=1, processes=None, seed=0, outputs=('trajectory',), verbose=True):
+    '''
+    Runs every (setting, replication) of the grid that is not yet in the store
+
+    scenario: the base arguments of Model (model_params, TrafficSpeed, ArrivalRate,
+        DepartureRate, IncreaseRate)
+    grid: {'key': [values]} over model_params keys or TrafficSpeed/IncreaseRate
+    seed: the replication r of setting s is always run with the seed [seed, s, r],
+        so resumed sweeps give the same results as uninterrupted ones
+    processes: size of the process pool (None: number of cores, 1: no pool)
+    '''
+    store = SweepStore(store_path)
+    settings = expand_grid(grid)
+    setting_ids = store.add_settings(settings)
+    done = store.completed()
+    tasks = [(setting_id, rep, scenario, setting, [seed, setting_id, rep], outputs)
+             for setting_id, setting in zip(setting_ids, settings)
+             for rep in range(NumReps) if (setting_id, rep) not in done]
+    if verbose:
+        print('Sweep: %d tasks, %d already completed' % (len(settings) * NumReps, len(settings) * NumReps - len(tasks)))
+
+    if processes == 1 or len(tasks) <= 1:
+        results = map(_run_task, tasks)
+        pool = None
+    else:
+        pool = mp.Pool(processes)
+        results = pool.imap_unordered(_run_task, tasks)
+    try:
+        for n, (setting_id, rep, arrays, seconds) in enumerate(results):
+            store.write(setting_id, rep, arrays, seconds)
+            if verbose:
+                print('task %d/%d: setting %d, replication %d (%.1f s)' % (n + 1, len(tasks), setting_id, rep, seconds))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return store
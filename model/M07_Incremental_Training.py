@@ -0,0 +1,219 @@
+"""
+Incremental (warm-start) training of the deep car-following model of M01
+
+Instead of retraining from scratch on the whole Car_following_df.csv whenever new
+highD recordings are processed, a new model version is obtained by:
+
+1. loading the weights of the previous version and its scaler statistics
+   (the scaler is not refit, so the inputs keep the meaning the weights learnt)
+2. fine-tuning on the newly extracted rows only, mixed with a replay buffer of
+   rows sampled from the data seen so far (to avoid forgetting the old data)
+3. updating the replay buffer with the new rows by reservoir sampling, so it
+   stays a uniform sample of all the data seen, with a fixed size
+4. recording the version in a lineage file (parent version, data files, number of
+   rows, test errors)
+
+So the cost of an update depends on the size of the new data and of the buffer,
+not on the size of the whole history.
+
+All the files of a model live in one folder (model_dir):
+    car_following_vN.h5        weights of version N
+    scaler_vN.npz              min/max of each column used by the MinMaxScaler
+    replay_buffer.npz          scaled rows of the replay buffer and number of rows seen
+    lineage.json               one entry per version
+
+M01_Deep_Car_Following_Model saves version 0 with save_version().
+
+tensorflow and sklearn are imported by the functions that use them, so the lineage
+and the replay buffer can be read without them.
+"""
+import os
+import json
+import time
+
+import numpy as np
+
+from model.M17_Lean_Dataset import load_dataset, minmax_scaler, scale_in_place
+
+LINEAGE_FILE = 'lineage.json'
+BUFFER_FILE = 'replay_buffer.npz'
+
+
+def split_features(dataset):
+    '''
+    Same columns as in M01: features are dataset[:,7:-2], the label is the acceleration (last column)
+    '''
+    return dataset[:, 7:-2], dataset[:, -1]
+
+
+def save_scaler(scaler, path):
+    np.savez(path, data_min=scaler.data_min_, data_max=scaler.data_max_, feature_range=np.array(scaler.feature_range))
+
+
+def load_scaler(path):
+    '''
+    Rebuilds a fitted MinMaxScaler from the statistics saved by save_scaler
+    '''
+    stats = np.load(path)
+    return minmax_scaler(stats['data_min'], stats['data_max'], tuple(stats['feature_range']))
+
+
+def read_lineage(model_dir):
+    path = os.path.join(model_dir, LINEAGE_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_lineage(model_dir, lineage):
+    path = os.path.join(model_dir, LINEAGE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(lineage, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def update_replay_buffer(model_dir, rows, buffer_size, rng=None, index=None):
+    '''
+    Reservoir sampling: after the update, the buffer is a uniform sample (without
+    replacement) of all the rows passed so far, of at most buffer_size rows
+
+    index: if given, the rows passed are rows[index]; only the rows kept are gathered
+    '''
+    if rng is None:
+        rng = np.random.default_rng()
+    if index is None:
+        index = np.arange(len(rows))
+    path = os.path.join(model_dir, BUFFER_FILE)
+    if os.path.exists(path):
+        saved = np.load(path)
+        buffer, n_seen = saved['rows'], int(saved['n_seen'])
+    else:
+        buffer, n_seen = np.empty((0, rows.shape[1]), dtype=rows.dtype), 0
+
+    # fill the buffer first
+    n_fill = min(buffer_size - len(buffer), len(index))
+    buffer = np.vstack([buffer, rows[index[:n_fill]]])
+    # then each next row i (the n-th row seen) replaces a random slot with probability buffer_size/n
+    rest = index[n_fill:]
+    if len(rest) > 0:
+        n = n_seen + n_fill + np.arange(1, len(rest) + 1)
+        slot = (rng.random(len(rest)) * n).astype(np.int64)
+        keep = np.flatnonzero(slot < buffer_size)
+        # when several rows hit the same slot the last one wins, as in the sequential algorithm
+        slots, last = np.unique(slot[keep][::-1], return_index=True)
+        buffer[slots] = rows[rest[keep[::-1][last]]]
+    n_seen += len(index)
+    np.savez(path, rows=buffer, n_seen=n_seen)
+    return buffer, n_seen
+
+
+def save_version(model, scaler, model_dir, scaled_rows, info=None, parent=None, buffer_size=50000, index=None):
+    '''
+    Saves a model version (weights, scaler, lineage entry) and adds the scaled rows
+    it has been trained on (scaled_rows[index] if index is given) to the replay buffer
+    '''
+    os.makedirs(model_dir, exist_ok=True)
+    lineage = read_lineage(model_dir)
+    version = 0 if len(lineage) == 0 else lineage[-1]['version'] + 1
+    weights = 'car_following_v%d.h5' % version
+    scaler_name = 'scaler_v%d.npz' % version
+    model.save(os.path.join(model_dir, weights))
+    save_scaler(scaler, os.path.join(model_dir, scaler_name))
+    _, n_seen = update_replay_buffer(model_dir, scaled_rows, buffer_size, index=index)
+    entry = {
+        'version': version,
+        'parent': parent,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'weights': weights,
+        'scaler': scaler_name,
+        'rows_seen': n_seen,
+    }
+    if info is not None:
+        entry.update(info)
+    lineage.append(entry)
+    _write_lineage(model_dir, lineage)
+    return entry
+
+
+def load_version(model_dir, version=None):
+    '''
+    Loads a model version (the latest if version is None) and its scaler
+    '''
+    import tensorflow.keras
+    lineage = read_lineage(model_dir)
+    if len(lineage) == 0:
+        raise FileNotFoundError('No model version saved in ' + model_dir)
+    if version is None:
+        entry = lineage[-1]
+    else:
+        entries = [e for e in lineage if e['version'] == version]
+        if len(entries) == 0:
+            raise KeyError('no version %d in %s' % (version, model_dir))
+        entry = entries[0]
+    model = tensorflow.keras.models.load_model(os.path.join(model_dir, entry['weights']), compile=False)
+    scaler = load_scaler(os.path.join(model_dir, entry['scaler']))
+    return model, scaler, entry
+
+
+def incremental_update(model_dir, new_files, replay_ratio=1.0, epochs=20, learning_rate=1e-4,
+                       buffer_size=50000, test_size=0.25, random_state=42):
+    '''
+    Fine-tunes the latest model version on newly extracted recordings
+
+    new_files: list of Car_following_df.csv files produced by A01 for the new recordings only
+    replay_ratio: number of replayed old rows per new row (capped by the buffer size)
+    Returns the lineage entry of the new version
+    '''
+    import tensorflow.keras
+    from sklearn.model_selection import train_test_split
+    model, scaler, parent = load_version(model_dir)
+    # float32, scaled in place (the scaler is not refit)
+    new_data = [load_dataset(f) for f in new_files]
+    new_data = new_data[0] if len(new_data) == 1 else np.concatenate(new_data)
+    scale_in_place(new_data, scaler)
+    outside = np.mean((new_data < 0) | (new_data > 1))
+    if outside > 0:
+        print('%.2f%% of the new values are outside the range of the saved scaler' % (100 * outside))
+
+    # the test rows of the new data are never used for training
+    train_index, test_index = train_test_split(np.arange(len(new_data)), test_size=test_size, random_state=random_state)
+    train_rows = new_data[train_index]
+
+    saved = np.load(os.path.join(model_dir, BUFFER_FILE))
+    buffer = saved['rows']
+    rng = np.random.default_rng(random_state)
+    n_replay = min(len(buffer), int(replay_ratio * len(train_rows)))
+    replay_rows = buffer[rng.choice(len(buffer), n_replay, replace=False)]
+
+    # shuffle before fit, so that validation_split does not only take replayed rows
+    train_features, train_labels = split_features(rng.permutation(np.vstack([train_rows, replay_rows])))
+    test_features, test_labels = split_features(new_data[test_index])
+
+    model.compile(loss='mse',
+                  optimizer=tensorflow.keras.optimizers.Adam(learning_rate=learning_rate),
+                  metrics=['mae', 'mse'])
+    early_stop = tensorflow.keras.callbacks.EarlyStopping(monitor='val_loss', patience=5, restore_best_weights=True)
+    start = time.time()
+    history = model.fit(train_features, train_labels, epochs=epochs, validation_split=0.2,
+                        shuffle=True, verbose=0, callbacks=[early_stop])
+    _, mae, mse = model.evaluate(test_features, test_labels, verbose=0)
+
+    info = {
+        'new_files': [os.path.abspath(f) for f in new_files],
+        'new_rows': int(len(new_data)),
+        'replay_rows': int(n_replay),
+        'epochs': len(history.epoch),
+        'training_seconds': round(time.time() - start, 2),
+        'test_mae': float(mae),
+        'test_mse': float(mse),
+    }
+    # only the training rows of the new data go into the replay buffer
+    return save_version(model, scaler, model_dir, train_rows, info, parent=parent['version'], buffer_size=buffer_size)
+
+
+if __name__ == '__main__':
+    import sys
+    # usage: python -m model.M07_Incremental_Training model_dir new_Car_following_df.csv [more files]
+    entry = incremental_update(sys.argv[1], sys.argv[2:])
+    print('New model version %d (parent %d): test MAE %.4f' % (entry['version'], entry['parent'], entry['test_mae']))
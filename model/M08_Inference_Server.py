@@ -0,0 +1,302 @@
+"""
+Local inference server for the car-following (M01) and lane-changing (M02) models
+
+One server process loads the models once; simulators (e.g. several M03 processes)
+send it rows of features through a Unix socket or a localhost TCP port, and get
+back accelerations and lane-change probabilities. Requests arriving at the same
+time from different clients are put together into one micro-batch, so each model
+is called once per batch instead of once per request. A batch is sent to the
+models as soon as it has max_batch rows, or when the oldest request in it has
+waited max_wait seconds (the latency budget).
+
+The rows are the unscaled features used by M01/M02 (the columns [7:-2] of
+Car_following_df.csv); the server scales them with the saved scaler statistics
+of each model (the M01 version, and the scaler saved next to the M02 forest)
+and returns the acceleration in m/s2.
+
+Server:
+    python -m model.M08_Inference_Server model_dir [forest.pkl] [address]
+    or start_server(model_dir, forest_path, address) from python
+    (serve/start_server take a surrogate_path to answer the rows without
+    surrounding vehicles from the M15_Surrogate_Table lookup table)
+
+Predictive distributions (Monte Carlo dropout, see M21_MC_Dropout):
+    ModelPredictor(model_dir).predict_distribution(rows, samples=50)
+
+Client:
+    client = InferenceClient(address)
+    result = client.predict(rows)     # {'acceleration': ..., 'lane_change': ...}
+    client.stats()                    # queue depth, batch size and latency histograms
+"""
+import pickle
+import queue
+import threading
+import time
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+DEFAULT_ADDRESS = ('localhost', 6010)
+AUTHKEY = b'car-following'
+FEATURES = slice(7, -2)
+
+
+class Histogram:
+    '''
+    Thread-safe histogram with fixed bin edges (values above the last edge go in the last bin)
+    '''
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros(len(self.edges), dtype=np.int64)
+        self.total = 0.0
+        self.n = 0
+        self.lock = threading.Lock()
+
+    def add(self, values):
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        index = np.minimum(np.searchsorted(self.edges, values, side='right') - 1, len(self.edges) - 1)
+        with self.lock:
+            np.add.at(self.counts, np.maximum(index, 0), 1)
+            self.total += values.sum()
+            self.n += len(values)
+
+    def summary(self):
+        with self.lock:
+            return {'edges': self.edges.tolist(), 'counts': self.counts.tolist(), 'n': self.n,
+                    'mean': float(self.total / self.n) if self.n > 0 else None}
+
+
+class ModelPredictor:
+    '''
+    Wraps the loaded models and the scaling of the features
+    '''
+    def __init__(self, model_dir, forest_path=None, version=None, surrogate_path=None):
+        from model.M07_Incremental_Training import load_version
+        self.model, self.scaler, self.entry = load_version(model_dir, version)
+        self.scale = self.scaler.scale_[FEATURES]
+        self.offset = self.scaler.min_[FEATURES]
+        self.forest = None
+        if forest_path is not None:
+            from model.M10_Lane_Change_Training import load_scaler
+            with open(forest_path, 'rb') as f:
+                self.forest = pickle.load(f)
+            # the forest is trained on rows scaled by the scaler of M02, not the one of M01
+            forest_scaler = load_scaler(forest_path)
+            if forest_scaler is None:
+                print('No scaler saved with %s: its features are scaled with the scaler of the network' % forest_path)
+                forest_scaler = self.scaler
+            self.forest_scale = forest_scaler.scale_[FEATURES]
+            self.forest_offset = forest_scaler.min_[FEATURES]
+        # lookup table answering the rows without surrounding vehicles (see M15_Surrogate_Table)
+        self.surrogate = None
+        if surrogate_path is not None:
+            from model.M15_Surrogate_Table import SurrogateTable
+            self.surrogate = SurrogateTable.load(surrogate_path)
+        # built at the first predict_distribution
+        self.mc_dropout = None
+
+    def predict(self, rows):
+        features = rows * self.scale + self.offset
+        result = {}
+        acceleration = np.empty(len(rows))
+        network = np.ones(len(rows), dtype=bool)
+        if self.surrogate is not None:
+            table, usable = self.surrogate.predict(rows)
+            acceleration[usable] = table[usable]
+            network = ~usable
+        if network.any():
+            # calling the model directly is faster than model.predict for small batches
+            scaled_acceleration = np.asarray(self.model(features[network].astype(np.float32), training=False)).ravel()
+            acceleration[network] = (scaled_acceleration - self.scaler.min_[-1]) / self.scaler.scale_[-1]
+        result['acceleration'] = acceleration
+        if self.forest is not None:
+            result['lane_change'] = self.forest.predict_proba(rows * self.forest_scale + self.forest_offset)[:, 1]
+        return result
+
+    def predict_distribution(self, rows, samples=30, quantiles=(0.05, 0.5, 0.95), seed=None, keep_samples=False):
+        '''
+        Mean, variance and quantiles (in m/s2) of samples accelerations per row, each with a
+        new dropout mask of the network, evaluated in one batch (the surrogate is not used)
+        '''
+        from model.M21_MC_Dropout import MCDropout, summarize
+        if self.mc_dropout is None:
+            self.mc_dropout = MCDropout(self.model)
+        features = rows * self.scale + self.offset
+        scaled = self.mc_dropout.sample(features, samples, seed)
+        accelerations = (scaled - self.scaler.min_[-1]) / self.scaler.scale_[-1]
+        result = summarize(accelerations, quantiles)
+        if keep_samples:
+            result['samples'] = accelerations
+        return result
+
+
+class InferenceServer:
+    '''
+    Accepts connections, coalesces the requests into micro-batches and sends back the results
+    '''
+    def __init__(self, predictor, address=DEFAULT_ADDRESS, authkey=AUTHKEY, max_batch=4096, max_wait=0.002):
+        self.predictor = predictor
+        self.address = address
+        self.authkey = authkey
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.running = True
+        self.queue_depth = Histogram([0, 1, 2, 4, 8, 16, 32, 64, 128, 256])
+        self.batch_rows = Histogram([0, 1, 10, 100, 1000, 10000, 100000])
+        self.batch_requests = Histogram([1, 2, 4, 8, 16, 32, 64, 128])
+        self.latency = Histogram([0, 1e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 1e-1, 1])
+
+    def stats(self):
+        return {'queue_depth_now': self.requests.qsize(), 'queue_depth': self.queue_depth.summary(),
+                'batch_rows': self.batch_rows.summary(), 'batch_requests': self.batch_requests.summary(),
+                'latency_seconds': self.latency.summary()}
+
+    def _handle_connection(self, conn):
+        # one thread per client; the replies are sent by the batching thread
+        send_lock = threading.Lock()
+        try:
+            while self.running:
+                message = conn.recv()
+                if message['op'] == 'predict':
+                    rows = np.atleast_2d(np.asarray(message['rows'], dtype=float))
+                    self.queue_depth.add(self.requests.qsize())
+                    self.requests.put((time.perf_counter(), message.get('id'), rows, conn, send_lock))
+                elif message['op'] == 'stats':
+                    with send_lock:
+                        conn.send({'id': message.get('id'), 'stats': self.stats()})
+                elif message['op'] == 'close':
+                    break
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            conn.close()
+
+    def _next_batch(self):
+        first = self.requests.get()
+        batch = [first]
+        n_rows = len(first[2])
+        deadline = first[0] + self.max_wait
+        while n_rows < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            n_rows += len(item[2])
+        return batch
+
+    def _batch_loop(self):
+        while self.running:
+            batch = self._next_batch()
+            rows = np.vstack([item[2] for item in batch])
+            try:
+                result = self.predictor.predict(rows)
+            except Exception as error:
+                # a bad batch must not stop the server: every request in it gets the error back
+                result = None
+                message = '%s: %s' % (type(error).__name__, error)
+            self.batch_rows.add(len(rows))
+            self.batch_requests.add(len(batch))
+            start = 0
+            now = time.perf_counter()
+            for received, request_id, request_rows, conn, send_lock in batch:
+                end = start + len(request_rows)
+                if result is None:
+                    reply = {'error': message}
+                else:
+                    reply = {key: value[start:end] for key, value in result.items()}
+                reply['id'] = request_id
+                start = end
+                try:
+                    with send_lock:
+                        conn.send(reply)
+                except (OSError, ConnectionError):
+                    pass
+                self.latency.add(now - received)
+
+    def serve_forever(self):
+        batcher = threading.Thread(target=self._batch_loop, daemon=True)
+        batcher.start()
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print('Inference server listening on', listener.address)
+            while self.running:
+                try:
+                    conn = listener.accept()
+                except (OSError, mp.AuthenticationError):
+                    continue
+                threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+
+def serve(model_dir, forest_path=None, address=DEFAULT_ADDRESS, max_batch=4096, max_wait=0.002, surrogate_path=None):
+    predictor = ModelPredictor(model_dir, forest_path, surrogate_path=surrogate_path)
+    InferenceServer(predictor, address, max_batch=max_batch, max_wait=max_wait).serve_forever()
+
+
+def start_server(model_dir, forest_path=None, address=DEFAULT_ADDRESS, max_batch=4096, max_wait=0.002, timeout=60,
+                 surrogate_path=None):
+    '''
+    Starts the server in a separate process and waits until it accepts connections
+    '''
+    process = mp.get_context('spawn').Process(target=serve, args=(model_dir, forest_path, address, max_batch, max_wait,
+                                                                  surrogate_path), daemon=True)
+    process.start()
+    start = time.time()
+    while True:
+        try:
+            InferenceClient(address).close()
+            return process
+        except (OSError, ConnectionError):
+            if not process.is_alive() or time.time() - start > timeout:
+                raise RuntimeError('The inference server did not start')
+            time.sleep(0.2)
+
+
+class InferenceClient:
+    '''
+    Blocking client: one request at a time per client (use one client per thread/process)
+    '''
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=AUTHKEY):
+        self.conn = Client(address, authkey=authkey)
+        self.next_id = 0
+
+    def _call(self, message):
+        self.next_id += 1
+        message['id'] = self.next_id
+        self.conn.send(message)
+        return self.conn.recv()
+
+    def predict(self, rows):
+        reply = self._call({'op': 'predict', 'rows': np.asarray(rows, dtype=float)})
+        reply.pop('id')
+        if 'error' in reply:
+            raise RuntimeError('Inference server error: ' + reply['error'])
+        return reply
+
+    def stats(self):
+        return self._call({'op': 'stats'})['stats']
+
+    def close(self):
+        try:
+            self.conn.send({'op': 'close'})
+        except (OSError, ConnectionError):
+            pass
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+if __name__ == '__main__':
+    import sys
+    # usage: python -m model.M08_Inference_Server model_dir [forest.pkl] [unix socket path or port]
+    forest_path = sys.argv[2] if len(sys.argv) > 2 else None
+    address = DEFAULT_ADDRESS
+    if len(sys.argv) > 3:
+        address = ('localhost', int(sys.argv[3])) if sys.argv[3].isdigit() else sys.argv[3]
+    serve(sys.argv[1], forest_path, address)
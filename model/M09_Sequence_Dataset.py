@@ -0,0 +1,180 @@
+"""
+Windowed sequence dataset for recurrent (LSTM) car-following models
+
+The LSTM notebook builds its inputs with create_dataset, appending one window at a
+time, and Stage B of A01 writes three lagged copies of every dynamic line. Here the
+per-vehicle time series (the Stage A output, Car_following_df_raw.csv) is kept once
+in memory; the (look_back, n_dynamic) windows are numpy strided views on it and a
+window is only copied when it is put into a batch.
+
+    data = load_stage_a(prject_path + "data/Car_following_df_raw.csv")
+    train_vehicles, test_vehicles = vehicle_split(data, test_size=0.25)
+    train = WindowedSequence(data, dynamic_index, static_index, target_index, look_back=3, vehicles=train_vehicles)
+    model.fit(train, epochs=...)
+
+Windows never cross from one vehicle to the next, and the batches are made of the
+windows of consecutive vehicles (the order of the vehicles is shuffled each epoch).
+
+RowSequence gives batches of rows of one array (e.g. the float32 Car_following_df.csv
+of M17_Lean_Dataset) selected by an index array, for the dense model of M01.
+
+The two classes are keras Sequences: they are only built (and tensorflow only
+imported) the first time they are used, so vehicle_bounds, vehicle_split and
+load_stage_a can be imported without tensorflow.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# columns of the Stage A output of A01 (see the METADATA comment there)
+VEHICLE_INDEX = 0
+STATIC_INDEX = [2,3,4,5,6,7,8,9]
+DYNAMIC_INDEX = list(range(10,29))
+LANE_INDEX = 29
+TARGET_INDEX = 30
+
+
+def load_stage_a(filename, dtype=np.float32):
+    import pandas as pd
+    return pd.read_csv(filename, header=None, dtype=dtype).values
+
+
+def vehicle_bounds(data):
+    '''
+    First line and end line of each vehicle (the lines of a vehicle are next to each other)
+    '''
+    vehicle = data[:, VEHICLE_INDEX]
+    starts = np.flatnonzero(np.r_[True, vehicle[1:] != vehicle[:-1]])
+    ends = np.r_[starts[1:], len(vehicle)]
+    return vehicle[starts], starts, ends
+
+
+def vehicle_split(data, test_size=0.25, random_state=42):
+    '''
+    Splits the vehicles (not the lines) into training and testing sets
+    '''
+    vehicles, _, _ = vehicle_bounds(data)
+    rng = np.random.default_rng(random_state)
+    vehicles = rng.permutation(vehicles)
+    n_test = int(round(len(vehicles) * test_size))
+    return np.sort(vehicles[n_test:]), np.sort(vehicles[:n_test])
+
+
+class _WindowedBatches:
+    '''
+    Batches of ([dynamic windows, static features], target) for Keras
+
+    look_back: number of lines in each window
+    lag: number of lines between two lines of the window (e.g. 25 to keep 1 s steps on 25 Hz data)
+    horizon: number of lines between the last line of the window and the target line
+        (default lag, i.e. the next step, as in Stage B)
+    flat: if True the inputs are one array [static, window line 1, ..., window line look_back]
+        as in the Car_following_df.csv made by Stage B, for dense models
+    '''
+    def __init__(self, data, dynamic_index=DYNAMIC_INDEX, static_index=STATIC_INDEX, target_index=TARGET_INDEX,
+                 look_back=3, lag=1, horizon=None, vehicles=None, batch_size=256, shuffle=True, flat=False, seed=0, **kwargs):
+        super().__init__(**kwargs)
+        self.data = data
+        self.dynamic_index = np.asarray(dynamic_index)
+        self.static_index = np.asarray(static_index)
+        self.target_index = target_index
+        self.look_back = look_back
+        self.lag = lag
+        self.horizon = lag if horizon is None else horizon
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.flat = flat
+        self.rng = np.random.default_rng(seed)
+
+        span = (look_back - 1) * lag + 1
+        # view of shape (lines, columns, look_back): no data is copied
+        self.windows = sliding_window_view(data, span, axis=0)[:, :, ::lag]
+        self.target_offset = span - 1 + self.horizon
+
+        # start line of every valid window, grouped by vehicle
+        ids, starts, ends = vehicle_bounds(data)
+        if vehicles is not None:
+            keep = np.isin(ids, vehicles)
+            ids, starts, ends = ids[keep], starts[keep], ends[keep]
+        counts = np.maximum(ends - starts - self.target_offset, 0)
+        self.vehicle_starts = [np.arange(s, s + n) for s, n in zip(starts, counts) if n > 0]
+        self.n_windows = int(counts.sum())
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(self.n_windows / self.batch_size))
+
+    def on_epoch_end(self):
+        order = self.rng.permutation(len(self.vehicle_starts)) if self.shuffle else np.arange(len(self.vehicle_starts))
+        self.order = np.concatenate([self.vehicle_starts[v] for v in order]) if len(order) > 0 else np.array([], dtype=int)
+
+    def window_batch(self, starts):
+        '''
+        Copies the windows starting at the given lines: (batch, look_back, n_dynamic)
+        '''
+        return np.transpose(self.windows[starts][:, self.dynamic_index, :], (0, 2, 1))
+
+    def __getitem__(self, index):
+        starts = self.order[index * self.batch_size:(index + 1) * self.batch_size]
+        dynamic = self.window_batch(starts)
+        static = self.data[starts][:, self.static_index]
+        target = self.data[starts + self.target_offset, self.target_index]
+        if self.flat:
+            return np.hstack([static, dynamic.reshape(len(starts), -1)]), target
+        return (dynamic, static), target
+
+
+class _RowBatches:
+    '''
+    Batches (data[rows, feature_columns], data[rows, label_column]) of the rows in index,
+    gathered from one shared array for each batch, so the training rows are never copied all at once
+    (as in M01, where data is the scaled Car_following_df.csv)
+    '''
+    def __init__(self, data, index, feature_columns=slice(7, -2), label_column=-1, batch_size=32, shuffle=True,
+                 seed=0, **kwargs):
+        super().__init__(**kwargs)
+        self.data = data
+        self.index = np.asarray(index)
+        self.feature_columns = feature_columns
+        self.label_column = label_column
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.index) / self.batch_size))
+
+    def on_epoch_end(self):
+        self.order = self.rng.permutation(self.index) if self.shuffle else self.index
+
+    def __getitem__(self, index):
+        rows = self.data[self.order[index * self.batch_size:(index + 1) * self.batch_size]]
+        return rows[:, self.feature_columns], rows[:, self.label_column]
+
+
+def __getattr__(name):
+    # WindowedSequence and RowSequence: the batches above as keras Sequences, made on first use
+    if name not in ('WindowedSequence', 'RowSequence'):
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    import tensorflow.keras
+    batches = _WindowedBatches if name == 'WindowedSequence' else _RowBatches
+    sequence = type(name, (batches, tensorflow.keras.utils.Sequence), {'__module__': __name__})
+    globals()[name] = sequence
+    return sequence
+
+
+def build_lstm_model(look_back, n_dynamic, n_static, units=64):
+    '''
+    LSTM on the dynamic windows, joined with the static features before the output layer
+    '''
+    from tensorflow.keras import layers, Model
+    dynamic_input = layers.Input(shape=(look_back, n_dynamic))
+    static_input = layers.Input(shape=(n_static,))
+    x = layers.LSTM(units)(dynamic_input)
+    x = layers.Concatenate()([x, static_input])
+    x = layers.Dense(64, activation='relu')(x)
+    x = layers.Dropout(0.5)(x)
+    output = layers.Dense(1)(x)
+    model = Model([dynamic_input, static_input], output)
+    model.compile(loss='mse', optimizer='adam', metrics=['mae', 'mse'])
+    return model
@@ -0,0 +1,123 @@
+"""
+Training of the lane-changing classifier of M02
+
+M02 fits RandomForestClassifier(n_estimators=300) on one core at every run. This
+module offers:
+
+1. fit_forest: the same forest, fitted on all the cores (n_jobs=-1)
+2. grow_forest: a forest grown by steps of trees (warm_start) until the
+   out-of-bag error stops improving, so the number of trees is not guessed
+3. fit_boosting: a histogram-based gradient boosting classifier, much faster
+   on millions of lines
+4. save_model/load_model and load_or_fit: the fitted classifier is pickled, with
+   a small json file describing how it was trained and the statistics of the
+   scaler of its features (forest.pkl.scaler.npz, see load_scaler), so that the
+   next steps (feature importance, simulation, M08_Inference_Server) load it
+   instead of fitting it again, and scale the features as in training
+
+sklearn is only imported when a classifier is fitted.
+"""
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+
+
+def fit_forest(train_features, train_labels, n_estimators=300, n_jobs=-1, random_state=None, **kwargs):
+    from sklearn.ensemble import RandomForestClassifier
+    clf = RandomForestClassifier(n_estimators=n_estimators, n_jobs=n_jobs, random_state=random_state, **kwargs)
+    clf.fit(train_features, train_labels)
+    return clf
+
+
+def grow_forest(train_features, train_labels, step=50, max_estimators=1000, tol=1e-4, patience=2,
+                n_jobs=-1, random_state=None, verbose=True, **kwargs):
+    '''
+    Adds step trees at a time while the out-of-bag error decreases by more than tol
+    (patience: number of steps without improvement before stopping).
+    The out-of-bag errors are kept in clf.oob_errors_
+    '''
+    from sklearn.ensemble import RandomForestClassifier
+    clf = RandomForestClassifier(n_estimators=step, warm_start=True, oob_score=True, bootstrap=True,
+                                 n_jobs=n_jobs, random_state=random_state, **kwargs)
+    oob_errors = []
+    best = np.inf
+    waited = 0
+    while True:
+        clf.fit(train_features, train_labels)
+        oob_errors.append(1 - clf.oob_score_)
+        if verbose:
+            print('%d trees: out-of-bag error %.5f' % (clf.n_estimators, oob_errors[-1]))
+        if oob_errors[-1] < best - tol:
+            best = oob_errors[-1]
+            waited = 0
+        else:
+            waited += 1
+        if waited >= patience or clf.n_estimators + step > max_estimators:
+            break
+        clf.n_estimators += step
+    clf.oob_errors_ = oob_errors
+    return clf
+
+
+def fit_boosting(train_features, train_labels, max_iter=500, learning_rate=0.1, random_state=None, **kwargs):
+    '''
+    Histogram-based gradient boosting (features binned into at most 255 values),
+    with early stopping on a validation part of the training data
+    '''
+    from sklearn.ensemble import HistGradientBoostingClassifier
+    clf = HistGradientBoostingClassifier(max_iter=max_iter, learning_rate=learning_rate, early_stopping=True,
+                                         random_state=random_state, **kwargs)
+    clf.fit(train_features, train_labels)
+    return clf
+
+
+METHODS = {'forest': fit_forest, 'grow_forest': grow_forest, 'boosting': fit_boosting}
+SCALER_SUFFIX = '.scaler.npz'
+
+
+def save_model(clf, path, info=None, scaler=None):
+    with open(path, 'wb') as f:
+        pickle.dump(clf, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if info is not None:
+        with open(path + '.json', 'w') as f:
+            json.dump(info, f, indent=2)
+    if scaler is not None:
+        from model.M07_Incremental_Training import save_scaler
+        save_scaler(scaler, path + SCALER_SUFFIX)
+
+
+def load_model(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_scaler(path):
+    '''
+    Scaler of the features of the classifier saved at path (None if it was saved without one)
+    '''
+    if not os.path.exists(path + SCALER_SUFFIX):
+        return None
+    from model.M07_Incremental_Training import load_scaler as load_saved_scaler
+    return load_saved_scaler(path + SCALER_SUFFIX)
+
+
+def load_or_fit(path, train_features, train_labels, method='forest', refit=False, scaler=None, **kwargs):
+    '''
+    Loads the classifier saved at path, or fits it with the given method and saves it
+    (with scaler, the scaler of the rows train_features come from)
+    '''
+    if os.path.exists(path) and not refit:
+        print('Loading the lane-changing model from ' + path)
+        return load_model(path)
+    start = time.time()
+    clf = METHODS[method](train_features, train_labels, **kwargs)
+    info = {'method': method, 'class': type(clf).__name__, 'rows': int(len(train_labels)),
+            'features': int(np.shape(train_features)[1]), 'training_seconds': round(time.time() - start, 2),
+            'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+    if hasattr(clf, 'oob_errors_'):
+        info['oob_errors'] = [float(e) for e in clf.oob_errors_]
+    save_model(clf, path, info, scaler)
+    return clf
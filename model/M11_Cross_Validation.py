@@ -0,0 +1,234 @@
+"""
+Cross-validation of the car-following (M01) and lane-changing (M02) models, by vehicle
+
+M01 and M02 are evaluated on one train_test_split of the lines. The three lagged
+lines of Stage B overlap from one line to the next of the same vehicle, so with a
+split of the lines the test set contains lines almost identical to training lines.
+Here:
+
+1. the folds are made of whole vehicles (or whole recordings, or whole
+   locations: a model is then scored on sites it has not seen), using the
+   Car_following_groups.csv written by A01 next to Car_following_df.csv
+2. the fold of each line, the unscaled labels and, for each fold, the whole
+   dataset scaled with the statistics of its training lines are saved once in
+   cache_dir as .npy files; the workers open them as memory-mapped arrays, so the
+   data is neither copied to each process nor scaled again at the next run
+3. the folds are trained and scored in parallel processes
+
+    results = cross_validate(prject_path + "data/Car_following_df.csv", prject_path + "data/Car_following_groups.csv",
+                             prject_path + "model/cv", model='car_following', n_folds=5, processes=5)
+
+Reported per fold: MAE and MSE of the acceleration (in m/s2) for 'car_following',
+accuracy and AUC of lane change or not for 'lane_change', with the number of
+lines and the seconds spent loading, fitting and predicting.
+"""
+import json
+import os
+import time
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+from model.M07_Incremental_Training import save_scaler
+from model.M17_Lean_Dataset import load_dataset, fit_min_max, scale_in_place
+
+FEATURES = slice(7, -2)
+CACHE_INFO = 'cache_info.json'
+
+
+def load_groups(groups_file, by='vehicle'):
+    '''
+    Group of each line of Car_following_df.csv: its uniqueID (by='vehicle'), its recording
+    (by='recording') or its location (by='location')
+    '''
+    groups = pd.read_csv(groups_file, header=None, dtype=np.int64).values
+    return groups[:, ['vehicle', 'recording', 'location'].index(by)]
+
+
+def group_folds(groups, n_folds=5, random_state=42):
+    '''
+    Fold of each line; all the lines of a group are in the same fold. The groups are
+    shuffled then, largest first, each is given to the fold with the fewest lines so far
+    '''
+    ids, inverse, counts = np.unique(groups, return_inverse=True, return_counts=True)
+    if len(ids) < n_folds:
+        raise ValueError('%d groups cannot be split into %d folds' % (len(ids), n_folds))
+    rng = np.random.default_rng(random_state)
+    order = rng.permutation(len(ids))
+    order = order[np.argsort(-counts[order], kind='stable')]
+    group_fold = np.empty(len(ids), dtype=np.int64)
+    fold_lines = np.zeros(n_folds, dtype=np.int64)
+    for g in order:
+        k = np.argmin(fold_lines)
+        group_fold[g] = k
+        fold_lines[k] += counts[g]
+    return group_fold[inverse]
+
+
+def fold_path(cache_dir, k):
+    return os.path.join(cache_dir, 'fold_%d.npy' % k)
+
+
+def prepare_folds(data_file, groups_file, cache_dir, n_folds=5, by='vehicle', random_state=42, chunk_rows=100000):
+    '''
+    Writes the cache used by the workers (skipped if it was made from the same files and settings):
+        folds.npy        fold of each line
+        labels.npy       unscaled lane change and acceleration of each line
+        fold_k.npy       all the lines scaled (float32) with the min/max of the training lines of fold k
+        scaler_k.npz     those min/max, in the format of M07 load_scaler
+    '''
+    info = {'data_file': os.path.abspath(data_file), 'data_mtime': os.path.getmtime(data_file),
+            'groups_file': os.path.abspath(groups_file), 'groups_mtime': os.path.getmtime(groups_file),
+            'n_folds': n_folds, 'by': by, 'random_state': random_state}
+    info_path = os.path.join(cache_dir, CACHE_INFO)
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            if json.load(f) == info:
+                return info
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # one float32 copy of the lines, from which every fold is scaled
+    dataset = load_dataset(data_file)
+    groups = load_groups(groups_file, by)
+    if len(groups) != len(dataset):
+        raise ValueError('%s has %d lines but %s has %d' % (groups_file, len(groups), data_file, len(dataset)))
+    folds = group_folds(groups, n_folds, random_state)
+    np.save(os.path.join(cache_dir, 'folds.npy'), folds)
+    np.save(os.path.join(cache_dir, 'labels.npy'), dataset[:, -2:])
+
+    for k in range(n_folds):
+        scaler = fit_min_max(dataset, np.flatnonzero(folds != k), chunk_rows)
+        save_scaler(scaler, os.path.join(cache_dir, 'scaler_%d.npz' % k))
+        scaled = open_memmap(fold_path(cache_dir, k), mode='w+', dtype=np.float32, shape=dataset.shape)
+        scaled[:] = dataset
+        scale_in_place(scaled, scaler, chunk_rows)
+        scaled.flush()
+        del scaled
+
+    # written last, so an interrupted preparation is done again
+    with open(info_path, 'w') as f:
+        json.dump(info, f, indent=2)
+    return info
+
+
+def train_car_following(train_features, train_labels, threads, seed, epochs=100, patience=10):
+    '''
+    Trains the network of M01 with threads TensorFlow threads; returns it with the number of epochs
+    '''
+    import tensorflow
+    from model.M01_Deep_Car_Following_Model import build_model
+    tensorflow.config.threading.set_intra_op_parallelism_threads(threads)
+    tensorflow.config.threading.set_inter_op_parallelism_threads(threads)
+    tensorflow.keras.utils.set_random_seed(seed)
+    model = build_model(train_features.shape[1])
+    early_stop = tensorflow.keras.callbacks.EarlyStopping(monitor='val_loss', patience=patience)
+    history = model.fit(train_features, train_labels, epochs=epochs, validation_split=0.2, verbose=0,
+                        callbacks=[early_stop])
+    return model, len(history.epoch)
+
+
+def _fit_car_following(train_features, train_labels, test_features, threads, seed, epochs=100, patience=10):
+    start = time.perf_counter()
+    model, n_epochs = train_car_following(train_features, train_labels, threads, seed, epochs, patience)
+    fit_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    predictions = model.predict(test_features, batch_size=4096, verbose=0).ravel()
+    return predictions, fit_seconds, time.perf_counter() - start, {'epochs': n_epochs}
+
+
+def _fit_lane_change(train_features, train_labels, test_features, threads, seed, method='forest', **kwargs):
+    from model.M10_Lane_Change_Training import METHODS
+    if method in ('forest', 'grow_forest'):
+        kwargs['n_jobs'] = threads
+    start = time.perf_counter()
+    clf = METHODS[method](train_features, train_labels, random_state=seed, **kwargs)
+    fit_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    probabilities = clf.predict_proba(test_features)
+    # probability of a lane change (0 if there was no lane change in the training lines)
+    probabilities = probabilities[:, list(clf.classes_).index(1)] if 1 in clf.classes_ else np.zeros(len(test_features))
+    extra = {'n_estimators': int(clf.n_estimators)} if hasattr(clf, 'n_estimators') else {}
+    return probabilities, fit_seconds, time.perf_counter() - start, extra
+
+
+def _run_fold(task):
+    cache_dir, k, model, threads, seed, kwargs = task
+    from sklearn import metrics
+    start = time.perf_counter()
+    folds = np.load(os.path.join(cache_dir, 'folds.npy'), mmap_mode='r')
+    scaled = np.load(fold_path(cache_dir, k), mmap_mode='r')
+    labels = np.load(os.path.join(cache_dir, 'labels.npy'), mmap_mode='r')
+    train_index = np.flatnonzero(folds != k)
+    test_index = np.flatnonzero(folds == k)
+    train_features = scaled[train_index, FEATURES]
+    test_features = scaled[test_index, FEATURES]
+    load_seconds = time.perf_counter() - start
+
+    result = {'fold': k, 'train_lines': int(len(train_index)), 'test_lines': int(len(test_index))}
+    if model == 'car_following':
+        # the network is trained on the scaled acceleration as in M01, the errors are in m/s2
+        predictions, fit_seconds, predict_seconds, extra = _fit_car_following(
+            train_features, scaled[train_index, -1], test_features, threads, seed, **kwargs)
+        scaler = np.load(os.path.join(cache_dir, 'scaler_%d.npz' % k))
+        span = scaler['data_max'][-1] - scaler['data_min'][-1]
+        predictions = predictions * (span if span > 0 else 1) + scaler['data_min'][-1]
+        truth = labels[test_index, 1]
+        result['mae'] = float(metrics.mean_absolute_error(truth, predictions))
+        result['mse'] = float(metrics.mean_squared_error(truth, predictions))
+    elif model == 'lane_change':
+        train_labels = (labels[train_index, 0] > 0).astype(int)
+        truth = (labels[test_index, 0] > 0).astype(int)
+        probabilities, fit_seconds, predict_seconds, extra = _fit_lane_change(
+            train_features, train_labels, test_features, threads, seed, **kwargs)
+        result['accuracy'] = float(metrics.accuracy_score(truth, probabilities >= 0.5))
+        # the AUC is not defined if the test fold has only one class
+        result['auc'] = float(metrics.roc_auc_score(truth, probabilities)) if len(np.unique(truth)) == 2 else float('nan')
+    else:
+        raise ValueError("model must be 'car_following' or 'lane_change', not %r" % model)
+    result.update(extra)
+    result.update({'load_seconds': round(load_seconds, 3), 'fit_seconds': round(fit_seconds, 3),
+                   'predict_seconds': round(predict_seconds, 3)})
+    return result
+
+
+def cross_validate(data_file, groups_file, cache_dir, model='car_following', n_folds=5, by='vehicle',
+                   processes=None, threads=None, random_state=42, verbose=True, **kwargs):
+    '''
+    Trains and scores the n_folds folds in parallel; returns one line per fold
+    (kwargs go to the fit: epochs/patience for 'car_following', method and its
+    arguments of M10_Lane_Change_Training for 'lane_change')
+    '''
+    prepare_folds(data_file, groups_file, cache_dir, n_folds, by, random_state)
+    if processes is None:
+        processes = min(n_folds, mp.cpu_count())
+    if threads is None:
+        # the cores are shared between the folds trained at the same time
+        threads = max(mp.cpu_count() // processes, 1)
+    tasks = [(cache_dir, k, model, threads, random_state + k, kwargs) for k in range(n_folds)]
+    start = time.perf_counter()
+    results = []
+    # spawn: tensorflow does not support being forked after it has been imported
+    with mp.get_context('spawn').Pool(processes) as pool:
+        for result in pool.imap_unordered(_run_fold, tasks):
+            if verbose:
+                print('fold %d done in %.1f s' % (result['fold'], result['fit_seconds'] + result['predict_seconds']))
+            results.append(result)
+    results = pd.DataFrame(results).sort_values('fold').reset_index(drop=True)
+    if verbose:
+        scores = ['mae', 'mse'] if model == 'car_following' else ['accuracy', 'auc']
+        for score in scores:
+            print('%s: %.4f +/- %.4f' % (score, results[score].mean(), results[score].std()))
+        print('total %.1f s' % (time.perf_counter() - start))
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    # usage: python -m model.M11_Cross_Validation Car_following_df.csv Car_following_groups.csv cache_dir
+    #        [car_following|lane_change] [vehicle|recording|location]
+    model = sys.argv[4] if len(sys.argv) > 4 else 'car_following'
+    by = sys.argv[5] if len(sys.argv) > 5 else 'vehicle'
+    results = cross_validate(sys.argv[1], sys.argv[2], sys.argv[3], model=model, by=by)
+    print(results.to_string())
@@ -0,0 +1,298 @@
+"""
+Simulation-based calibration of the parameters of M03_CarSimDL against highD statistics
+
+The parameters of the simulation (BusAcceleration, dt, demand, TrafficSpeed,
+IncreaseRate, ...) are set by hand in M03. Here they are searched so that the
+simulated speeds and time headways have the same distributions as in highD:
+
+1. the target statistics are computed once from the A01 output (Stage A,
+   Car_following_df_raw.csv: speeds and time headways) and optionally from the
+   A02 output (Veh_features.csv: maximum speeds of the unrestricted vehicles),
+   and saved as histograms in a .npz file
+2. a candidate parameter set is simulated with M06_Scenario_Sweep.simulate and
+   scored by the Wasserstein distance between its histograms and the targets
+3. candidates are evaluated in batches on a process pool, either by
+   approximate Bayesian computation (abc_rejection: candidates drawn from the
+   prior, the closest ones are kept as the posterior) or by an evolutionary
+   search (evolutionary_search: each generation is drawn around the best
+   candidates found so far)
+4. every evaluation is written to an SQLite log as soon as it is done; the
+   candidates of a batch are drawn from a seed that only depends on the batch
+   number, so a stopped calibration resumes exactly where it stopped
+
+    targets = load_targets(prject_path + "data/calibration_targets.npz", prject_path + "data/Car_following_df_raw.csv")
+    space = {'BusAcceleration': (0.5, 5), 'TrafficSpeed': (8, 30), 'IncreaseRate': (1, 20)}
+    log = evolutionary_search('Calibration.sqlite', scenario, space, targets, generations=20, batch_size=32)
+    best = log.best(10)
+"""
+import json
+import os
+import sqlite3
+import time
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+# columns of the Stage A output of A01
+SPEED_INDEX = 10
+TIME_HEADWAY_INDEX = 12
+# column of the maximum speed in the A02 output (Veh_features.csv, read by its header)
+MAX_SPEED_COLUMN = 'MaxSpeed'
+
+SPEED_BINS = np.arange(0, 61, 1.0)  # m/s
+HEADWAY_BINS = np.r_[0, np.logspace(-1, np.log10(900), 60)]  # s
+STATISTICS = ('speed', 'time_headway', 'max_speed')
+
+
+def histogram(values, bins):
+    '''
+    Normalised histogram, the values outside the bins are counted in the first/last bin
+    '''
+    values = np.clip(np.asarray(values, dtype=float), bins[0], bins[-1])
+    counts = np.histogram(values, bins)[0].astype(float)
+    return counts / counts.sum() if counts.sum() > 0 else counts
+
+
+def wasserstein(p, q, bins):
+    '''
+    Earth mover's distance between two histograms on the same bins
+    '''
+    return float(np.sum(np.abs(np.cumsum(p) - np.cumsum(q))[:-1] * np.diff(bins)[1:]))
+
+
+def compute_targets(raw_file, targets_file, features_file=None):
+    '''
+    Histograms of the highD speeds, time headways (lines with a preceding vehicle)
+    and, if features_file is given, maximum speeds of the unrestricted vehicles
+    '''
+    raw = pd.read_csv(raw_file, header=None, usecols=[SPEED_INDEX, TIME_HEADWAY_INDEX]).values
+    headway = raw[:, 1]
+    targets = {'speed': histogram(raw[:, 0], SPEED_BINS),
+               'time_headway': histogram(headway[headway > 0], HEADWAY_BINS),
+               'speed_bins': SPEED_BINS, 'headway_bins': HEADWAY_BINS}
+    if features_file is not None:
+        features = pd.read_csv(features_file, usecols=[MAX_SPEED_COLUMN])[MAX_SPEED_COLUMN].values
+        targets['max_speed'] = histogram(features, SPEED_BINS)
+    np.savez(targets_file, **targets)
+    return targets
+
+
+def load_targets(targets_file, raw_file=None, features_file=None):
+    '''
+    Loads the saved targets, computing them first if the file is missing or older than the data
+    '''
+    sources = [f for f in (raw_file, features_file) if f is not None]
+    if os.path.exists(targets_file) and all(os.path.getmtime(targets_file) >= os.path.getmtime(f) for f in sources):
+        saved = np.load(targets_file)
+        return {key: saved[key] for key in saved.files}
+    if raw_file is None:
+        raise FileNotFoundError(targets_file + ' does not exist and no A01 output was given to compute it')
+    return compute_targets(raw_file, targets_file, features_file)
+
+
+def crossing_times(t, positions, detectors):
+    '''
+    Time at which each bus passes each detector position (nan if it never does),
+    interpolated between time steps: array (bus, detector)
+    '''
+    reached = positions[:, :, None] >= detectors[None, None, :]
+    i = np.argmax(reached, axis=0)
+    passed = reached.any(axis=0) & (i > 0)
+    i = np.maximum(i, 1)
+    bus = np.arange(positions.shape[1])[:, None]
+    before, after = positions[i - 1, bus], positions[i, bus]
+    fraction = (detectors[None, :] - before) / np.where(after > before, after - before, 1)
+    times = t[i - 1] + fraction * (t[i] - t[i - 1])
+    return np.where(passed, times, np.nan)
+
+
+def summary_statistics(groundtruth, model_params, targets, n_detectors=10):
+    '''
+    Histograms of a simulation on the bins of the targets: speeds of the moving buses,
+    time headways between consecutive buses at n_detectors positions, maximum speed of each bus
+    '''
+    status = groundtruth[:, 0::4]
+    positions = groundtruth[:, 1::4]
+    velocity = groundtruth[:, 2::4]
+    t = np.arange(1, len(groundtruth) + 1) * model_params['dt']
+    road_length = model_params['NumberOfStop'] * model_params['LengthBetweenStop']
+    detectors = np.linspace(0, road_length, n_detectors + 2)[1:-1]
+    times = np.sort(crossing_times(t, positions, detectors), axis=0)
+    headways = np.diff(times, axis=0)
+    moving = status == 1
+    stats = {'speed': histogram(velocity[moving], targets['speed_bins']),
+             'time_headway': histogram(headways[np.isfinite(headways)], targets['headway_bins'])}
+    if 'max_speed' in targets:
+        stats['max_speed'] = histogram(velocity.max(axis=0), targets['speed_bins'])
+    return stats
+
+
+def distance(stats, targets, weights=None):
+    '''
+    Weighted sum of the Wasserstein distances of each statistic (speeds in m/s, headways in s)
+    '''
+    total = 0.0
+    for name in STATISTICS:
+        if name not in targets:
+            continue
+        bins = targets['headway_bins'] if name == 'time_headway' else targets['speed_bins']
+        weight = 1.0 if weights is None else weights.get(name, 1.0)
+        total += weight * wasserstein(stats[name], targets[name], bins)
+    return total
+
+
+def _evaluate(task):
+    from model.M06_Scenario_Sweep import simulate
+    batch, index, scenario, setting, seeds, targets, weights = task
+    start = time.time()
+    model_params = dict(scenario['model_params'])
+    model_params.update({k: v for k, v in setting.items() if k in model_params})
+    pooled = None
+    # the statistics of the replications are pooled before comparing with the targets
+    for seed in seeds:
+        stats = summary_statistics(simulate(scenario, setting, seed, ('groundtruth',))['groundtruth'], model_params, targets)
+        pooled = stats if pooled is None else {k: pooled[k] + stats[k] for k in stats}
+    stats = {k: v / len(seeds) for k, v in pooled.items()}
+    return batch, index, setting, distance(stats, targets, weights), stats, time.time() - start
+
+
+class CalibrationLog:
+    '''
+    SQLite log of all the evaluated candidates (one line per candidate)
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS evaluations (batch INTEGER, idx INTEGER, params TEXT, distance REAL,
+                stats TEXT, seconds REAL, PRIMARY KEY (batch, idx));
+        ''')
+        self.conn.commit()
+
+    def write(self, batch, index, setting, dist, stats, seconds):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO evaluations VALUES (?,?,?,?,?,?)',
+                              (batch, index, json.dumps(setting, sort_keys=True), dist,
+                               json.dumps({k: np.asarray(v).tolist() for k, v in stats.items()}), seconds))
+
+    def done(self, batch):
+        return set(i for i, in self.conn.execute('SELECT idx FROM evaluations WHERE batch = ?', (batch,)))
+
+    def best(self, n=1, before_batch=None):
+        '''
+        The n candidates with the smallest distance, as a DataFrame (one column per parameter)
+        '''
+        query = 'SELECT batch, idx, params, distance FROM evaluations'
+        args = ()
+        if before_batch is not None:
+            query += ' WHERE batch < ?'
+            args = (before_batch,)
+        rows = self.conn.execute(query + ' ORDER BY distance LIMIT ?', args + (n,)).fetchall()
+        return pd.DataFrame([dict(json.loads(params), batch=batch, idx=idx, distance=dist)
+                             for batch, idx, params, dist in rows])
+
+    def evaluations(self):
+        rows = self.conn.execute('SELECT batch, idx, params, distance, seconds FROM evaluations ORDER BY batch, idx')
+        return pd.DataFrame([dict(json.loads(params), batch=batch, idx=idx, distance=dist, seconds=seconds)
+                             for batch, idx, params, dist, seconds in rows])
+
+    def stats(self, batch, index):
+        row = self.conn.execute('SELECT stats FROM evaluations WHERE batch = ? AND idx = ?', (batch, index)).fetchone()
+        return {k: np.array(v) for k, v in json.loads(row[0]).items()}
+
+    def close(self):
+        self.conn.close()
+
+
+def evaluate_batch(log, batch, candidates, scenario, targets, weights=None, n_reps=1, seed=0, pool=None, verbose=True):
+    '''
+    Evaluates the candidates of a batch that are not in the log yet. The replication
+    r of candidate i of batch b is run with the seed [seed, b, i, r]
+    '''
+    done = log.done(batch)
+    tasks = [(batch, i, scenario, setting, [[seed, batch, i, r] for r in range(n_reps)], targets, weights)
+             for i, setting in enumerate(candidates) if i not in done]
+    results = map(_evaluate, tasks) if pool is None else pool.imap_unordered(_evaluate, tasks)
+    for batch, index, setting, dist, stats, seconds in results:
+        log.write(batch, index, setting, dist, stats, seconds)
+    if verbose:
+        best = log.best(1)
+        print('batch %d: %d candidates evaluated, best distance so far %.4f' % (batch, len(tasks), best['distance'][0]))
+
+
+def _draw_prior(space, n, rng):
+    return [{key: float(rng.uniform(low, high)) for key, (low, high) in space.items()} for _ in range(n)]
+
+
+def _open_pool(processes):
+    return None if processes == 1 else mp.Pool(processes)
+
+
+def abc_rejection(log_path, scenario, space, targets, n_batches=10, batch_size=64, quantile=0.05,
+                  weights=None, n_reps=1, processes=None, seed=0, verbose=True):
+    '''
+    Rejection ABC with uniform priors space = {'key': (low, high)} (keys of model_params
+    or TrafficSpeed/IncreaseRate). Returns the log and the accepted candidates: the
+    fraction quantile of all the logged candidates closest to the targets
+    '''
+    log = CalibrationLog(log_path)
+    pool = _open_pool(processes)
+    try:
+        for batch in range(n_batches):
+            candidates = _draw_prior(space, batch_size, np.random.default_rng([seed, batch]))
+            evaluate_batch(log, batch, candidates, scenario, targets, weights, n_reps, seed, pool, verbose)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    evaluations = log.evaluations()
+    accepted = evaluations[evaluations['distance'] <= evaluations['distance'].quantile(quantile)]
+    return log, accepted.sort_values('distance').reset_index(drop=True)
+
+
+def evolutionary_search(log_path, scenario, space, targets, generations=20, batch_size=32, n_parents=8,
+                        sigma=0.1, weights=None, n_reps=1, processes=None, seed=0, verbose=True):
+    '''
+    (mu + lambda) evolution strategy: generation 0 is drawn from the bounds in space,
+    each next generation is drawn around the n_parents best candidates of all the
+    previous generations (gaussian steps of sigma times the width of the bounds)
+    '''
+    log = CalibrationLog(log_path)
+    keys = list(space.keys())
+    low = np.array([space[k][0] for k in keys], dtype=float)
+    high = np.array([space[k][1] for k in keys], dtype=float)
+    pool = _open_pool(processes)
+    try:
+        for generation in range(generations):
+            rng = np.random.default_rng([seed, generation])
+            if generation == 0:
+                candidates = _draw_prior(space, batch_size, rng)
+            else:
+                # the parents come from the log, so a resumed search draws the same candidates
+                parents = log.best(n_parents, before_batch=generation)[keys].values
+                chosen = parents[rng.integers(len(parents), size=batch_size)]
+                values = np.clip(chosen + rng.normal(size=chosen.shape) * sigma * (high - low), low, high)
+                candidates = [dict(zip(keys, map(float, v))) for v in values]
+            evaluate_batch(log, generation, candidates, scenario, targets, weights, n_reps, seed, pool, verbose)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return log
+
+
+if __name__ == '__main__':
+    import sys
+    # usage: python -m model.M12_Calibration Car_following_df_raw.csv [Veh_features.csv]
+    NumberOfStop = 20
+    model_params = {"dt": 10, "minDemand": 0.5, "maxDemand": 1, "NumberOfStop": NumberOfStop,
+                    "LengthBetweenStop": 2000, "EndTime": 6000, "Headway": 5 * 60, "BurnIn": 1 * 60,
+                    "AlightTime": 1, "BoardTime": 3, "StoppingTime": 3, "BusAcceleration": 3}
+    rng = np.random.default_rng(0)
+    scenario = {'model_params': model_params, 'TrafficSpeed': 14,
+                'ArrivalRate': rng.uniform(0.5 / 60, 1 / 60, NumberOfStop),
+                'DepartureRate': np.sort(rng.uniform(0.05, 0.5, NumberOfStop)), 'IncreaseRate': 1}
+    targets = load_targets('calibration_targets.npz', sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    space = {'BusAcceleration': (0.5, 5), 'TrafficSpeed': (8, 30), 'IncreaseRate': (1, 20),
+             'maxDemand': (0.5, 3)}
+    log = evolutionary_search('Calibration.sqlite', scenario, space, targets)
+    print(log.best(10).to_string())
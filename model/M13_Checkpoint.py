@@ -0,0 +1,199 @@
+"""
+Binary checkpoints of the simulation in M03_CarSimDL, and scenario forking
+
+save_checkpoint writes the complete state of a Model into one uncompressed .npz
+file (numpy binary arrays, no pickle):
+
+1. the attributes of the model (parameters, current_time, TrafficSpeed, rates, ...)
+2. the agents, one array per attribute over all the agents (status, position,
+   velocity, ... of the buses; rates, activation of the bus stops)
+3. what has been recorded so far (trajectory, groundtruth, arrival times, ...),
+   the lists of all the agents concatenated, with the length of each list, so the
+   recording carries on from the same position after a restore
+4. objects of the model such as the traffic aggregates (M20_Traffic_Aggregates),
+   one array per attribute
+5. the state of the numpy random generator
+
+load_checkpoint rebuilds the Model without running __init__, so restoring does
+not depend on the length of the run so far.
+
+A warmed-up model (e.g. after BurnIn) can be saved once, then many variants are
+forked from it, in parallel processes:
+
+    model.save_checkpoint('warm.npz')
+    results = fork('warm.npz', [{'IncreaseRate': r} for r in range(1, 21)])
+
+Each variant only simulates from the checkpoint time to EndTime.
+"""
+import importlib
+import json
+import multiprocessing as mp
+
+import numpy as np
+
+VERSION = 2
+AGENTS = ('buses', 'busstops')
+#other objects of the model: attribute -> module and class
+OBJECTS = {'traffic': ('model.M20_Traffic_Aggregates', 'LaneAggregates')}
+#attributes that are not part of the state of the simulation (not saved, None after a restore)
+TRANSIENT = ('profiler', 'detectors')
+
+
+def _pack_agents(name, agents, arrays, meta):
+    '''
+    One array per attribute of the agents; list attributes are concatenated with their lengths
+    '''
+    scalars, lists = [], []
+    for key in (vars(agents[0]) if len(agents) > 0 else {}):
+        values = [getattr(agent, key) for agent in agents]
+        if isinstance(values[0], list):
+            lengths = np.array([len(v) for v in values], dtype=np.int64)
+            items = [np.asarray(v) for v in values if len(v) > 0]
+            arrays['%s/%s/lengths' % (name, key)] = lengths
+            arrays['%s/%s' % (name, key)] = np.concatenate(items) if len(items) > 0 else np.empty(0)
+            lists.append(key)
+        else:
+            arrays['%s/%s' % (name, key)] = np.array(values)
+            scalars.append(key)
+    meta[name] = {'n': len(agents), 'scalars': scalars, 'lists': lists}
+
+
+def _unpack_agents(cls, name, data, meta):
+    info = meta[name]
+    agents = [cls.__new__(cls) for _ in range(info['n'])]
+    for key in info['scalars']:
+        for agent, value in zip(agents, data['%s/%s' % (name, key)].tolist()):
+            setattr(agent, key, value)
+    for key in info['lists']:
+        values = data['%s/%s' % (name, key)]
+        bounds = np.cumsum(data['%s/%s/lengths' % (name, key)])[:-1]
+        for agent, value in zip(agents, np.split(values, bounds)):
+            setattr(agent, key, value.tolist())
+    return agents
+
+
+def _pack_object(name, value, arrays, meta):
+    keys = list(vars(value))
+    for key in keys:
+        arrays['%s/%s' % (name, key)] = np.asarray(getattr(value, key))
+    meta['objects'][name] = {'keys': keys, 'arrays': [key for key in keys
+                                                      if isinstance(getattr(value, key), np.ndarray)]}
+
+
+def _unpack_object(name, data, meta):
+    module, cls = OBJECTS[name]
+    cls = getattr(importlib.import_module(module), cls)
+    value = cls.__new__(cls)
+    info = meta['objects'][name]
+    for key in info['keys']:
+        array = data['%s/%s' % (name, key)]
+        setattr(value, key, array.copy() if key in info['arrays'] else array.item())
+    return value
+
+
+def save_checkpoint(model, path):
+    '''
+    Writes the complete state of the model and of the numpy random generator to path (.npz)
+    '''
+    arrays = {}
+    meta = {'version': VERSION, 'scalars': [], 'arrays': [], 'none': [], 'objects': {}}
+    for key, value in vars(model).items():
+        if key in AGENTS or key in TRANSIENT:
+            continue
+        if key in OBJECTS:
+            _pack_object(key, value, arrays, meta)
+            continue
+        if value is None:
+            # e.g. a model without seed
+            meta['none'].append(key)
+            continue
+        if isinstance(value, np.ndarray):
+            meta['arrays'].append(key)
+        else:
+            meta['scalars'].append(key)
+        arrays['model/' + key] = np.asarray(value)
+    _pack_agents('buses', model.buses, arrays, meta)
+    _pack_agents('busstops', model.busstops, arrays, meta)
+
+    kind, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    arrays['random/keys'] = keys
+    arrays['random/state'] = np.array([pos, has_gauss, cached_gaussian])
+    arrays['meta'] = np.array(json.dumps(meta))
+    np.savez(path, **arrays)
+
+
+def load_checkpoint(path, restore_random=True):
+    '''
+    Rebuilds the model saved by save_checkpoint (and by default the state of the numpy random generator)
+    '''
+    from model.M03_CarSimDL import Model, Bus, BusStop
+
+    with np.load(path) as data:
+        meta = json.loads(data['meta'].item())
+        if meta['version'] != VERSION:
+            raise ValueError('%s is a checkpoint of version %s, expected %d' % (path, meta['version'], VERSION))
+        model = Model.__new__(Model)
+        for key in meta['scalars']:
+            setattr(model, key, data['model/' + key].item())
+        for key in meta['arrays']:
+            setattr(model, key, data['model/' + key].copy())
+        for key in meta.get('none', []) + list(TRANSIENT):
+            setattr(model, key, None)
+        for key in meta['objects']:
+            setattr(model, key, _unpack_object(key, data, meta))
+        model.buses = _unpack_agents(Bus, 'buses', data, meta)
+        model.busstops = _unpack_agents(BusStop, 'busstops', data, meta)
+        if restore_random:
+            pos, has_gauss, cached_gaussian = data['random/state']
+            np.random.set_state(('MT19937', data['random/keys'], int(pos), int(has_gauss), float(cached_gaussian)))
+    return model
+
+
+def run_to_end(model):
+    '''
+    Runs the model from its current time to EndTime
+    '''
+    for time_step in range(int(round(model.current_time / model.dt)), int(model.EndTime / model.dt)):
+        model.step()
+    return model
+
+
+def _run_variant(task):
+    from model.M06_Scenario_Sweep import model_outputs
+    path, index, changes, seed, outputs = task
+    model = load_checkpoint(path, restore_random=seed is None)
+    if seed is not None:
+        np.random.seed(seed)
+        if model.seed is not None:
+            # a model with its own seed (see Model.random) gets a new one too
+            model.seed = int(np.random.SeedSequence(seed).generate_state(1)[0])
+    for key, value in changes.items():
+        if callable(value):
+            # e.g. {'incident': close_lane}: value(model) changes the model in place
+            value(model)
+        else:
+            setattr(model, key, value)
+    return index, model_outputs(run_to_end(model), outputs)
+
+
+def fork(path, variants, processes=None, seed=0, outputs=('trajectory',)):
+    '''
+    Runs each variant from the checkpoint at path to EndTime and returns their outputs, in order
+
+    variants: list of dicts of model attributes to change (IncreaseRate, TrafficSpeed0,
+        maxDemand, EndTime, ...); a callable value is called with the model instead
+        (it must be a module-level function to be sent to the processes)
+    seed: variant i is run with the random seed [seed, i]; None continues the random
+        state saved in the checkpoint, so every variant sees the same random numbers
+    outputs: see M06_Scenario_Sweep.simulate
+    '''
+    tasks = [(path, i, changes, None if seed is None else [seed, i], outputs) for i, changes in enumerate(variants)]
+    results = [None] * len(tasks)
+    if processes == 1 or len(tasks) <= 1:
+        for index, arrays in map(_run_variant, tasks):
+            results[index] = arrays
+        return results
+    with mp.Pool(processes) as pool:
+        for index, arrays in pool.imap_unordered(_run_variant, tasks):
+            results[index] = arrays
+    return results
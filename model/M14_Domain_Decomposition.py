@@ -0,0 +1,170 @@
+"""
+Domain-decomposed simulation of a long corridor on several processes
+
+The road of M03_CarSimDL is split into n_segments contiguous segments, each
+owned by one worker process: a segment is a run of consecutive bus stops and the
+part of the road closer to these stops than to any other. A worker steps the
+buses that are on its segment, and is the only one to read and change the state
+of its bus stops.
+
+The state of all the buses (status, position, velocity, occupancy, ...) and
+what they record are kept in shared memory. Every time step has two phases,
+each ended by a barrier:
+
+1. the workers move the buses on their segment (dispatch, speed, position)
+2. every bus now belongs to the segment of its nearest stop, i.e. buses that
+   crossed a boundary are handed over, and the new owner lets the bus reach the
+   stop, board/alight, dwell, and records it
+
+Buses only interact through the bus stops, and a bus stop is only touched by
+its owner, so no other data has to be exchanged. The model is created with a
+seed (see Model.random): the random numbers of a step and of a bus stop do not
+depend on which process draws them, and the run gives exactly the same results
+as a single-process run of Model(..., seed=seed).
+
+    model = run_decomposed(model_params, TrafficSpeed, ArrivalRate, DepartureRate, IncreaseRate,
+                           seed=0, n_segments=4)
+"""
+import queue
+import multiprocessing as mp
+
+import numpy as np
+
+#bus attributes kept in shared memory, and whether the bus has moved in the current step
+STATE = ('status', 'position', 'velocity', 'occupancy', 'visited', 'leave_stop_time', 'moved')
+INTEGERS = ('status', 'occupancy', 'visited')
+
+
+def segment_stops(NumberOfStop, n_segments):
+    '''
+    Segment that owns each bus stop (contiguous runs of stops of about the same length)
+    '''
+    owner = np.empty(NumberOfStop, dtype=np.int64)
+    for segment, stops in enumerate(np.array_split(np.arange(NumberOfStop), n_segments)):
+        owner[stops] = segment
+    return owner
+
+
+def _load(buses, state, index):
+    for b in index:
+        bus = buses[b]
+        for k, key in enumerate(STATE[:-1]):
+            value = state[b, k]
+            setattr(bus, key, int(value) if key in INTEGERS else value.item())
+
+
+def _save(buses, state, index):
+    for b in index:
+        state[b, :-1] = [getattr(buses[b], key) for key in STATE[:-1]]
+
+
+def _owned(model, state, stop_owner, segment):
+    # nearest stop of every bus (the first one on a tie, as Model.nearest_stop)
+    nearest = np.argmin(np.abs(model.StopList[None, :] - state[:, 1][:, None]), axis=1)
+    return np.flatnonzero(stop_owner[nearest] == segment)
+
+
+def _worker(segment, n_segments, args, seed, state_buffer, record_buffer, n_steps, barrier, results):
+    from model.M03_CarSimDL import Model
+    model_params, TrafficSpeed, ArrivalRate, DepartureRate, IncreaseRate = args
+    model = Model(model_params, TrafficSpeed, np.array(ArrivalRate, dtype=float), np.array(DepartureRate, dtype=float),
+                  IncreaseRate, seed=seed)
+    n_buses = len(model.buses)
+    state = np.frombuffer(state_buffer, dtype=np.float64).reshape(n_buses, len(STATE))
+    record = np.frombuffer(record_buffer, dtype=np.float64).reshape(n_steps, n_buses, 4)
+    stop_owner = segment_stops(len(model.StopList), n_segments)
+    moved = len(STATE) - 1
+    owned = _owned(model, state, stop_owner, segment)
+    # no bus is moved before every worker knows its buses
+    barrier.wait()
+    for step in range(n_steps):
+        # every worker updates the demand and time (same draws, see Model.random)
+        model.update_demand()
+        model.current_time += model.dt
+
+        # phase 1: move the buses of the segment (the positions have not changed since phase 2,
+        # so the buses are the ones owned at the end of the previous step)
+        _load(model.buses, state, owned)
+        for b in owned:
+            state[b, moved] = model.move_bus(model.buses[b])
+        _save(model.buses, state, owned)
+        barrier.wait()
+
+        # phase 2: the buses now on the segment reach its stops, dwell and are recorded
+        # (phase 2 does not change the positions, so all the workers see the same owners)
+        owned = _owned(model, state, stop_owner, segment)
+        _load(model.buses, state, owned)
+        for b in owned:
+            bus = model.buses[b]
+            if state[b, moved]:
+                model.visit_stop(bus)
+            model.dwell_bus(bus)
+            record[step, b] = [bus.status, bus.position, bus.velocity, bus.occupancy]
+        _save(model.buses, state, owned)
+        barrier.wait()
+
+    stops = {busstop.busstopID: (busstop.arrival_time, busstop.actual_headway)
+             for busstop in model.busstops if stop_owner[busstop.busstopID] == segment}
+    results.put((segment, stops, {'current_time': model.current_time, 'TrafficSpeed': model.TrafficSpeed,
+                                  'ArrivalRate': model.ArrivalRate}))
+
+
+def run_decomposed(model_params, TrafficSpeed, ArrivalRate, DepartureRate, IncreaseRate, seed=0, n_segments=None):
+    '''
+    Runs the model to EndTime on n_segments processes (default: number of cores,
+    at most one per bus stop) and returns it as if it had been run by Model.step
+    '''
+    from model.M03_CarSimDL import Model
+    model = Model(model_params, TrafficSpeed, np.array(ArrivalRate, dtype=float), np.array(DepartureRate, dtype=float),
+                  IncreaseRate, seed=seed)
+    if n_segments is None:
+        n_segments = mp.cpu_count()
+    n_segments = max(min(n_segments, len(model.StopList)), 1)
+    n_steps = int(model.EndTime / model.dt)
+    n_buses = len(model.buses)
+
+    state_buffer = mp.RawArray('d', n_buses * len(STATE))
+    state = np.frombuffer(state_buffer, dtype=np.float64).reshape(n_buses, len(STATE))
+    _save(model.buses, state, range(n_buses))
+    record_buffer = mp.RawArray('d', n_steps * n_buses * 4)
+    barrier = mp.Barrier(n_segments)
+    results = mp.Queue()
+    args = (model_params, TrafficSpeed, ArrivalRate, DepartureRate, IncreaseRate)
+    workers = [mp.Process(target=_worker, args=(segment, n_segments, args, seed, state_buffer, record_buffer,
+                                                n_steps, barrier, results), daemon=True)
+               for segment in range(n_segments)]
+    for worker in workers:
+        worker.start()
+    try:
+        # read the results before joining, so the workers can flush the queue
+        for _ in range(n_segments):
+            while True:
+                try:
+                    segment, stops, scalars = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    # the other workers would wait at the barrier for ever
+                    if any(worker.exitcode not in (None, 0) for worker in workers):
+                        raise RuntimeError('A segment worker of the decomposed simulation has failed')
+            for busstopID, (arrival_time, actual_headway) in stops.items():
+                model.busstops[busstopID].arrival_time = arrival_time
+                model.busstops[busstopID].actual_headway = actual_headway
+            [setattr(model, key, value) for key, value in scalars.items()]
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    # the agents as after a single-process run
+    _load(model.buses, state, range(n_buses))
+    record = np.frombuffer(record_buffer, dtype=np.float64).reshape(n_steps, n_buses, 4)
+    for b, bus in enumerate(model.buses):
+        bus.groundtruth = record[:, b].tolist()
+        bus.trajectory = record[:, b, 1].tolist()
+    for busstop in model.busstops:
+        busstop.arrival_rate = model.ArrivalRate[busstop.busstopID]
+    # the workers only step the buses, the traffic aggregates are summed once at the end
+    model.rebuild_traffic()
+    return model
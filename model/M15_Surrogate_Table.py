@@ -0,0 +1,209 @@
+"""
+Lookup-table surrogate of the deep car-following model of M01
+
+Most of the time a vehicle is in free flow or simply follows its leader, with
+no vehicle around in the other lanes, and the network is asked nearly the same
+question again and again. For these cases the answer of the network is sampled
+once on a grid of the inputs that matter, and then interpolated:
+
+    free flow (no preceding vehicle):   own speed x traffic density
+    following:                          own speed x distance headway x preceding speed x traffic density
+
+The rows sent to the network on the grid are steady states: the three lagged
+lines are the same, the time headway and time to collision are computed from
+the speeds and headway, and the other inputs are the medians of the data.
+
+    predictor = ModelPredictor(model_dir)       # M08_Inference_Server
+    surrogate = build_surrogate(predictor, features, prject_path + "model/surrogate.npz")
+    print(surrogate_error(surrogate, predictor, test_features))
+    predictor = ModelPredictor(model_dir, surrogate_path=prject_path + "model/surrogate.npz")
+
+The last predictor answers the rows without any surrounding vehicle and inside
+the grid from the table, and only sends the other rows to the network.
+The features are the unscaled columns [7:-2] of Car_following_df.csv.
+"""
+import time
+
+import numpy as np
+
+# columns of the features (Car_following_df.csv[:,7:-2]): meanXSpeed, then 3 lines of 19 dynamic values
+MEAN_SPEED = 0
+BLOCK_STARTS = [1, 20, 39]
+SPEED, DISTANCE_HEADWAY, TIME_HEADWAY, TIME_TO_COLLISION, PRECEDING_SPEED = 0, 1, 2, 3, 4
+NEIGHBOURS = list(range(5, 17))
+DENSITY, TRAFFIC_SPEED = 17, 18
+# the last line (the most recent) gives the grid coordinates
+LAST = BLOCK_STARTS[-1]
+
+
+def neighbours_empty(features):
+    '''
+    True for the rows with no vehicle alongside, ahead or behind in the other lanes, in the 3 lines
+    '''
+    columns = [start + c for start in BLOCK_STARTS for c in NEIGHBOURS]
+    return np.all(features[:, columns] == 0, axis=1)
+
+
+def _axis(values, n, low=None):
+    # grid from low (or the 0.5% quantile) to the 99.5% quantile
+    lo, hi = np.quantile(values, [0.005, 0.995]) if len(values) > 0 else (0.0, 1.0)
+    lo = lo if low is None else low
+    return np.linspace(lo, max(hi, lo + 1e-6), n)
+
+
+def steady_state_rows(reference, speed, density, headway=None, preceding_speed=None):
+    '''
+    Feature rows of vehicles keeping the same state over the 3 lines
+    (all the arguments except reference are arrays of the same length)
+    '''
+    rows = np.tile(reference, (len(speed), 1))
+    rows[:, MEAN_SPEED] = speed
+    for start in BLOCK_STARTS:
+        rows[:, start + SPEED] = speed
+        rows[:, start + DENSITY] = density
+        rows[:, [start + c for c in NEIGHBOURS]] = 0
+        if headway is None:
+            # highD gives 0 headways and speeds when there is no preceding vehicle
+            rows[:, start + DISTANCE_HEADWAY:start + PRECEDING_SPEED + 1] = 0
+        else:
+            rows[:, start + DISTANCE_HEADWAY] = headway
+            rows[:, start + TIME_HEADWAY] = np.where(speed > 0, headway / np.maximum(speed, 1e-6), 0)
+            closing = speed - preceding_speed
+            rows[:, start + TIME_TO_COLLISION] = np.where(closing > 0, headway / np.maximum(closing, 1e-6), 0)
+            rows[:, start + PRECEDING_SPEED] = preceding_speed
+    return rows
+
+
+def interpolate(axes, table, points):
+    '''
+    Multilinear interpolation of table (defined on the regular grid axes) at points (n, len(axes))
+    '''
+    index = []
+    weight = []
+    for d, axis in enumerate(axes):
+        step = (axis[-1] - axis[0]) / (len(axis) - 1)
+        position = np.clip((points[:, d] - axis[0]) / step, 0, len(axis) - 1 - 1e-9)
+        i = np.floor(position).astype(np.int64)
+        index.append(i)
+        weight.append(position - i)
+    result = np.zeros(len(points))
+    # the 2^d corners of the cell of each point
+    for corner in range(2 ** len(axes)):
+        w = np.ones(len(points))
+        cell = []
+        for d in range(len(axes)):
+            upper = (corner >> d) & 1
+            cell.append(index[d] + upper)
+            w *= weight[d] if upper else 1 - weight[d]
+        result += w * table[tuple(cell)]
+    return result
+
+
+class SurrogateTable:
+    def __init__(self, free_axes, free, following_axes, following):
+        self.free_axes = [np.asarray(a) for a in free_axes]
+        self.free = np.asarray(free)
+        self.following_axes = [np.asarray(a) for a in following_axes]
+        self.following = np.asarray(following)
+
+    def save(self, path):
+        arrays = {'free': self.free, 'following': self.following}
+        arrays.update({'free_axis_%d' % d: a for d, a in enumerate(self.free_axes)})
+        arrays.update({'following_axis_%d' % d: a for d, a in enumerate(self.following_axes)})
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        saved = np.load(path)
+        return cls([saved['free_axis_%d' % d] for d in range(saved['free'].ndim)], saved['free'],
+                   [saved['following_axis_%d' % d] for d in range(saved['following'].ndim)], saved['following'])
+
+    @staticmethod
+    def _inside(axes, points):
+        return np.all([(points[:, d] >= a[0]) & (points[:, d] <= a[-1]) for d, a in enumerate(axes)], axis=0)
+
+    def predict(self, features):
+        '''
+        Accelerations from the table, and which rows the table can answer
+        (no surrounding vehicle in the other lanes, inside the grid)
+        '''
+        last = features[:, LAST:LAST + 19]
+        acceleration = np.full(len(features), np.nan)
+        usable = neighbours_empty(features)
+        free = usable & (last[:, DISTANCE_HEADWAY] == 0)
+        points = last[free][:, [SPEED, DENSITY]]
+        inside = self._inside(self.free_axes, points)
+        acceleration[np.flatnonzero(free)[inside]] = interpolate(self.free_axes, self.free, points[inside])
+        following = usable & (last[:, DISTANCE_HEADWAY] > 0)
+        points = last[following][:, [SPEED, DISTANCE_HEADWAY, PRECEDING_SPEED, DENSITY]]
+        inside = self._inside(self.following_axes, points)
+        acceleration[np.flatnonzero(following)[inside]] = interpolate(self.following_axes, self.following, points[inside])
+        return acceleration, ~np.isnan(acceleration)
+
+
+def build_surrogate(predictor, features, path=None, free_points=(60, 20), following_points=(40, 40, 30, 12),
+                    batch_size=65536, verbose=True):
+    '''
+    Samples the network (predictor.predict(rows)['acceleration'], e.g. M08 ModelPredictor)
+    on the grids; the ranges of the grids and the other inputs come from the data (features)
+    '''
+    empty = features[neighbours_empty(features)]
+    if len(empty) == 0:
+        empty = features
+    last = empty[:, LAST:LAST + 19]
+    free_rows = empty[last[:, DISTANCE_HEADWAY] == 0]
+    following_rows = empty[last[:, DISTANCE_HEADWAY] > 0]
+    reference = np.median(empty, axis=0)
+
+    def sample(axes, headway):
+        grid = np.meshgrid(*axes, indexing='ij')
+        points = np.column_stack([g.ravel() for g in grid])
+        values = np.empty(len(points))
+        for start in range(0, len(points), batch_size):
+            p = points[start:start + batch_size]
+            if headway:
+                rows = steady_state_rows(reference, p[:, 0], p[:, 3], p[:, 1], p[:, 2])
+            else:
+                rows = steady_state_rows(reference, p[:, 0], p[:, 1])
+            values[start:start + batch_size] = predictor.predict(rows)['acceleration']
+        return values.reshape(grid[0].shape)
+
+    start = time.time()
+    free_axes = [_axis(free_rows[:, LAST + SPEED], free_points[0], low=0),
+                 _axis(free_rows[:, LAST + DENSITY], free_points[1], low=0)]
+    following_axes = [_axis(following_rows[:, LAST + SPEED], following_points[0], low=0),
+                      _axis(following_rows[:, LAST + DISTANCE_HEADWAY], following_points[1]),
+                      _axis(following_rows[:, LAST + PRECEDING_SPEED], following_points[2], low=0),
+                      _axis(following_rows[:, LAST + DENSITY], following_points[3], low=0)]
+    surrogate = SurrogateTable(free_axes, sample(free_axes, False), following_axes, sample(following_axes, True))
+    if verbose:
+        print('surrogate: %d + %d grid points sampled in %.1f s' % (surrogate.free.size, surrogate.following.size,
+                                                                     time.time() - start))
+    if path is not None:
+        surrogate.save(path)
+    return surrogate
+
+
+def surrogate_error(surrogate, predictor, features, labels=None):
+    '''
+    Error of the table against the network on the rows it can answer, the share
+    of these rows, and the time per row of the table and of the network
+    '''
+    start = time.perf_counter()
+    table, usable = surrogate.predict(features)
+    table_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    network = predictor.predict(features[usable])['acceleration']
+    network_seconds = time.perf_counter() - start
+    error = table[usable] - network
+    report = {'coverage': float(np.mean(usable)), 'rows': int(usable.sum()),
+              'mae': float(np.mean(np.abs(error))) if len(error) > 0 else float('nan'),
+              'rmse': float(np.sqrt(np.mean(error ** 2))) if len(error) > 0 else float('nan'),
+              'max_error': float(np.max(np.abs(error))) if len(error) > 0 else float('nan'),
+              'table_us_per_row': 1e6 * table_seconds / max(len(features), 1),
+              'network_us_per_row': 1e6 * network_seconds / max(int(usable.sum()), 1)}
+    if labels is not None and len(error) > 0:
+        # the error of each against the observed accelerations
+        report['table_mae_data'] = float(np.mean(np.abs(table[usable] - labels[usable])))
+        report['network_mae_data'] = float(np.mean(np.abs(network - labels[usable])))
+    return report
@@ -0,0 +1,168 @@
+"""
+Closed-loop replay of the car-following model against highD trajectories
+
+The one-step error of M01 (scatter_pred.pdf) does not tell whether a simulated
+vehicle stays stable when it is driven by its own predictions. Here every
+follower episode extracted by A01 is replayed:
+
+1. an episode is a run of lines of one vehicle (Stage A output,
+   Car_following_df_raw.csv, one line per second) following the same leader;
+   the leader position is rebuilt from the distance headway and the integrated
+   speed of the real follower, and is replayed as recorded
+2. the first 3 lines are the real ones, then the follower is driven by the
+   model: each second the predicted acceleration updates its speed and
+   position, and its speed, headways, time to collision are recomputed from the
+   simulated state (the surrounding vehicles, density and traffic speed are
+   the recorded ones)
+3. all the episodes are stepped together: one call of the model per second for
+   all the vehicles still running
+
+Reported per episode: RMSE of the spacing and speed against the real follower,
+collision (spacing below min_gap, the episode then stops) and drift (spacing
+error at the end), with a summary over all the episodes.
+
+    predictor = ModelPredictor(model_dir)       # M08_Inference_Server
+    episodes, summary = replay(predictor, load_stage_a(prject_path + "data/Car_following_df_raw.csv"))
+"""
+import numpy as np
+import pandas as pd
+
+from model.M09_Sequence_Dataset import vehicle_bounds
+
+# columns of the Stage A output of A01
+MEAN_SPEED = 9
+DYNAMIC = slice(10, 29)
+SPEED, DISTANCE_HEADWAY, TIME_HEADWAY, TIME_TO_COLLISION, PRECEDING_SPEED = 10, 11, 12, 13, 14
+WARM_UP = 3  # real lines given to the model before it drives
+
+
+def extract_episodes(data, min_length=10, max_jump=5.0, dt=1.0, vehicles=None):
+    '''
+    Runs of lines with the same leader: the distance headway is positive and the
+    rebuilt leader position moves as its recorded speed says (within max_jump metres).
+    Returns the first line, length and vehicle of each episode, and the position
+    of the real follower on every line (integrated speed, 0 at the start of each vehicle)
+    '''
+    ids, starts, ends = vehicle_bounds(data)
+    first = np.zeros(len(data), dtype=bool)
+    first[starts] = True
+    speed = data[:, SPEED].astype(float)
+    headway = data[:, DISTANCE_HEADWAY].astype(float)
+    step = np.where(first, 0, (speed + np.r_[0, speed[:-1]]) / 2 * dt)
+    position = np.cumsum(step)
+    position -= np.repeat(position[starts], ends - starts)
+
+    leader = position + headway
+    leader_step = np.where(first, 0, leader - np.r_[0, leader[:-1]])
+    leader_speed = data[:, PRECEDING_SPEED].astype(float)
+    expected = (leader_speed + np.r_[0, leader_speed[:-1]]) / 2 * dt
+    valid = headway > 0
+    if vehicles is not None:
+        valid &= np.isin(data[:, 0], vehicles)
+    new = valid & (first | ~np.r_[False, valid[:-1]] | (np.abs(leader_step - expected) > max_jump))
+    episode_start = np.flatnonzero(new)
+    # an episode ends at the next start or at the first line without leader
+    next_start = np.r_[episode_start[1:], len(data)]
+    invalid = np.flatnonzero(~valid)
+    next_invalid = invalid[np.minimum(np.searchsorted(invalid, episode_start), len(invalid) - 1)] if len(invalid) > 0 \
+        else np.full(len(episode_start), len(data))
+    next_invalid = np.where(next_invalid > episode_start, next_invalid, len(data))
+    length = np.minimum(next_start, next_invalid) - episode_start
+    keep = length >= min_length
+    return episode_start[keep], length[keep], data[episode_start[keep], 0], position
+
+
+def replay(predictor, data, min_length=10, max_jump=5.0, dt=1.0, min_gap=0.0, vehicles=None, max_steps=None):
+    '''
+    Replays all the episodes at once with predictor.predict(rows)['acceleration']
+    (rows: unscaled features as the columns [7:-2] of Car_following_df.csv).
+    Returns one line per episode and a summary
+    '''
+    start, length, vehicle, position = extract_episodes(data, min_length, max_jump, dt, vehicles)
+    if max_steps is not None:
+        length = np.minimum(length, max_steps)
+    n, T = len(start), int(length.max()) if len(start) > 0 else 0
+    if n == 0:
+        raise ValueError('No follower episode of at least %d lines' % min_length)
+    line = np.minimum(start[:, None] + np.arange(T)[None, :], len(data) - 1)
+    running = np.arange(T)[None, :] < length[:, None]
+
+    # real trajectories, as (episode, time) arrays
+    dynamic = data[line][:, :, DYNAMIC].astype(float)  # (episode, time, 19), overwritten by the simulation
+    real_speed = dynamic[:, :, SPEED - 10].copy()
+    real_headway = dynamic[:, :, DISTANCE_HEADWAY - 10].copy()
+    leader_position = position[line] + real_headway
+    leader_speed = dynamic[:, :, PRECEDING_SPEED - 10]
+    mean_speed = data[start, MEAN_SPEED].astype(float)
+
+    x = position[line].copy()
+    v = real_speed.copy()
+    collided = np.zeros(n, dtype=bool)
+    collision_time = np.full(n, -1)
+    for t in range(WARM_UP - 1, T - 1):
+        active = running[:, t + 1] & ~collided
+        if not active.any():
+            break
+        index = np.flatnonzero(active)
+        rows = np.column_stack([mean_speed[index], dynamic[index, t - 2], dynamic[index, t - 1], dynamic[index, t]])
+        acceleration = np.asarray(predictor.predict(rows)['acceleration'], dtype=float)
+        v[index, t + 1] = np.maximum(v[index, t] + acceleration * dt, 0)
+        x[index, t + 1] = x[index, t] + (v[index, t] + v[index, t + 1]) / 2 * dt
+
+        # the simulated line seen by the model at the next steps
+        gap = leader_position[index, t + 1] - x[index, t + 1]
+        speed = v[index, t + 1]
+        closing = speed - leader_speed[index, t + 1]
+        dynamic[index, t + 1, SPEED - 10] = speed
+        dynamic[index, t + 1, DISTANCE_HEADWAY - 10] = gap
+        dynamic[index, t + 1, TIME_HEADWAY - 10] = np.where(speed > 0, gap / np.maximum(speed, 1e-6), 0)
+        dynamic[index, t + 1, TIME_TO_COLLISION - 10] = np.where(closing > 0, gap / np.maximum(closing, 1e-6), 0)
+
+        crash = index[gap <= min_gap]
+        collided[crash] = True
+        collision_time[crash] = t + 1
+        # the lines after a collision are not simulated
+        running[crash, t + 2:] = False
+
+    simulated = running.copy()
+    simulated[:, :WARM_UP] = False
+    spacing_error = np.where(simulated, (leader_position - x) - real_headway, np.nan)
+    speed_error = np.where(simulated, v - real_speed, np.nan)
+    last = np.maximum(running.sum(axis=1) - 1, 0)
+    with np.errstate(invalid='ignore'):
+        episodes = pd.DataFrame({
+            'vehicle': vehicle, 'first_line': start, 'length': running.sum(axis=1),
+            'spacing_rmse': np.sqrt(np.nanmean(spacing_error ** 2, axis=1)),
+            'speed_rmse': np.sqrt(np.nanmean(speed_error ** 2, axis=1)),
+            'drift': spacing_error[np.arange(n), last],
+            'collided': collided, 'collision_time': collision_time})
+    summary = {
+        'episodes': n,
+        'collisions': int(collided.sum()),
+        'collision_rate': float(collided.mean()),
+        'spacing_rmse': float(np.sqrt(np.nanmean(spacing_error ** 2))),
+        'speed_rmse': float(np.sqrt(np.nanmean(speed_error ** 2))),
+        'drift_percentiles': dict(zip(['5%', '25%', '50%', '75%', '95%'],
+                                      np.nanpercentile(episodes['drift'], [5, 25, 50, 75, 95]).tolist())),
+    }
+    return episodes, summary
+
+
+def plot_drift(episodes, filename=None):
+    import matplotlib.pyplot as plt
+    plt.figure()
+    plt.hist(episodes['drift'].dropna(), bins=50)
+    plt.xlabel('Spacing error at the end of the episode (m)')
+    plt.ylabel('Episodes')
+    if filename is not None:
+        plt.savefig(filename, bbox_inches='tight')
+
+
+if __name__ == '__main__':
+    import sys
+    from model.M08_Inference_Server import ModelPredictor
+    from model.M09_Sequence_Dataset import load_stage_a
+    # usage: python -m model.M16_Closed_Loop_Replay model_dir Car_following_df_raw.csv
+    episodes, summary = replay(ModelPredictor(sys.argv[1]), load_stage_a(sys.argv[2], dtype=np.float64))
+    print(summary)
+    plot_drift(episodes, 'closed_loop_drift.pdf')
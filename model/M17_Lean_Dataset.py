@@ -0,0 +1,107 @@
+"""
+Memory-lean loading and scaling of Car_following_df.csv for M01 and M02
+
+np.genfromtxt(dtype=None) gives a float64 array, MinMaxScaler.fit_transform makes
+a second one, dataset[:,7:-2] a third one and train_test_split a fourth one.
+Here the data is kept in one float32 array:
+
+1. load_dataset counts the lines, allocates the array once and fills it with
+   chunks read by pandas
+2. fit_min_max computes the min/max of the given rows chunk by chunk, and
+   returns a fitted MinMaxScaler (so it can be saved with M07 save_scaler)
+3. scale_in_place applies it chunk by chunk, without making a copy
+4. split_indices gives the training and testing rows as index arrays (the same
+   split as train_test_split(dataset, ..., random_state=42)); the rows are then
+   gathered batch by batch (M09_Sequence_Dataset.RowSequence) or once, for the
+   training rows only
+
+    dataset = load_dataset(filename)
+    train_index, test_index = split_indices(len(dataset))
+    scaler = fit_min_max(dataset, train_index)
+    scale_in_place(dataset, scaler)
+
+These are the scaling helpers of the repository: M07 (saved scalers, new
+recordings) and M11 (cross-validation folds) use them too.
+"""
+import numpy as np
+
+
+def count_lines(filename, block_size=1 << 24):
+    '''
+    Number of non-empty lines of a text file, read by blocks
+    '''
+    n = 0
+    last = b'\n'
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            n += block.count(b'\n')
+            last = block[-1:]
+    # the last line may have no newline
+    return n + (last != b'\n')
+
+
+def load_dataset(filename, dtype=np.float32, chunk_rows=20000):
+    '''
+    Reads a headerless csv of numbers into one array of the given dtype
+    '''
+    import pandas as pd
+    n_rows = count_lines(filename)
+    dataset = None
+    start = 0
+    for chunk in pd.read_csv(filename, header=None, dtype=dtype, chunksize=chunk_rows):
+        if dataset is None:
+            dataset = np.empty((n_rows, chunk.shape[1]), dtype=dtype)
+        dataset[start:start + len(chunk)] = chunk.values
+        start += len(chunk)
+    if dataset is None:
+        raise ValueError(filename + ' is empty')
+    return dataset[:start]
+
+
+def minmax_scaler(data_min, data_max, feature_range=(0, 1)):
+    '''
+    A MinMaxScaler fitted to the given statistics
+    '''
+    from sklearn.preprocessing import MinMaxScaler
+    scaler = MinMaxScaler(feature_range=feature_range)
+    # fitting on the two extreme rows gives exactly these statistics
+    scaler.fit(np.vstack([data_min, data_max]).astype(np.float64))
+    return scaler
+
+
+def fit_min_max(data, rows=None, chunk_rows=20000, feature_range=(0, 1)):
+    '''
+    Min/max of each column over the given rows (all by default), one chunk of rows at a time
+    '''
+    n = len(data) if rows is None else len(rows)
+    data_min = np.full(data.shape[1], np.inf)
+    data_max = np.full(data.shape[1], -np.inf)
+    if rows is not None:
+        # in increasing order, the chunks are read from memory in order
+        rows = np.sort(rows)
+    for start in range(0, n, chunk_rows):
+        chunk = data[start:start + chunk_rows] if rows is None else data[rows[start:start + chunk_rows]]
+        data_min = np.minimum(data_min, chunk.min(axis=0))
+        data_max = np.maximum(data_max, chunk.max(axis=0))
+    return minmax_scaler(data_min, data_max, feature_range)
+
+
+def scale_in_place(data, scaler, chunk_rows=20000):
+    '''
+    data = scaler.transform(data), one chunk of rows at a time, without a copy of data
+    '''
+    scale = scaler.scale_.astype(data.dtype)
+    offset = scaler.min_.astype(data.dtype)
+    for start in range(0, len(data), chunk_rows):
+        chunk = data[start:start + chunk_rows]
+        chunk *= scale
+        chunk += offset
+    return data
+
+
+def split_indices(n, test_size=0.25, random_state=42):
+    from sklearn.model_selection import train_test_split
+    return train_test_split(np.arange(n), test_size=test_size, random_state=random_state)
@@ -0,0 +1,241 @@
+"""
+Mixture of car-following experts, one per vehicle class and speed band
+
+Instead of one network of M01 for all the drivers, the lines of
+Car_following_df.csv are split into clusters by the class of the vehicle (Car or
+Truck, column 4) and by bands of its mean speed (meanXSpeed, the first feature):
+the speed bands are the quantiles of each class, so every cluster has about the
+same number of lines. One expert (the network of M01) is trained per cluster,
+all of them at the same time in separate processes, each with its own share of
+the cores. Clusters with less than min_rows lines are merged into the largest
+cluster of the same class.
+
+The gate is a lookup: class and band give the cluster, the cluster gives the
+expert. At inference time a batch of mixed vehicles is sorted by expert
+(argsort), the size of each sub-batch is counted (bincount), and every expert is
+called once on its contiguous sub-batch; the results are scattered back to the
+order of the batch. The number of calls per batch is the number of experts
+present in it, not the number of rows.
+
+    report = train_experts(prject_path + "data/Car_following_df.csv", prject_path + "model/experts")
+    predictor = MixturePredictor(prject_path + "model/experts")
+    result = predictor.predict(rows, vehicle_class)     # {'acceleration': ..., 'expert': ...}
+
+or python -m model.M18_Mixture_of_Experts Car_following_df.csv model_dir [n_speed_bands]
+
+The experts are saved as M07 model versions (model_dir/expert_k), so each of them
+can be loaded by M08 ModelPredictor, served, or updated with new recordings.
+"""
+import json
+import os
+import time
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+from model.M08_Inference_Server import ModelPredictor
+from model.M17_Lean_Dataset import load_dataset, fit_min_max, scale_in_place, split_indices
+
+EXPERTS_FILE = 'experts.json'
+CACHE_FILE = 'mixture_rows.npy'
+CLASS_COLUMN = 4
+FEATURES = slice(7, -2)
+MEAN_SPEED = 0  # first feature, signed as in tracksMeta
+CLASSES = ('Car', 'Truck')  # as encoded by A01 (0, 1)
+
+
+class Gate:
+    '''
+    Cluster of each line: class * n_bands + speed band within the class
+    '''
+    def __init__(self, speed_edges):
+        # inner edges of the speed bands, one list per class
+        self.speed_edges = [np.asarray(edges, dtype=float) for edges in speed_edges]
+        self.n_bands = len(self.speed_edges[0]) + 1
+
+    @classmethod
+    def fit(cls, vehicle_class, mean_speed, n_bands=2):
+        quantiles = np.linspace(0, 1, n_bands + 1)[1:-1]
+        speed_edges = []
+        for c in range(len(CLASSES)):
+            speeds = mean_speed[vehicle_class == c]
+            speed_edges.append(np.quantile(speeds, quantiles) if len(speeds) > 0 else np.zeros(n_bands - 1))
+        return cls(speed_edges)
+
+    @property
+    def n_clusters(self):
+        return len(self.speed_edges) * self.n_bands
+
+    def assign(self, features, vehicle_class=None):
+        '''
+        Cluster of each row of features (unscaled); vehicle_class (one per row, or one
+        for all the rows) may only be left out when the gate has a single class
+        '''
+        if vehicle_class is None:
+            if len(self.speed_edges) > 1:
+                raise ValueError('The gate routes %d vehicle classes: the class of the rows is required'
+                                 % len(self.speed_edges))
+            vehicle_class = 0
+        mean_speed = np.abs(features[:, MEAN_SPEED])
+        vehicle_class = np.broadcast_to(np.asarray(vehicle_class).astype(np.int64), (len(features),))
+        band = np.zeros(len(features), dtype=np.int64)
+        for c, edges in enumerate(self.speed_edges):
+            rows = vehicle_class == c
+            band[rows] = np.searchsorted(edges, mean_speed[rows], side='right')
+        return vehicle_class * self.n_bands + band
+
+    def to_dict(self):
+        return {'speed_edges': [edges.tolist() for edges in self.speed_edges]}
+
+    @classmethod
+    def from_dict(cls, saved):
+        return cls(saved['speed_edges'])
+
+
+def merge_clusters(counts, n_bands, min_rows):
+    '''
+    Expert of each cluster: clusters with less than min_rows lines go to the largest
+    cluster of their class (or the largest cluster overall)
+    '''
+    counts = np.asarray(counts)
+    target = np.arange(len(counts))
+    small = counts < min_rows
+    for cluster in np.flatnonzero(small):
+        same_class = np.arange(len(counts)) // n_bands == cluster // n_bands
+        candidates = np.flatnonzero(same_class & ~small)
+        if len(candidates) == 0:
+            candidates = np.flatnonzero(~small)
+        if len(candidates) == 0:
+            candidates = np.array([np.argmax(counts)])
+        target[cluster] = candidates[np.argmax(counts[candidates])]
+    # experts numbered 0..n-1 in the order of their clusters
+    experts, expert_of_cluster = np.unique(target, return_inverse=True)
+    return expert_of_cluster
+
+
+def _train_expert(task):
+    k, cache_file, train_rows, test_rows, scaler, expert_dir, threads, seed, epochs, patience, info = task
+    from model.M07_Incremental_Training import save_version
+    from model.M11_Cross_Validation import train_car_following
+    start = time.perf_counter()
+    data = np.load(cache_file, mmap_mode='r')
+    # only the features and the label of the lines are gathered
+    train_features, train_labels = data[train_rows, FEATURES], data[train_rows, -1]
+    test_features, test_labels = data[test_rows, FEATURES], data[test_rows, -1]
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model, n_epochs = train_car_following(train_features, train_labels, threads, seed, epochs, patience)
+    fit_seconds = time.perf_counter() - start
+    predictions = model.predict(test_features, batch_size=4096, verbose=0).ravel() if len(test_rows) > 0 else []
+    # errors in m/s2
+    unscale = lambda values: (np.asarray(values) - scaler.min_[-1]) / scaler.scale_[-1]
+    error = unscale(predictions) - unscale(test_labels)
+    info = dict(info, expert=k, train_lines=len(train_rows), epochs=n_epochs)
+    save_version(model, scaler, expert_dir, data, info=info, index=train_rows)
+    return {'expert': k, 'train_lines': len(train_rows), 'test_lines': len(test_rows), 'epochs': n_epochs,
+            'mae': float(np.mean(np.abs(error))) if len(error) > 0 else float('nan'),
+            'mse': float(np.mean(error ** 2)) if len(error) > 0 else float('nan'),
+            'load_seconds': round(load_seconds, 3), 'fit_seconds': round(fit_seconds, 3)}
+
+
+def train_experts(data_file, model_dir, n_speed_bands=2, min_rows=1000, processes=None, threads=None,
+                  random_state=42, epochs=100, patience=10, keep_cache=False, verbose=True):
+    '''
+    Fits the gate on the training lines and trains all the experts in parallel;
+    returns one line per expert with its errors on the test lines it is routed
+    '''
+    os.makedirs(model_dir, exist_ok=True)
+    #Step 1: one float32 copy of the data, scaled with the statistics of the training lines (as M01)
+    dataset = load_dataset(data_file)
+    train_index, test_index = split_indices(len(dataset), test_size=0.25, random_state=random_state)
+    vehicle_class = dataset[:, CLASS_COLUMN].astype(np.int64)
+    gate = Gate.fit(vehicle_class[train_index], np.abs(dataset[train_index, FEATURES.start + MEAN_SPEED]),
+                     n_speed_bands)
+    cluster = gate.assign(dataset[:, FEATURES], vehicle_class)
+    scaler = fit_min_max(dataset, train_index)
+    scale_in_place(dataset, scaler)
+    # the workers memory-map the scaled lines instead of receiving a copy each
+    cache_file = os.path.join(model_dir, CACHE_FILE)
+    np.save(cache_file, dataset)
+    del dataset
+
+    #Step 2: experts and their lines
+    expert_of_cluster = merge_clusters(np.bincount(cluster[train_index], minlength=gate.n_clusters),
+                                       gate.n_bands, min_rows)
+    expert = expert_of_cluster[cluster]
+    n_experts = int(expert_of_cluster.max()) + 1
+    if processes is None:
+        processes = min(n_experts, mp.cpu_count())
+    if threads is None:
+        # the cores are shared between the experts trained at the same time
+        threads = max(mp.cpu_count() // processes, 1)
+    tasks = []
+    for k in range(n_experts):
+        clusters = np.flatnonzero(expert_of_cluster == k).tolist()
+        tasks.append((k, cache_file, np.sort(train_index[expert[train_index] == k]),
+                      np.sort(test_index[expert[test_index] == k]), scaler, os.path.join(model_dir, 'expert_%d' % k),
+                      threads, random_state + k, epochs, patience, {'clusters': clusters}))
+
+    #Step 3: train them at the same time
+    start = time.perf_counter()
+    results = []
+    try:
+        # spawn: tensorflow does not support being forked after it has been imported
+        with mp.get_context('spawn').Pool(processes) as pool:
+            for result in pool.imap_unordered(_train_expert, tasks):
+                if verbose:
+                    print('expert %d: %d lines, %d epochs, %.1f s, test MAE %.4f m/s2'
+                          % (result['expert'], result['train_lines'], result['epochs'], result['fit_seconds'],
+                             result['mae']))
+                results.append(result)
+    finally:
+        if not keep_cache:
+            os.remove(cache_file)
+    results = pd.DataFrame(results).sort_values('expert').reset_index(drop=True)
+
+    with open(os.path.join(model_dir, EXPERTS_FILE), 'w') as f:
+        json.dump({'gate': gate.to_dict(), 'expert_of_cluster': expert_of_cluster.tolist(),
+                   'experts': ['expert_%d' % k for k in range(n_experts)],
+                   'report': results.to_dict('records')}, f, indent=2)
+    if verbose:
+        lines = results['test_lines']
+        print('mixture: test MAE %.4f m/s2, %d experts trained in %.1f s'
+              % ((results['mae'] * lines).sum() / max(lines.sum(), 1), n_experts, time.perf_counter() - start))
+    return results
+
+
+class MixturePredictor:
+    '''
+    Routes every row to its expert; as M08 ModelPredictor, but the feature rows do not
+    contain the class of the vehicle, so predict also takes vehicle_class (column 4 of
+    Car_following_df.csv)
+    '''
+    def __init__(self, model_dir):
+        with open(os.path.join(model_dir, EXPERTS_FILE)) as f:
+            saved = json.load(f)
+        self.gate = Gate.from_dict(saved['gate'])
+        self.expert_of_cluster = np.asarray(saved['expert_of_cluster'], dtype=np.int64)
+        self.experts = [ModelPredictor(os.path.join(model_dir, name)) for name in saved['experts']]
+
+    def predict(self, rows, vehicle_class=None):
+        rows = np.asarray(rows)
+        expert = self.expert_of_cluster[self.gate.assign(rows, vehicle_class)]
+        # the rows of each expert are contiguous once sorted by expert
+        order = np.argsort(expert, kind='stable')
+        counts = np.bincount(expert, minlength=len(self.experts))
+        bounds = np.r_[0, np.cumsum(counts)]
+        sorted_rows = rows[order]
+        acceleration = np.empty(len(rows))
+        for k in np.flatnonzero(counts):
+            part = slice(bounds[k], bounds[k + 1])
+            acceleration[order[part]] = self.experts[k].predict(sorted_rows[part])['acceleration']
+        return {'acceleration': acceleration, 'expert': expert}
+
+
+if __name__ == '__main__':
+    import sys
+    # usage: python -m model.M18_Mixture_of_Experts Car_following_df.csv model_dir [n_speed_bands]
+    results = train_experts(sys.argv[1], sys.argv[2], n_speed_bands=int(sys.argv[3]) if len(sys.argv) > 3 else 2)
+    print(results.to_string())
@@ -0,0 +1,164 @@
+"""
+Opt-in instrumentation of the simulation step of M03_CarSimDL
+
+When a profiler is attached to a Model, Model.step measures each phase of the
+step separately:
+
+    update_demand   traffic speed and passenger arrival rates
+    move_bus        dispatch, speed and position of the buses
+    stop_lookup     whether a bus that has moved has reached a bus stop, and which one
+    board_alight    boarding/alighting draws and dwell time at the stop
+    dwell_bus       buses leaving the stops
+    record_bus      appends to the trajectories
+
+and other code can time its own phases (animation, plotting, model inference,
+neighbour search, ...) with model.timed('name'). For every step the profiler
+also counts the buses of each status, the memory blocks allocated by Python
+(sys.getallocatedblocks) and the garbage collections, and with memory=True the
+bytes traced by tracemalloc.
+
+Each step gives one record, sent to the sinks: MemorySink keeps them in memory,
+JsonLinesSink appends them to a file (one JSON object per line, then a summary
+line when the profiler is closed), so runs of different releases can be compared.
+
+    profiler = model.enable_profiling([JsonLinesSink('BusSim_profile.jsonl')])
+    for time_step in range(int(model.EndTime / model.dt)):
+        model.step()
+    print(profiler.summary())
+    model.disable_profiling()
+
+Without a profiler (the default) the step is unchanged.
+"""
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+#status of the buses (see Bus)
+STATUS = ('inactive', 'moving', 'dwelling', 'finished')
+
+
+class MemorySink:
+    '''
+    Keeps the records of the steps in memory (the last max_records only, if given)
+    '''
+    def __init__(self, max_records=None):
+        self.records = deque(maxlen=max_records)
+        self.summary = None
+
+    def write(self, record):
+        self.records.append(record)
+
+    def close(self, summary):
+        self.summary = summary
+
+    def to_frame(self):
+        '''
+        One line per step, one column per phase (seconds)
+        '''
+        import pandas as pd
+        return pd.json_normalize(list(self.records))
+
+
+class JsonLinesSink:
+    '''
+    Appends the record of every every-th step to a file, one JSON object per line
+    '''
+    def __init__(self, path, every=1, mode='a'):
+        self.path = path
+        self.every = every
+        self.file = open(path, mode)
+
+    def write(self, record):
+        if record['step'] % self.every == 0:
+            self.file.write(json.dumps(record) + '\n')
+
+    def close(self, summary):
+        self.file.write(json.dumps({'summary': summary}) + '\n')
+        self.file.close()
+
+
+class StepProfiler:
+    '''
+    Cumulative time and number of calls of each phase, and one record per step
+    '''
+    def __init__(self, sinks=(), memory=False, label=None):
+        self.sinks = list(sinks)
+        self.memory = memory
+        self.label = label
+        self.seconds = {}
+        self.calls = {}
+        self.steps = 0
+        self.step_seconds = 0.0
+        self.current = None
+        self.started_tracing = False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.current is not None:
+            self.current[name] = self.current.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def begin_step(self):
+        self.current = {}
+        self.blocks = sys.getallocatedblocks()
+        self.collections = sum(stats['collections'] for stats in gc.get_stats())
+        if self.memory:
+            self.traced = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+
+    def end_step(self, model):
+        seconds = time.perf_counter() - self.start
+        self.steps += 1
+        self.step_seconds += seconds
+        record = {'step': self.steps, 'time': model.current_time, 'seconds': seconds, 'phases': self.current,
+                  'buses': dict(zip(STATUS, np.bincount([bus.status for bus in model.buses],
+                                                        minlength=len(STATUS)).tolist())),
+                  'allocated_blocks': sys.getallocatedblocks() - self.blocks,
+                  'collections': sum(stats['collections'] for stats in gc.get_stats()) - self.collections}
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            record['traced_bytes'] = current - self.traced
+            record['traced_peak_bytes'] = peak
+        if self.label is not None:
+            record['label'] = self.label
+        for sink in self.sinks:
+            sink.write(record)
+        self.current = None
+
+    def summary(self):
+        '''
+        Steps per second, and the time of each phase (total, per call, share of the step time)
+        '''
+        phases = {}
+        for name in sorted(self.seconds, key=self.seconds.get, reverse=True):
+            phases[name] = {'seconds': self.seconds[name], 'calls': self.calls[name],
+                            'us_per_call': 1e6 * self.seconds[name] / self.calls[name],
+                            'share': self.seconds[name] / self.step_seconds if self.step_seconds > 0 else None}
+        return {'label': self.label, 'steps': self.steps, 'seconds': self.step_seconds,
+                'steps_per_second': self.steps / self.step_seconds if self.step_seconds > 0 else None,
+                'phases': phases}
+
+    def close(self):
+        summary = self.summary()
+        for sink in self.sinks:
+            sink.close(summary)
+        if self.started_tracing:
+            tracemalloc.stop()
+        return summary
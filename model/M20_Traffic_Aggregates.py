@@ -0,0 +1,112 @@
+"""
+Running per-lane and per-direction traffic aggregates for the simulator
+
+The car-following model of M01 takes two traffic features at every line,
+computed by A01 (frame_aggregates) over all the vehicles of the section in the
+driving direction of the vehicle:
+
+    traffic_density = number of vehicles in the direction / (L * NumLane)
+    traffic_speed   = sum of their xVelocity / number of vehicles, with the sign
+                      of the upper lanes (drivingDirection 1, x decreasing) changed
+
+LaneAggregates keeps the number of vehicles and the sum of xVelocity of every
+lane and of every direction, and updates them when a vehicle enters the road,
+leaves it, changes lane or changes speed (move), so the features are read in
+O(1) instead of a pass over all the vehicles. The lanes are numbered as in
+highD: with NumLane lanes per direction, the lanes 2..NumLane+1 are the upper
+lanes and NumLane+3..2*NumLane+2 the lower lanes (the other ids are lane markings).
+
+    traffic = LaneAggregates(length_km=0.424, NumLane=2)
+    traffic.move(NO_LANE, 0, 5, 30.2)       # a vehicle enters lane 5 at 30.2 m/s
+    traffic.move(5, 30.2, 6, 31.0)          # changes lane and speed
+    density, speed = traffic.features(2)    # as A01 for drivingDirection 2
+
+The sums are updated by additions and subtractions, so after many updates they
+may differ from a new sum by rounding errors; rebuild() sums them again.
+"""
+import numpy as np
+
+NO_LANE = -1  # not on the road (not entered yet, or left)
+
+
+class LaneAggregates:
+    '''
+    Number of vehicles and sum of xVelocity (as in highD: negative on the upper lanes) per lane and direction
+    '''
+    def __init__(self, length_km, NumLane=2):
+        self.length_km = length_km
+        self.NumLane = NumLane
+        n_lanes = 2 * NumLane + 3
+        self.lane_count = np.zeros(n_lanes, dtype=np.int64)
+        self.lane_speed = np.zeros(n_lanes)
+        # index 1 and 2: drivingDirection (0 is not used)
+        self.direction_count = np.zeros(3, dtype=np.int64)
+        self.direction_speed = np.zeros(3)
+        # drivingDirection of each lane id
+        self.lane_direction = np.where(np.arange(n_lanes) < NumLane + 2, 1, 2)
+
+    def move(self, old_lane, old_speed, new_lane, new_speed):
+        '''
+        One vehicle moves from (old_lane, old_speed) to (new_lane, new_speed);
+        NO_LANE as old_lane when it enters the road, as new_lane when it leaves
+        '''
+        if old_lane != NO_LANE:
+            direction = self.lane_direction[old_lane]
+            self.lane_count[old_lane] -= 1
+            self.lane_speed[old_lane] -= old_speed
+            self.direction_count[direction] -= 1
+            self.direction_speed[direction] -= old_speed
+        if new_lane != NO_LANE:
+            direction = self.lane_direction[new_lane]
+            self.lane_count[new_lane] += 1
+            self.lane_speed[new_lane] += new_speed
+            self.direction_count[direction] += 1
+            self.direction_speed[direction] += new_speed
+        return
+
+    def move_many(self, old_lane, old_speed, new_lane, new_speed):
+        '''
+        move for arrays of vehicles, in one pass
+        '''
+        for lanes, speeds, sign in ((old_lane, old_speed, -1), (new_lane, new_speed, 1)):
+            lanes = np.asarray(lanes)
+            on_road = lanes != NO_LANE
+            lanes = lanes[on_road]
+            speeds = np.broadcast_to(speeds, on_road.shape)[on_road]
+            np.add.at(self.lane_count, lanes, sign)
+            np.add.at(self.lane_speed, lanes, sign * speeds)
+            np.add.at(self.direction_count, self.lane_direction[lanes], sign)
+            np.add.at(self.direction_speed, self.lane_direction[lanes], sign * speeds)
+        return
+
+    def rebuild(self, lanes, speeds):
+        '''
+        Sums again over all the vehicles (lane NO_LANE: not on the road)
+        '''
+        lanes = np.asarray(lanes, dtype=np.int64)
+        on_road = lanes != NO_LANE
+        n_lanes = len(self.lane_count)
+        self.lane_count = np.bincount(lanes[on_road], minlength=n_lanes)
+        self.lane_speed = np.bincount(lanes[on_road], weights=np.asarray(speeds, dtype=float)[on_road],
+                                      minlength=n_lanes)
+        self.direction_count = np.bincount(self.lane_direction, weights=self.lane_count, minlength=3).astype(np.int64)
+        self.direction_speed = np.bincount(self.lane_direction, weights=self.lane_speed, minlength=3)
+        return
+
+    def _features(self, count, speed, direction, lanes):
+        # as A01: positive speeds in the driving direction, 0 when there is no vehicle
+        sign = -1.0 if direction == 1 else 1.0
+        return count / (self.length_km * lanes), (sign * speed / count if count > 0 else 0.0)
+
+    def features(self, drivingDirection):
+        '''
+        traffic_density (vehicles/km/lane) and traffic_speed of a direction, as A01
+        '''
+        return self._features(self.direction_count[drivingDirection], self.direction_speed[drivingDirection],
+                              drivingDirection, self.NumLane)
+
+    def lane_features(self, lane):
+        '''
+        Density (vehicles/km) and mean speed of one lane
+        '''
+        return self._features(self.lane_count[lane], self.lane_speed[lane], self.lane_direction[lane], 1)
@@ -0,0 +1,174 @@
+"""
+Virtual loop detectors and space-time cells measuring the simulation of M03_CarSimDL as it runs
+
+Instead of keeping the whole trajectories and post-processing them, the
+macroscopic variables are accumulated at every step and written out once per
+interval (e.g. every 60 s of simulated time):
+
+1. loop detectors at given positions: number of vehicles crossing, their
+   time-mean and space-mean (harmonic) speeds, and the occupancy (share of the
+   time a vehicle of vehicle_length is over the loop)
+2. space-time cells between given positions, with Edie's definitions over the
+   cell of length dx and the interval of duration T (area |A| = dx T):
+       flow    q = total distance travelled in the cell / |A|
+       density k = total time spent in the cell / |A|
+       speed   v = q / k
+   within a step a vehicle is assumed to drive at a constant speed, so its
+   distance and time in each cell are the overlap of its path with the cell
+
+The flows are in veh/h/lane, the densities in veh/km/lane (as the traffic_density
+of A01) and the speeds in m/s, so that flow / density is the speed and the
+flow-density diagrams can be compared with the per-lane diagrams of highD (count
+is the number of vehicles over all the lanes). Only the buses on the road (moving
+or dwelling) are measured, plus the step in which a bus leaves the road.
+
+    detectors = Detectors(loops=[5000, 15000], cell_edges=np.arange(0, 40001, 2000), interval=60,
+                          path='BusSim_detectors.csv')
+    model.add_detectors(detectors)
+    model.record_trajectories = False       # the trajectories are not kept
+    for time_step in range(int(model.EndTime / model.dt)):
+        model.step()
+    model.remove_detectors()                # writes the last interval and closes the file
+    detectors.to_frame()                    # or pd.read_csv('BusSim_detectors.csv')
+
+Each closed interval is appended to the csv file straight away (one line per loop
+and per cell), or kept in memory if there is no path.
+"""
+import numpy as np
+
+COLUMNS = ['interval_start', 'interval_end', 'kind', 'id', 'start', 'end', 'count', 'flow', 'density', 'speed',
+           'time_mean_speed', 'occupancy']
+
+
+def path_in_cells(x0, x1, dt, edges):
+    '''
+    Distance travelled and time spent by each vehicle in each cell [edges[c], edges[c+1])
+    during a step of dt, driving from x0 to x1 at a constant speed: (vehicles, cells) arrays
+    '''
+    x0 = np.asarray(x0, dtype=float)[:, None]
+    x1 = np.asarray(x1, dtype=float)[:, None]
+    low, high = np.minimum(x0, x1), np.maximum(x0, x1)
+    distance = np.clip(np.minimum(high, edges[None, 1:]) - np.maximum(low, edges[None, :-1]), 0, None)
+    moving = (high > low)[:, 0]
+    time = np.zeros_like(distance)
+    time[moving] = distance[moving] / (high - low)[moving] * dt
+    # a vehicle that has not moved spends the whole step in its cell
+    stopped = np.flatnonzero(~moving)
+    cell = np.searchsorted(edges, x0[stopped, 0], side='right') - 1
+    inside = (cell >= 0) & (cell < len(edges) - 1)
+    time[stopped[inside], cell[inside]] = dt
+    return distance, time
+
+
+class Detectors:
+    '''
+    Loop detectors and Edie cells, accumulated over intervals of interval seconds
+    '''
+    def __init__(self, loops=(), cell_edges=None, interval=60, vehicle_length=12.0, lanes=1, path=None):
+        self.loops = np.asarray(loops, dtype=float)
+        self.cell_edges = np.asarray(cell_edges if cell_edges is not None else [], dtype=float)
+        self.n_cells = max(len(self.cell_edges) - 1, 0)
+        # the loop is occupied while the front of a vehicle is between the loop and vehicle_length after it
+        self.loop_edges = np.column_stack([self.loops, self.loops + vehicle_length])
+        self.interval = interval
+        self.lanes = lanes
+        self.path = path
+        self.records = []
+        self.file = None
+        if path is not None:
+            self.file = open(path, 'w')
+            self.file.write(','.join(COLUMNS) + '\n')
+        self.previous = None
+        self.interval_start = None
+        self.reset()
+
+    def reset(self):
+        n = len(self.loops)
+        self.loop_count = np.zeros(n, dtype=np.int64)
+        self.loop_speed = np.zeros(n)
+        self.loop_inverse_speed = np.zeros(n)
+        self.loop_occupied = np.zeros(n)
+        self.cell_distance = np.zeros(self.n_cells)
+        self.cell_time = np.zeros(self.n_cells)
+
+    def start(self, current_time, positions):
+        self.interval_start = current_time
+        self.previous = np.asarray(positions, dtype=float)
+
+    def observe(self, x0, x1, t0, dt):
+        '''
+        Adds a step of dt starting at t0, where the vehicles drove from x0 to x1
+        '''
+        while t0 >= self.interval_start + self.interval:
+            self.flush()
+        if len(self.loops) > 0:
+            crossed = (x0[:, None] < self.loops[None, :]) & (x1[:, None] >= self.loops[None, :])
+            speed = (x1 - x0) / dt
+            self.loop_count += crossed.sum(axis=0)
+            self.loop_speed += (crossed * speed[:, None]).sum(axis=0)
+            with np.errstate(divide='ignore'):
+                self.loop_inverse_speed += (crossed * np.where(speed > 0, 1 / speed, 0)[:, None]).sum(axis=0)
+            for d, edges in enumerate(self.loop_edges):
+                self.loop_occupied[d] += path_in_cells(x0, x1, dt, edges)[1].sum()
+        if self.n_cells > 0:
+            distance, time = path_in_cells(x0, x1, dt, self.cell_edges)
+            self.cell_distance += distance.sum(axis=0)
+            self.cell_time += time.sum(axis=0)
+
+    def update(self, model):
+        '''
+        Called by Model.step after every step
+        '''
+        positions = np.array([bus.position for bus in model.buses], dtype=float)
+        # inactive and finished buses stand still off the road: only the buses on the road, or
+        # that have moved during the step (dispatched, or reaching the end of the road), are measured
+        observed = np.array([bus.status in (1, 2) for bus in model.buses], dtype=bool) | (positions != self.previous)
+        self.observe(self.previous[observed], positions[observed], model.current_time - model.dt, model.dt)
+        self.previous = positions
+
+    def flush(self, duration=None):
+        '''
+        Closes the current interval: computes its measurements and writes them out
+        '''
+        T = self.interval if duration is None else duration
+        end = self.interval_start + T
+        lines = []
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for d, position in enumerate(self.loops):
+                count = self.loop_count[d]
+                flow = count / T * 3600 / self.lanes
+                space_mean_speed = count / self.loop_inverse_speed[d] if self.loop_inverse_speed[d] > 0 else np.nan
+                lines.append([self.interval_start, end, 'loop', d, position, position, count, flow,
+                              flow / 3.6 / space_mean_speed, space_mean_speed,
+                              self.loop_speed[d] / count if count > 0 else np.nan, self.loop_occupied[d] / T])
+            for c in range(self.n_cells):
+                area = (self.cell_edges[c + 1] - self.cell_edges[c]) * T
+                flow = self.cell_distance[c] / area
+                density = self.cell_time[c] / area
+                lines.append([self.interval_start, end, 'cell', c, self.cell_edges[c], self.cell_edges[c + 1],
+                              np.nan, flow * 3600 / self.lanes, density * 1000 / self.lanes,
+                              flow / density if density > 0 else np.nan, np.nan, np.nan])
+        if self.file is not None:
+            for line in lines:
+                self.file.write(','.join(str(v) for v in line) + '\n')
+            self.file.flush()
+        else:
+            self.records.extend(lines)
+        self.interval_start = end
+        self.reset()
+
+    def close(self, current_time=None):
+        '''
+        Writes the last (possibly shorter) interval and closes the file
+        '''
+        if current_time is not None and current_time > self.interval_start:
+            self.flush(current_time - self.interval_start)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def to_frame(self):
+        import pandas as pd
+        if self.path is not None:
+            return pd.read_csv(self.path)
+        return pd.DataFrame(self.records, columns=COLUMNS)